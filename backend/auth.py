@@ -5,24 +5,31 @@ Basic authentication system for the health chatbot
 
 from datetime import datetime, timedelta, timezone
 from typing import Optional
-from fastapi import HTTPException, Depends, status
+from fastapi import HTTPException, Depends, Header, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 import jwt
-from database import get_db
+import hmac
+import os
+from database import SessionLocal, get_db, get_read_db
 from models import User
 
 # Security configuration
 SECRET_KEY = "your-secret-key-change-this-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Org-wide operational endpoints (usage across all users, cache and prompt stats) need
+# `X-Ops-Token: <OPS_TOKEN>`; unset disables them
+OPS_TOKEN = os.getenv("OPS_TOKEN")
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # JWT token bearer
 security = HTTPBearer()
+# Same, for endpoints that also serve anonymous callers
+optional_security = HTTPBearer(auto_error=False)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
@@ -59,13 +66,32 @@ def verify_token(token: str) -> Optional[dict]:
             detail="Could not validate credentials"
         )
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
-    """Get the current authenticated user from JWT token"""
-    token = credentials.credentials
-    payload = verify_token(token)
+def request_token_payload(request: Request) -> Optional[dict]:
+    """
+    Decoded bearer token of the request, or None when it is missing or invalid. Decoded
+    once per request: get_read_db routes by it and get_current_user_read reuses it.
+    """
+    if not hasattr(request.state, "token_payload"):
+        authorization = request.headers.get("Authorization", "")
+        payload = None
+        if authorization.lower().startswith("bearer "):
+            try:
+                payload = verify_token(authorization[7:])
+            except Exception:
+                pass
+        request.state.token_payload = payload
+    return request.state.token_payload
+
+def _user_from_credentials(credentials: HTTPAuthorizationCredentials, db: Session) -> User:
+    """Resolve the user referenced by a bearer token"""
+    return user_from_token(credentials.credentials, db)
+
+def user_from_token(token: str, db: Session) -> User:
+    """Resolve the user referenced by a JWT (also used for WebSocket connections)"""
+    return user_from_payload(verify_token(token), db)
+
+def user_from_payload(payload: dict, db: Session) -> User:
+    """Resolve the user referenced by a decoded JWT"""
     user_id: int = payload.get("sub")
     if user_id is None:
         raise HTTPException(
@@ -81,6 +107,48 @@ async def get_current_user(
         )
     return user
 
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_db)
+) -> User:
+    """Get the current authenticated user from JWT token"""
+    return _user_from_credentials(credentials, db)
+
+async def get_current_user_detached(
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+) -> User:
+    """
+    Get the current user with a session that is closed right away, for endpoints that
+    stream or wait (get_db's session would stay checked out until the response ends).
+    The user is detached: its loaded columns are readable, relationships are not.
+    """
+    db = SessionLocal()
+    try:
+        return _user_from_credentials(credentials, db)
+    finally:
+        db.close()
+
+async def get_current_user_read(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    db: Session = Depends(get_read_db)
+) -> User:
+    """Get the current user for read-only endpoints (shares the request's read session)"""
+    payload = request_token_payload(request)
+    if payload is None:
+        # Missing or invalid: decode again for the specific 401
+        return _user_from_credentials(credentials, db)
+    return user_from_payload(payload, db)
+
+async def get_current_user_optional(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    db: Session = Depends(get_db)
+) -> Optional[User]:
+    """Get the current user when a token is sent, None for anonymous requests"""
+    if credentials is None:
+        return None
+    return _user_from_credentials(credentials, db)
+
 def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
     """Authenticate a user with username and password"""
     user = db.query(User).filter(User.username == username).first()
@@ -89,3 +157,11 @@ def authenticate_user(db: Session, username: str, password: str) -> Optional[Use
     if not verify_password(password, user.password_hash):
         return None
     return user
+
+def require_ops_token(x_ops_token: Optional[str] = Header(None)):
+    """Dependency of operational endpoints: the request must carry the OPS_TOKEN"""
+    if not OPS_TOKEN or x_ops_token is None or not hmac.compare_digest(x_ops_token, OPS_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Operations token required"
+        )
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: single-pass format_response vs the previous four re.sub passes
+
+Run: python bench_format.py [--repeat N]
+"""
+
+import argparse
+import re
+import timeit
+from formatting import format_response, StreamingFormatter
+
+def format_response_legacy(text: str) -> str:
+    """The previous implementation, kept here as the baseline"""
+    if not text:
+        return ""
+    text = re.sub(r"^\s*\*", "-", text, flags=re.MULTILINE)
+    text = re.sub(r"-\s*\\(.+?):\\", r"- *\1*:", text)
+    text = re.sub(r"(#+\s[^\n]+)", r"\1\n", text)
+    text = re.sub(r'([.!?])\s+(?=[A-Z])', r'\1\n\n', text)
+    return text.strip()
+
+# Shaped like a "detailed" response_style answer from the chat agents
+SECTION = """## Possible Causes
+Headaches have many possible causes. Most of them are not serious and improve with rest.
+* **Tension headache:** usually linked to stress, poor posture or lack of sleep.
+* **Migraine:** throbbing pain, often on one side, sometimes with nausea or sensitivity to light.
+* **Dehydration:** common after exercise or in hot weather. Drinking water often helps within an hour.
+* **Caffeine withdrawal:** can start a day after cutting back. Symptoms usually fade within a week.
+
+### Next Steps
+Keep a headache diary for two weeks. Note the time, duration, food, sleep and stress level.
+- Stay hydrated throughout the day
+- Take regular screen breaks (the 20-20-20 rule)
+- Consider *acetaminophen* or *ibuprofen* as directed on the label
+
+### When to Seek Help
+Seek urgent care for a sudden, severe headache. Also seek care if it comes with fever, a stiff neck or confusion!
+Is the pain getting worse over days? Book an appointment with your doctor.
+
+"""
+
+def build_answer(sections: int) -> str:
+    return SECTION * sections + "*Disclaimer:* This is general information, not medical advice."
+
+def stream_format(text: str, chunk_size: int = 64) -> str:
+    formatter = StreamingFormatter()
+    parts = [formatter.feed(text[i:i + chunk_size]) for i in range(0, len(text), chunk_size)]
+    parts.append(formatter.flush())
+    return "".join(parts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark format_response")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats (best is reported)")
+    args = parser.parse_args()
+
+    print(f"{'answer size':>12} {'legacy (us)':>12} {'single pass (us)':>17} {'speedup':>8} {'streamed (us)':>14}")
+    for sections in (1, 5, 20, 100):
+        text = build_answer(sections)
+        assert format_response(text) == format_response_legacy(text)
+        assert stream_format(text) == format_response_legacy(text)
+
+        number = max(1, 2000 // sections)
+        legacy = min(timeit.repeat(lambda: format_response_legacy(text), number=number, repeat=args.repeat)) / number
+        single = min(timeit.repeat(lambda: format_response(text), number=number, repeat=args.repeat)) / number
+        streamed = min(timeit.repeat(lambda: stream_format(text), number=number, repeat=args.repeat)) / number
+        print(f"{len(text):>10} ch {legacy * 1e6:>12.1f} {single * 1e6:>17.1f} {legacy / single:>7.2f}x {streamed * 1e6:>14.1f}")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Benchmark: Core rows + JSON bytes (read_path) vs ORM objects + jsonable_encoder for the list endpoints
+
+Run: python bench_read_path.py [--database-url URL] [--repeat N]
+Seeds a throwaway SQLite database by default; point --database-url at an empty
+PostgreSQL database to include the driver's row overhead.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+
+SIZES = (10, 100, 1000, 10000)
+EXTRA_USERS = 5000
+# A few current drugs give the interaction check some work; the rest are finished courses,
+# which it skips (its pairwise check would otherwise dominate both paths)
+INTERACTING = ("Ibuprofen", "Warfarin", "Metformin", "Lisinopril")
+
+def legacy_medications(db, user_id):
+    """The previous /api/medications body, kept here as the baseline"""
+    from fastapi.encoders import jsonable_encoder
+    from models import Medication
+    from read_path import serialize_medication
+    from interactions import check_regimen
+    medications = db.query(Medication).filter(Medication.user_id == user_id).all()
+    content = {"medications": [serialize_medication(med) for med in medications], "interactions": check_regimen(medications)}
+    return _fastapi_render(jsonable_encoder(content))
+
+def legacy_messages(db, session_id):
+    from fastapi.encoders import jsonable_encoder
+    from models import ChatSession, ChatMessage
+    messages = db.query(ChatMessage).join(ChatSession, ChatSession.id == ChatMessage.session_id).filter(
+        ChatSession.session_id == session_id
+    ).order_by(ChatMessage.id).all()
+    content = {"messages": [{"id": m.id, "message_type": m.message_type, "content": m.content, "message_metadata": m.message_metadata, "created_at": m.timestamp} for m in messages]}
+    return _fastapi_render(jsonable_encoder(content))
+
+def legacy_users(db):
+    from fastapi.encoders import jsonable_encoder
+    from models import User
+    users = db.query(User).all()
+    return _fastapi_render(jsonable_encoder({"users": [{"id": u.id, "username": u.username, "email": u.email} for u in users]}))
+
+def _fastapi_render(content) -> bytes:
+    # What JSONResponse.render does with the encoded content
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def fast_medications(db, user_id):
+    from read_path import medication_rows, serialize_medication, json_bytes
+    from interactions import check_regimen
+    medications = medication_rows(db, user_id)
+    return json_bytes({"medications": [serialize_medication(med) for med in medications], "interactions": check_regimen(medications)})
+
+def fast_messages(db, session_id):
+    from read_path import chat_message_rows, json_bytes
+    return json_bytes({"messages": [row._asdict() for row in chat_message_rows(db, session_id)]})
+
+def fast_users(db):
+    from read_path import user_rows, json_bytes
+    return json_bytes({"users": [row._asdict() for row in user_rows(db)]})
+
+def seed(engine, size: int):
+    """One user per size with `size` medications and a session of `size` messages"""
+    from sqlalchemy import insert
+    from models import User, ChatSession, ChatMessage, Medication
+    start = datetime(2024, 1, 1, 8, 30, 15, 250000)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [{"id": size, "username": f"bench_{size}", "email": f"bench_{size}@example.com", "password_hash": "x"}])
+        conn.execute(insert(Medication), [{
+            "id": f"med-{size}-{n}", "user_id": size, "name": INTERACTING[n % len(INTERACTING)],
+            "dosage": "200mg", "frequency": "twice daily", "prescribedBy": "Dr. Bench", "startDate": start,
+            "endDate": None if n < len(INTERACTING) else start + timedelta(days=30), "totalDoses": 60, "instructions": "Take with food",
+            "schedule": {"times": ["09:00", "21:00"]}, "next_due_at": start + timedelta(hours=n),
+        } for n in range(size)])
+        conn.execute(insert(ChatSession), [{"id": size, "session_id": f"bench-{size}", "user_id": size, "agent_type": "general", "created_at": start}])
+        conn.execute(insert(ChatMessage), [{
+            "session_id": size, "message_type": "user" if n % 2 == 0 else "assistant",
+            "content": "How should I take my medication with meals? " * (1 + n % 5),
+            "message_metadata": {"agent_type": "general"} if n % 2 else None, "timestamp": start + timedelta(seconds=n),
+        } for n in range(size)])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the list endpoint read path")
+    parser.add_argument("--database-url", help="empty database to seed (default: a temporary SQLite file)")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats (best is reported)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    # database.py reads DATABASE_URL on import
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench_read_path.db')}"
+    from database import engine, SessionLocal
+    from models import Base
+    Base.metadata.create_all(bind=engine)
+    for size in SIZES:
+        seed(engine, size)
+    with engine.begin() as conn:
+        conn.execute(Base.metadata.tables["users"].insert(), [
+            {"id": 100000 + n, "username": f"bench_user_{n}", "email": f"bench_user_{n}@example.com", "password_hash": "x"}
+            for n in range(EXTRA_USERS)
+        ])
+
+    cases = [
+        ("medications", lambda db, size: legacy_medications(db, size), lambda db, size: fast_medications(db, size)),
+        ("chat-messages", lambda db, size: legacy_messages(db, f"bench-{size}"), lambda db, size: fast_messages(db, f"bench-{size}")),
+    ]
+    print(f"{'endpoint':<14} {'rows':>6} {'ORM (ms)':>9} {'Core (ms)':>10} {'speedup':>8}")
+    db = SessionLocal()
+    try:
+        for name, legacy, fast in cases:
+            for size in SIZES:
+                assert json.loads(legacy(db, size)) == json.loads(fast(db, size))
+                number = max(1, 2000 // size)
+
+                def timed(fn):
+                    def run():
+                        fn(db, size)
+                        # Fresh identity map each time, as in a request
+                        db.expunge_all()
+                    return min(timeit.repeat(run, number=number, repeat=args.repeat)) / number
+
+                orm, core = timed(legacy), timed(fast)
+                print(f"{name:<14} {size:>6} {orm * 1e3:>9.2f} {core * 1e3:>10.2f} {orm / core:>7.2f}x")
+
+        users = db.execute(Base.metadata.tables["users"].select()).all()
+        assert json.loads(legacy_users(db)) == json.loads(fast_users(db))
+        orm = min(timeit.repeat(lambda: (legacy_users(db), db.expunge_all()), number=20, repeat=args.repeat)) / 20
+        core = min(timeit.repeat(lambda: fast_users(db), number=20, repeat=args.repeat)) / 20
+        print(f"{'users':<14} {len(users):>6} {orm * 1e3:>9.2f} {core * 1e3:>10.2f} {orm / core:>7.2f}x")
+    finally:
+        db.close()
@@ -0,0 +1,93 @@
+"""
+Dashboard and chat list data in a few aggregate queries: medications with adherence counts and session summaries
+"""
+
+from datetime import datetime, timezone
+from sqlalchemy import func, case
+from sqlalchemy.orm import Session, aliased
+from models import ChatSession, ChatMessage, Medication, DoseEvent
+
+RECENT_SESSIONS = 5
+# Characters of the last message shown in chat lists
+PREVIEW_CHARS = 120
+
+def _preview(content):
+    if not content:
+        return ""
+    truncated = len(content) > PREVIEW_CHARS
+    content = " ".join(content[:PREVIEW_CHARS].split())
+    return content + "…" if truncated else content
+
+def medications_with_adherence(db: Session, user_id: int):
+    """(medication, doses taken in total, doses taken today, last day a dose was taken) per medication"""
+    today = datetime.now(timezone.utc).date()
+    doses = (
+        db.query(
+            DoseEvent.medication_id.label("medication_id"),
+            func.sum(DoseEvent.count).label("taken"),
+            func.sum(case((DoseEvent.date == today, DoseEvent.count), else_=0)).label("taken_today"),
+            func.max(DoseEvent.date).label("last_taken"),
+        )
+        .filter(DoseEvent.user_id == user_id, DoseEvent.count > 0)
+        .group_by(DoseEvent.medication_id)
+        .subquery()
+    )
+    return (
+        db.query(Medication, doses.c.taken, doses.c.taken_today, doses.c.last_taken)
+        .outerjoin(doses, doses.c.medication_id == Medication.id)
+        .filter(Medication.user_id == user_id)
+        .order_by(Medication.created_at)
+        .all()
+    )
+
+def session_summaries(db: Session, user_id: int, limit: int = None):
+    """
+    The user's chat sessions, most recently active first, with message count, last message
+    time and a preview of the last message, all from one query.
+    """
+    stats = (
+        db.query(
+            ChatMessage.session_id.label("session_pk"),
+            func.count(ChatMessage.id).label("message_count"),
+            func.max(ChatMessage.timestamp).label("last_message_at"),
+            func.max(ChatMessage.id).label("last_message_id"),
+        )
+        .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+        .filter(ChatSession.user_id == user_id)
+        .group_by(ChatMessage.session_id)
+        .subquery()
+    )
+    last_message = aliased(ChatMessage)
+    last_activity = func.coalesce(stats.c.last_message_at, ChatSession.created_at)
+    query = (
+        db.query(
+            ChatSession.id, ChatSession.session_id, ChatSession.agent_type, ChatSession.created_at,
+            stats.c.message_count, stats.c.last_message_at,
+            last_message.message_type.label("last_message_type"),
+            # Only the start of the last message leaves the database
+            func.substr(last_message.content, 1, PREVIEW_CHARS + 1).label("preview"),
+        )
+        .outerjoin(stats, stats.c.session_pk == ChatSession.id)
+        .outerjoin(last_message, last_message.id == stats.c.last_message_id)
+        .filter(ChatSession.user_id == user_id)
+        .order_by(last_activity.desc(), ChatSession.id.desc())
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    return [
+        {
+            "id": row.id,
+            "session_id": row.session_id,
+            "agent_type": row.agent_type,
+            "created_at": row.created_at,
+            "message_count": row.message_count or 0,
+            "last_message_at": row.last_message_at,
+            "last_message_type": row.last_message_type,
+            "preview": _preview(row.preview),
+        }
+        for row in query.all()
+    ]
+
+def recent_sessions(db: Session, user_id: int, limit: int = RECENT_SESSIONS):
+    """The user's latest chat sessions, summarized"""
+    return session_summaries(db, user_id, limit)
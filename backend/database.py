@@ -1,7 +1,17 @@
-from sqlalchemy import create_engine
+from sqlalchemy import DateTime, bindparam, create_engine, event, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+from fastapi import Request
 from dotenv import load_dotenv
+from contextvars import ContextVar
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from collections import Counter
 import os
+import re
+import time
+import threading
 import logging
 
 # Set up logging
@@ -14,26 +24,238 @@ load_dotenv()
 # For team development, set TEAM_DATABASE_URL in .env file
 # For local development, set LOCAL_DATABASE_URL or use default
 
-# Use team database if available, otherwise fall back to local
-# In database.py
-DATABASE_URL = os.getenv("DATABASE_URL") or os.getenv("TEAM_DATABASE_URL") or os.getenv("LOCAL_DATABASE_URL", "postgresql://...")
+# Use team database if available, otherwise fall back to local, and with none of
+# them set to an embedded SQLite file next to this module (see SQLite mode below)
+DEFAULT_SQLITE_URL = f"sqlite:///{os.path.join(os.path.dirname(os.path.abspath(__file__)), 'healthmate.db')}"
+DATABASE_URL = os.getenv("DATABASE_URL") or os.getenv("TEAM_DATABASE_URL") or os.getenv("LOCAL_DATABASE_URL", DEFAULT_SQLITE_URL)
 
 logger.info(f"Connecting to database: {DATABASE_URL}")
 
-# Create engine with connection pooling and better timeout settings
-engine = create_engine(
-    DATABASE_URL,
-    pool_size=5,
-    max_overflow=10,
+# Optional read replica - when set, read-only endpoints are served from it
+READ_REPLICA_URL = os.getenv("READ_REPLICA_URL")
+# Replica is skipped while its replay lag is above this many seconds
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "5"))
+# How often (seconds) the replica lag is re-checked
+REPLICA_CHECK_INTERVAL_SECONDS = float(os.getenv("REPLICA_CHECK_INTERVAL_SECONDS", "5"))
+# After a user writes, their reads stay on the primary for this many seconds
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+# How often each process reloads the read-your-writes markers of the other processes
+READ_YOUR_WRITES_REFRESH_SECONDS = float(os.getenv("READ_YOUR_WRITES_REFRESH_SECONDS", "1"))
+
+# Connection pooling and timeout settings shared by the primary and the replica.
+# Pool sizes are per process; serve.py derives them from DB_CONNECTION_BUDGET per worker
+ENGINE_OPTIONS = dict(
+    pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "10")),
     pool_timeout=30,
     pool_pre_ping=True,
     pool_recycle=1800,  # Recycle connections after 30 minutes
     echo=False  # Set to True for SQL query logging (useful for debugging)
 )
 
+# SQLite mode (DATABASE_URL=sqlite:///path/to/file.db): every connection is set up with
+# these pragmas. WAL lets readers run alongside the single writer; NORMAL sync is
+# durable across application crashes and only risks the last commits on power loss.
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+# Bytes of the database file read through a memory map instead of read() calls
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Page cache per connection, in KiB
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", str(64 * 1024)))
+# How long a write waits for another connection's (or worker's) write to finish
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+if SQLITE_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"SQLITE_SYNCHRONOUS must be OFF, NORMAL, FULL or EXTRA, not {SQLITE_SYNCHRONOUS!r}")
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        # journal_mode is stored in the file; an in-memory database stays in "memory" mode
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        # Negative sizes are in KiB rather than pages
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        # Off by default in SQLite; the models rely on ON DELETE CASCADE
+        cursor.execute("PRAGMA foreign_keys=ON")
+    finally:
+        cursor.close()
+
+def engine_options(url) -> dict:
+    """ENGINE_OPTIONS adjusted for the database behind `url`"""
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        return ENGINE_OPTIONS
+    # FastAPI runs sync endpoints in a threadpool, so a pooled connection is used from
+    # whichever thread checks it out (never from two at once). The driver keeps its
+    # default transaction handling: reads outside a write run in autocommit, and a
+    # write transaction begins at its first INSERT/UPDATE/DELETE, where it waits up
+    # to the busy timeout for the write lock instead of failing.
+    connect_args = {"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    if url.database in (None, "", ":memory:"):
+        # Each connection would otherwise get its own empty in-memory database
+        return dict(poolclass=StaticPool, connect_args=connect_args, echo=ENGINE_OPTIONS["echo"])
+    return dict(ENGINE_OPTIONS, connect_args=connect_args)
+
+def create_database_engine(url):
+    """Engine for the primary, the replica or a chat shard"""
+    created = create_engine(url, **engine_options(url))
+    if created.dialect.name == "sqlite":
+        event.listen(created, "connect", _configure_sqlite)
+    return created
+
+# Create engine with connection pooling and better timeout settings
+engine = create_database_engine(DATABASE_URL)
+
 # Create SessionLocal class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+replica_engine = None
+ReplicaSessionLocal = None
+if READ_REPLICA_URL:
+    logger.info(f"Read replica configured: {READ_REPLICA_URL}")
+    replica_engine = create_database_engine(READ_REPLICA_URL)
+    ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine)
+
+# Query instrumentation. Every statement is timed; within a request (see
+# QueryStatsMiddleware) statements are counted, and repeated statements of the same
+# shape are reported as likely N+1 queries.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+# Log the plan of slow SELECTs too (one extra EXPLAIN round trip per slow query)
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "0") == "1"
+# A statement shape executed this many times in one request is flagged
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "5"))
+# Add X-DB-Queries / X-DB-Time response headers (development and staging)
+DB_DEBUG_HEADERS = os.getenv("DB_DEBUG_HEADERS", "0") == "1"
+# Fail requests that exceed their endpoint's @query_budget instead of logging (tests)
+DB_QUERY_BUDGET_ENFORCE = os.getenv("DB_QUERY_BUDGET_ENFORCE", "0") == "1"
+
+# Literals and expanded IN lists do not change a statement's shape
+SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_PARAMETER_LIST = re.compile(r"\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)")
+SQL_WHITESPACE = re.compile(r"\s+")
+
+def statement_shape(statement: str) -> str:
+    shape = SQL_LITERAL.sub("?", statement)
+    shape = SQL_PARAMETER_LIST.sub("(?...)", shape)
+    return SQL_WHITESPACE.sub(" ", shape).strip()
+
+class QueryStats:
+    """Queries run on behalf of one request (including its threadpool work)"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.count = 0
+        self.total_ms = 0.0
+        self.shapes = Counter()
+        self.flagged = set()
+        self._lock = threading.Lock()
+
+    def record(self, statement: str, elapsed_ms: float):
+        shape = statement_shape(statement)
+        with self._lock:
+            self.count += 1
+            self.total_ms += elapsed_ms
+            self.shapes[shape] += 1
+            repeated = self.shapes[shape] >= N_PLUS_ONE_THRESHOLD and shape not in self.flagged
+            if repeated:
+                self.flagged.add(shape)
+        if repeated:
+            logger.warning(f"Possible N+1 in {self.label}: statement ran {N_PLUS_ONE_THRESHOLD}+ times: {shape[:300]}")
+
+_query_stats: ContextVar = ContextVar("query_stats", default=None)
+
+def current_query_stats():
+    return _query_stats.get()
+
+def _explain(conn, cursor, statement: str, parameters) -> str:
+    prefix = "EXPLAIN " if conn.dialect.name == "postgresql" else "EXPLAIN QUERY PLAN "
+    # A raw cursor, so the EXPLAIN itself is not timed and logged again
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute(prefix + statement, parameters)
+        return "\n".join(" ".join(str(value) for value in row) for row in explain_cursor.fetchall())
+    finally:
+        explain_cursor.close()
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_started"].pop()) * 1000
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.record(statement, elapsed_ms)
+    if SLOW_QUERY_MS and elapsed_ms >= SLOW_QUERY_MS:
+        where = f" in {stats.label}" if stats is not None else ""
+        message = f"Slow query ({elapsed_ms:.0f} ms){where}: {SQL_WHITESPACE.sub(' ', statement)[:1000]}"
+        if SLOW_QUERY_EXPLAIN and not executemany and statement.lstrip()[:6].upper() == "SELECT":
+            try:
+                message += "\n" + _explain(conn, cursor, statement, parameters)
+            except Exception as e:
+                message += f"\n(EXPLAIN failed: {e})"
+        logger.warning(message)
+
+def _on_query_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get("query_started"):
+        context.connection.info["query_started"].pop()
+
+def instrument_engine(instrumented):
+    event.listen(instrumented, "before_cursor_execute", _before_cursor_execute)
+    event.listen(instrumented, "after_cursor_execute", _after_cursor_execute)
+    event.listen(instrumented, "handle_error", _on_query_error)
+
+for instrumented in (engine, replica_engine):
+    if instrumented is not None:
+        instrument_engine(instrumented)
+
+def query_budget(max_queries: int):
+    """Declare the most queries an endpoint may run; checked by QueryStatsMiddleware"""
+    def decorate(endpoint):
+        endpoint.query_budget = max_queries
+        return endpoint
+    return decorate
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+class QueryStatsMiddleware:
+    """ASGI middleware collecting QueryStats per HTTP request, for headers and budgets"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = QueryStats(f"{scope['method']} {scope['path']}")
+        token = _query_stats.set(stats)
+
+        async def send_with_stats(message):
+            if message["type"] == "http.response.start":
+                # The router has stored the matched endpoint in the scope by now
+                budget = getattr(scope.get("endpoint"), "query_budget", None)
+                if budget is not None and stats.count > budget:
+                    error = f"{stats.label} ran {stats.count} queries, over its budget of {budget}"
+                    if DB_QUERY_BUDGET_ENFORCE:
+                        raise QueryBudgetExceeded(error)
+                    logger.warning(error)
+                if DB_DEBUG_HEADERS:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-db-queries", str(stats.count).encode()))
+                    headers.append((b"x-db-time", f"{stats.total_ms:.1f}".encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            _query_stats.reset(token)
+
 # Dependency to get database session
 def get_db():
     db = SessionLocal()
@@ -42,6 +264,142 @@ def get_db():
     finally:
         db.close()
 
+# Seconds the replica is behind the primary. 0 when it has replayed everything it
+# received (an idle primary would otherwise look like growing lag), NULL when the
+# server is not in recovery at all.
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+_replica_state = {"healthy": True, "checked_at": 0.0}
+_replica_lock = threading.Lock()
+
+# Read-your-writes markers, on the primary so every worker sees a user's latest write.
+# Each process reads the live ones in one query per refresh interval, not one per read.
+UPSERT_RECENT_WRITE_SQL = text("""
+    INSERT INTO recent_writes (user_id, expires_at) VALUES (:user_id, :expires_at)
+    ON CONFLICT (user_id) DO UPDATE SET expires_at = excluded.expires_at
+""").bindparams(bindparam("expires_at", type_=DateTime))
+LIVE_RECENT_WRITES_SQL = text(
+    "SELECT user_id, expires_at FROM recent_writes WHERE expires_at > :now"
+).bindparams(bindparam("now", type_=DateTime))
+
+# "pending": this process's marks since the last reload, which may not be in its result
+_recent_writes = {"users": {}, "pending": {}, "loaded_at": 0.0, "failed": False}
+_recent_writes_lock = threading.Lock()
+
+if replica_engine is not None:
+    @event.listens_for(replica_engine, "handle_error")
+    def _on_replica_error(context):
+        # A dropped replica connection takes the replica out of rotation until the next check
+        if context.is_disconnect:
+            logger.warning("Read replica connection lost, routing reads to primary")
+            _replica_state.update(healthy=False, checked_at=time.monotonic())
+
+def replica_available() -> bool:
+    """Check (at most every REPLICA_CHECK_INTERVAL_SECONDS) that the replica is up and caught up"""
+    if replica_engine is None:
+        return False
+    if time.monotonic() - _replica_state["checked_at"] < REPLICA_CHECK_INTERVAL_SECONDS:
+        return _replica_state["healthy"]
+    with _replica_lock:
+        # Another request may have refreshed the state while we waited for the lock
+        if time.monotonic() - _replica_state["checked_at"] < REPLICA_CHECK_INTERVAL_SECONDS:
+            return _replica_state["healthy"]
+        try:
+            with replica_engine.connect() as conn:
+                lag = conn.execute(text(REPLICA_LAG_SQL)).scalar()
+            healthy = lag is None or float(lag) <= REPLICA_MAX_LAG_SECONDS
+            if not healthy:
+                logger.warning(f"Read replica lagging by {float(lag):.1f}s, routing reads to primary")
+        except Exception as e:
+            logger.warning(f"Read replica unavailable, routing reads to primary: {e}")
+            healthy = False
+        _replica_state.update(healthy=healthy, checked_at=time.monotonic())
+        return healthy
+
+def _utcnow() -> datetime:
+    # Stored naive, like the other DateTime columns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+@contextmanager
+def _untracked():
+    # Replica routing bookkeeping is not the endpoint's own work: keep it out of its query budget
+    token = _query_stats.set(None)
+    try:
+        yield
+    finally:
+        _query_stats.reset(token)
+
+def mark_user_write(user_id):
+    """Keep a user's reads on the primary for READ_YOUR_WRITES_SECONDS after they write"""
+    if replica_engine is None or user_id is None:
+        return
+    expires_at = _utcnow() + timedelta(seconds=READ_YOUR_WRITES_SECONDS)
+    # This process sees its own writes at once, the others on their next refresh
+    _recent_writes["users"][int(user_id)] = expires_at
+    _recent_writes["pending"][int(user_id)] = expires_at
+    with _untracked(), engine.begin() as conn:
+        conn.execute(UPSERT_RECENT_WRITE_SQL, {"user_id": int(user_id), "expires_at": expires_at})
+
+def _refresh_recent_writes():
+    if time.monotonic() - _recent_writes["loaded_at"] < READ_YOUR_WRITES_REFRESH_SECONDS:
+        return
+    with _recent_writes_lock:
+        # Another request may have refreshed the markers while we waited for the lock
+        if time.monotonic() - _recent_writes["loaded_at"] < READ_YOUR_WRITES_REFRESH_SECONDS:
+            return
+        now = _utcnow()
+        try:
+            with engine.connect() as conn:
+                users = dict(conn.execute(LIVE_RECENT_WRITES_SQL, {"now": now}).all())
+            failed = False
+        except Exception as e:
+            logger.warning(f"Could not load recent writes, reading from primary: {e}")
+            users, failed = {}, True
+        pending, _recent_writes["pending"] = _recent_writes["pending"], {}
+        for user_id, expires_at in pending.items():
+            if expires_at > users.get(user_id, now):
+                users[user_id] = expires_at
+        _recent_writes.update(users=users, loaded_at=time.monotonic(), failed=failed)
+
+def _recently_wrote(user_id) -> bool:
+    if user_id is None:
+        return False
+    _refresh_recent_writes()
+    if _recent_writes["failed"]:
+        # Unknown, so the read cannot safely go to the replica
+        return True
+    expires_at = _recent_writes["users"].get(int(user_id))
+    return expires_at is not None and expires_at > _utcnow()
+
+def use_replica(user_id) -> bool:
+    """Whether a read for this user (None: anonymous) may go to the replica"""
+    with _untracked():
+        return (
+            replica_engine is not None
+            and replica_available()
+            and not _recently_wrote(user_id)
+        )
+
+def _request_user_id(request: Request):
+    """User id from the bearer token, or None - validation proper is left to get_current_user"""
+    from auth import request_token_payload
+    payload = request_token_payload(request)
+    return payload.get("sub") if payload else None
+
+# Dependency to get a session for read-only endpoints. Uses the replica when one is
+# configured, healthy and the user has not written within the read-your-writes window.
+def get_read_db(request: Request):
+    db = ReplicaSessionLocal() if use_replica(_request_user_id(request)) else SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
 # Create all tables
 def create_tables():
     try:
@@ -55,81 +413,37 @@ def create_tables():
 # Handle database migrations with better error handling and data preservation
 def migrate_database():
     from models import Base
-    from sqlalchemy import text, inspect
     
     try:
-        inspector = inspect(engine)
-        existing_tables = inspector.get_table_names()
-        
-        # Check if medications table exists and needs migration
-        if 'medications' in existing_tables:
-            logger.info("Medications table exists, checking if migration is needed...")
-            
-            # Check if the table has the old schema (prescribed_by vs prescribedBy)
-            columns = inspector.get_columns('medications')
-            column_names = [col['name'] for col in columns]
-            
-            if 'prescribed_by' in column_names:
-                logger.info("Old schema detected, migrating medications table...")
-                
-                # Create a temporary table to preserve data
-                with engine.connect() as conn:
-                    # Create temporary table with old schema
-                    conn.execute(text("""
-                        CREATE TABLE IF NOT EXISTS medications_temp (
-                            id VARCHAR(50) PRIMARY KEY,
-                            user_id INTEGER,
-                            name VARCHAR(100) NOT NULL,
-                            dosage VARCHAR(50) NOT NULL,
-                            frequency VARCHAR(50) NOT NULL,
-                            prescribed_by VARCHAR(100) NOT NULL,
-                            start_date TIMESTAMP NOT NULL,
-                            end_date TIMESTAMP,
-                            total_doses INTEGER,
-                            instructions TEXT,
-                            created_at TIMESTAMP,
-                            FOREIGN KEY (user_id) REFERENCES users (id)
-                        )
-                    """))
-                    
-                    # Copy data to temporary table
-                    conn.execute(text("""
-                        INSERT INTO medications_temp 
-                        SELECT id, user_id, name, dosage, frequency, prescribed_by, 
-                               start_date, end_date, total_doses, instructions, created_at
-                        FROM medications
-                    """))
-                    
-                    # Drop the old table
-                    conn.execute(text("DROP TABLE medications CASCADE"))
-                    conn.commit()
-                    logger.info("Old medications table dropped")
-                
-                # Create new table with correct schema
-                Base.metadata.create_all(bind=engine)
-                logger.info("New medications table created with correct schema")
-                
-                # Copy data back with corrected column names
-                with engine.connect() as conn:
-                    conn.execute(text("""
-                        INSERT INTO medications (id, user_id, name, dosage, frequency, 
-                                                "prescribedBy", "startDate", "endDate", 
-                                                "totalDoses", instructions, created_at)
-                        SELECT id, user_id, name, dosage, frequency, prescribed_by, 
-                               start_date, end_date, total_doses, instructions, created_at
-                        FROM medications_temp
-                    """))
-                    
-                    # Drop the temporary table
-                    conn.execute(text("DROP TABLE medications_temp"))
-                    conn.commit()
-                    logger.info("Data migrated to new medications table")
-            else:
-                logger.info("Medications table already has correct schema")
-        else:
-            # Create all tables if they don't exist
-            Base.metadata.create_all(bind=engine)
-            logger.info("All database tables created successfully")
+        # New tables (including the data_migrations checkpoints) first
+        Base.metadata.create_all(bind=engine)
+
+        # Column renames and backfills on existing tables run online: short batched
+        # transactions with checkpoints instead of copying whole tables. Large
+        # deployments set RUN_STARTUP_BACKFILLS=0 and run `python online_migrations.py run`
+        # next to the live servers.
+        from online_migrations import run_migrations
+        run_migrations(backfill=os.getenv("RUN_STARTUP_BACKFILLS", "1") != "0")
+
+        # Columns and indexes added to the models since the database was created
+        add_missing_columns()
+        add_missing_indexes()
+
+        create_search_index()
+
+        if engine.dialect.name == "sqlite":
+            # Planner statistics for the tables and indexes that changed
+            with engine.connect() as conn:
+                conn.execute(text("PRAGMA optimize"))
+
+        # Chat tables on the chat shards, when chat storage is sharded (shards.py)
+        from shards import migrate_shards
+        migrate_shards()
+
+        # Keep upcoming chat_messages partitions in place (no-op until partitions.py convert has run)
+        if engine.dialect.name == "postgresql":
+            from partitions import ensure_future_partitions
+            ensure_future_partitions()
             
     except Exception as e:
         logger.error(f"Error during database migration: {e}")
@@ -142,6 +456,145 @@ def migrate_database():
             logger.error(f"Error in fallback table creation: {e2}")
             raise
 
+# Add model columns that existing tables are missing. Only nullable (or Python-side
+# defaulted) additions are handled - existing rows get NULL.
+def add_missing_columns():
+    from models import Base
+    from sqlalchemy import inspect
+
+    from online_migrations import run_ddl
+
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {col['name'] for col in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            # Nullable additions are metadata-only; run_ddl keeps them from queueing behind long transactions
+            run_ddl([f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"])
+            logger.info(f"Added column {table.name}.{column.name}")
+
+# Create model indexes that existing tables are missing (create_all skips existing tables).
+# On PostgreSQL they are built CONCURRENTLY, so writes to large tables are not blocked.
+def add_missing_indexes():
+    from models import Base
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import CreateIndex
+
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    postgres = engine.dialect.name == "postgresql"
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            if postgres and table.name == "chat_messages":
+                from partitions import is_partitioned
+                if is_partitioned(conn):
+                    continue
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                statement = str(CreateIndex(index).compile(dialect=engine.dialect))
+                if postgres:
+                    statement = statement.replace(" INDEX ", " INDEX CONCURRENTLY ", 1)
+                try:
+                    conn.execute(text(statement))
+                    logger.info(f"Created index {index.name}")
+                except Exception as e:
+                    logger.error(f"Could not create index {index.name}: {e}")
+
+# Full-text search over chat messages: a GIN index on the content_tsv column and indexes
+# for the user -> sessions -> messages join. content_tsv itself is added and backfilled
+# online (online_migrations.py, chat_messages_content_tsv) and kept current by a trigger.
+SEARCH_INDEX_DDL = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chat_messages_content_tsv ON chat_messages USING GIN (content_tsv)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chat_messages_session_id ON chat_messages (session_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_chat_sessions_user_id ON chat_sessions (user_id)",
+]
+
+# SQLite mode: an FTS5 index of chat_messages.content. It is an external-content table
+# (the text is not stored twice) kept in sync by triggers; porter stemming matches
+# roughly what the 'english' configuration does on Postgres.
+SQLITE_SEARCH_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+        content, content='chat_messages', content_rowid='id', tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update AFTER UPDATE OF content ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_messages_fts (rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_chat_messages_session_id ON chat_messages (session_id)",
+    "CREATE INDEX IF NOT EXISTS ix_chat_sessions_user_id ON chat_sessions (user_id)",
+]
+
+def _create_sqlite_search_index(target):
+    with target.begin() as conn:
+        exists = conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_fts'"
+        )).scalar()
+        for statement in SQLITE_SEARCH_DDL:
+            conn.execute(text(statement))
+        if not exists:
+            # Index the messages written before the triggers existed
+            conn.execute(text("INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('rebuild')"))
+            logger.info("Built full-text search index (FTS5)")
+
+def create_search_index(target=None):
+    # The primary by default; chat shards pass their own engine
+    target = target if target is not None else engine
+    if target.dialect.name == "sqlite":
+        try:
+            _create_sqlite_search_index(target)
+        except Exception as e:
+            logger.error(f"Error creating full-text search index: {e}")
+        return
+    if target.dialect.name != "postgresql":
+        logger.info("Skipping full-text search index (requires PostgreSQL or SQLite)")
+        return
+    try:
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        from online_migrations import CONTENT_TSV
+        if target is not engine:
+            # A new chat shard's table is empty: column and trigger without a backfill
+            CONTENT_TSV.install(target)
+        with target.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            from partitions import is_partitioned
+            from sqlalchemy import inspect
+            # Partitioned tables get these from partitions.py and reject CONCURRENTLY
+            concurrently = not is_partitioned(conn)
+            columns = {col["name"] for col in inspect(conn).get_columns("chat_messages")}
+            for statement in SEARCH_INDEX_DDL:
+                if "content_tsv" in statement and "content_tsv" not in columns:
+                    logger.warning("chat_messages.content_tsv is missing; run `python online_migrations.py run`")
+                    continue
+                if not concurrently:
+                    statement = statement.replace(" CONCURRENTLY", "")
+                conn.execute(text(statement))
+        logger.info("Full-text search index is up to date")
+    except Exception as e:
+        logger.error(f"Error creating full-text search index: {e}")
+
 # Test database connection
 def test_connection():
     try:
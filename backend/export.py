@@ -0,0 +1,80 @@
+"""
+Streaming NDJSON export of a user's chat sessions, messages, medications and doses taken
+"""
+
+import json
+import zlib
+from datetime import date, datetime, timezone
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+from models import ChatSession, ChatMessage, Medication, DoseEvent
+
+# Rows fetched per round trip from the server-side cursor
+EXPORT_BATCH_SIZE = 1000
+
+SESSION_COLUMNS = (ChatSession.id, ChatSession.session_id, ChatSession.agent_type, ChatSession.created_at)
+MESSAGE_COLUMNS = (
+    ChatMessage.id, ChatSession.session_id, ChatMessage.message_type,
+    ChatMessage.content, ChatMessage.timestamp, ChatMessage.message_metadata,
+)
+MEDICATION_COLUMNS = (
+    Medication.id, Medication.name, Medication.dosage, Medication.frequency, Medication.prescribedBy,
+    Medication.startDate, Medication.endDate, Medication.totalDoses, Medication.instructions, Medication.created_at,
+)
+DOSE_COLUMNS = (DoseEvent.medication_id, DoseEvent.date, DoseEvent.count, DoseEvent.updated_at)
+# Records read from the chat tables, which may live on a chat shard
+CHAT_RECORDS = ("session", "message")
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+def _record(record_type: str, row: dict) -> str:
+    return json.dumps({"type": record_type, **row}, default=_json_default, ensure_ascii=False) + "\n"
+
+def _export_queries(user_id: int):
+    yield "session", select(*SESSION_COLUMNS).where(ChatSession.user_id == user_id).order_by(ChatSession.id)
+    yield "message", (
+        select(*MESSAGE_COLUMNS)
+        .join(ChatSession, ChatSession.id == ChatMessage.session_id)
+        .where(ChatSession.user_id == user_id)
+        .order_by(ChatMessage.session_id, ChatMessage.id)
+    )
+    yield "medication", select(*MEDICATION_COLUMNS).where(Medication.user_id == user_id).order_by(Medication.id)
+    yield "dose", select(*DOSE_COLUMNS).where(DoseEvent.user_id == user_id).order_by(DoseEvent.medication_id, DoseEvent.date)
+
+def _stream(conn, record_type: str, statement):
+    # yield_per switches to a server-side cursor (stream_results) on PostgreSQL
+    result = conn.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(statement)
+    for batch in result.mappings().partitions():
+        yield "".join(_record(record_type, dict(row)) for row in batch)
+
+def iter_export_lines(engine: Engine, user_id: int, chat_engine: Engine = None):
+    """
+    Yield one chunk of NDJSON per fetched batch; only one batch is ever held in memory.
+    chat_engine is the user's chat shard when chat storage is sharded.
+    """
+    yield _record("export", {"user_id": user_id, "generated_at": datetime.now(timezone.utc)})
+    with engine.connect() as conn:
+        for record_type, statement in _export_queries(user_id):
+            if record_type in CHAT_RECORDS and chat_engine not in (None, engine):
+                with chat_engine.connect() as chat_conn:
+                    yield from _stream(chat_conn, record_type, statement)
+            else:
+                yield from _stream(conn, record_type, statement)
+
+def iter_export(engine: Engine, user_id: int, compress: bool = False, chat_engine: Engine = None):
+    """Encoded export stream, gzip-compressed incrementally when requested"""
+    if not compress:
+        for chunk in iter_export_lines(engine, user_id, chat_engine):
+            yield chunk.encode("utf-8")
+        return
+
+    # wbits=31 produces a gzip container rather than a raw zlib stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in iter_export_lines(engine, user_id, chat_engine):
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
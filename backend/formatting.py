@@ -0,0 +1,135 @@
+"""
+Markdown post-processing of AI responses, in one pass over the text or incrementally over streamed chunks
+"""
+
+import re
+
+# The four formatting rules, applied in this order:
+#   1. bullets written with '*' at the start of a line become '-'
+#   2. "-\\Label:\\" bullets become "- *Label*:"
+#   3. a line break is added after headings (## or ###)
+#   4. sentences are separated by a blank line
+BULLET = re.compile(r"^\s*\*", re.MULTILINE)
+LABEL = re.compile(r"-\s*\\(.+?):\\")
+HEADING = re.compile(r"(#+\s[^\n]+)")
+SENTENCE = re.compile(r"([.!?])\s+(?=[A-Z])")
+
+# Rules 1, 3 and 4 as one scan with one pattern. Every alternative starts with a literal
+# character, so the regex engine only stops at newlines, '#', '.', '!' and '?'. Bullets are
+# matched from the newline before them for the same reason.
+COMBINED = re.compile(
+    r"\n(\s*\*)"                                   # 1: bullet
+    r"|\.(\s+)(?=[A-Z])"                            # 2: sentence ending in '.'
+    r"|#(#*\s[^\n]*[.!?])[^\S\n]*\n\s*(?=[A-Z])"     # 3: heading ending a sentence before a capital
+    r"|#(#*\s[^\n]+)"                                # 4: heading
+    r"|!(\s+)(?=[A-Z])"                              # 5: sentence ending in '!'
+    r"|\?(\s+)(?=[A-Z])"                            # 6: sentence ending in '?'
+)
+CONSTANT_REPLACEMENTS = {1: "\n-", 2: ".\n\n", 5: "!\n\n", 6: "?\n\n"}
+LEADING_BULLET = re.compile(r"\s*\*")
+
+def _format_sequential(text: str) -> str:
+    """The rules as separate passes; used for the rare inputs the single pass does not cover"""
+    text = BULLET.sub("-", text)
+    text = LABEL.sub(r"- *\1*:", text)
+    text = HEADING.sub(r"\1\n", text)
+    return SENTENCE.sub(r"\1\n\n", text)
+
+def _replace(match, constants=CONSTANT_REPLACEMENTS, split_sentences=SENTENCE.sub):
+    replacement = constants.get(match.lastindex)
+    if replacement is not None:
+        return replacement
+    if match.lastindex == 4:
+        return split_sentences(r"\1\n\n", match.group()) + "\n"
+    # The heading's closing sentence mark pairs with the capital after the heading's
+    # line break, so everything up to that capital collapses into one blank line
+    return split_sentences(r"\1\n\n", "#" + match.group(3)) + "\n\n"
+
+def _format_body(text: str) -> str:
+    """Apply the formatting rules without the final strip"""
+    # Label bullets and headings whose text starts on the next line interact with the
+    # other rules in ways the single pass does not model; both are rare in practice
+    if "\\" in text or "#\n" in text:
+        return _format_sequential(text)
+
+    leading = LEADING_BULLET.match(text)
+    if leading:
+        return "-" + COMBINED.sub(_replace, text[leading.end():])
+    return COMBINED.sub(_replace, text)
+
+def format_response(text: str) -> str:
+    """
+    Format AI response into clean Markdown with:
+    - Proper headings
+    - Consistent bullet points
+    - Bolded keywords
+    - Separated disclaimers
+    """
+
+    if not text:
+        return ""
+    return _format_body(text).strip()
+
+class StreamingFormatter:
+    """
+    Incremental format_response for streamed output.
+
+    feed() returns the formatted text that is final so far, flush() the rest. The
+    concatenated output equals format_response() of the concatenated input. Text is
+    held back until a line break where no rule can match across the break.
+    """
+
+    def __init__(self):
+        self._pending = ""      # Input not formatted yet
+        self._started = False   # Whether non-whitespace output has been emitted
+        self._held_space = ""   # Trailing whitespace emitted only if more text follows
+
+    def _safe_cut(self) -> int:
+        """Index of the last line start at which the buffered text can be split, or 0"""
+        text = self._pending
+        cut = text.rfind("\n", 0, len(text) - 1)
+        while cut > 0:
+            start = cut + 1
+            first = text[start]
+            before = text[cut - 1]
+            if not (first.isspace() or first == "\\" or before == "#"):
+                if first == "*":
+                    # A bullet after a blank line swallows the blank line
+                    safe = not before.isspace()
+                elif "A" <= first <= "Z":
+                    # A capital may start a sentence that needs a blank line before it
+                    safe = text[:cut].rstrip()[-1:] not in (".", "!", "?")
+                else:
+                    safe = True
+                if safe:
+                    return start
+            cut = text.rfind("\n", 0, cut)
+        return 0
+
+    def _emit(self, formatted: str, final: bool) -> str:
+        if not self._started:
+            formatted = formatted.lstrip()
+            if not formatted:
+                return ""
+            self._started = True
+        formatted = self._held_space + formatted
+        if final:
+            self._held_space = ""
+            return formatted.rstrip()
+        body = formatted.rstrip()
+        self._held_space = formatted[len(body):]
+        return body
+
+    def feed(self, chunk: str) -> str:
+        if not chunk:
+            return ""
+        self._pending += chunk
+        cut = self._safe_cut()
+        if cut == 0:
+            return ""
+        ready, self._pending = self._pending[:cut], self._pending[cut:]
+        return self._emit(_format_body(ready), final=False)
+
+    def flush(self) -> str:
+        ready, self._pending = self._pending, ""
+        return self._emit(_format_body(ready), final=True)
@@ -0,0 +1,170 @@
+"""
+Idempotency-Key support: the first request with a key runs, retries get its stored response
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone, timedelta
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.exc import IntegrityError
+from database import SessionLocal
+from models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+# How long a stored response is replayed
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))
+# A claim whose holder died is taken over after this long (longer than the slowest LLM call)
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "150"))
+# Concurrent duplicates wait this long for the first request before getting a 409
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "60"))
+POLL_INTERVAL_SECONDS = 0.2
+MAX_KEY_LENGTH = 255
+PURGE_INTERVAL_SECONDS = 600
+
+_last_purge = 0.0
+
+def _now() -> datetime:
+    # Stored naive, like the other DateTime columns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def request_fingerprint(endpoint: str, payload) -> str:
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{endpoint}\n{body}".encode("utf-8")).hexdigest()
+
+def _purge_expired(db):
+    global _last_purge
+    if time.monotonic() - _last_purge < PURGE_INTERVAL_SECONDS:
+        return
+    _last_purge = time.monotonic()
+    removed = db.query(IdempotencyKey).filter(IdempotencyKey.expires_at < _now()).delete(synchronize_session=False)
+    db.commit()
+    if removed:
+        logger.info(f"Purged {removed} expired idempotency keys")
+
+def _claim(user_id: int, key: str, endpoint: str, fingerprint: str):
+    """
+    Try to become the request that runs for this key. Returns (True, None) when claimed,
+    or (False, record) for an existing record (completed or still running).
+    """
+    db = SessionLocal()
+    try:
+        _purge_expired(db)
+        now = _now()
+        record = IdempotencyKey(
+            user_id=user_id, key=key, endpoint=endpoint, request_hash=fingerprint,
+            created_at=now,
+            locked_until=now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS),
+            expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+        )
+        db.add(record)
+        try:
+            db.commit()
+            return True, None
+        except IntegrityError:
+            db.rollback()
+
+        existing = db.query(IdempotencyKey).filter(
+            IdempotencyKey.user_id == user_id, IdempotencyKey.key == key
+        ).first()
+        if existing is None:
+            return False, None
+        if existing.request_hash != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+
+        # Expired records and abandoned claims are taken over; the conditional update
+        # lets exactly one of several waiting retries win
+        stale = (
+            (existing.response is None and existing.locked_until < now)
+            or existing.expires_at < now
+        )
+        if stale:
+            taken = db.query(IdempotencyKey).filter(
+                IdempotencyKey.user_id == user_id,
+                IdempotencyKey.key == key,
+                IdempotencyKey.locked_until == existing.locked_until,
+            ).update({
+                "status_code": None,
+                "response": None,
+                "created_at": now,
+                "locked_until": record.locked_until,
+                "expires_at": record.expires_at,
+            }, synchronize_session=False)
+            db.commit()
+            if taken:
+                return True, None
+            return False, None
+        return False, {"status_code": existing.status_code, "response": existing.response}
+    finally:
+        db.close()
+
+def _store(user_id: int, key: str, status_code: int, response):
+    db = SessionLocal()
+    try:
+        db.query(IdempotencyKey).filter(
+            IdempotencyKey.user_id == user_id, IdempotencyKey.key == key
+        ).update({"status_code": status_code, "response": response}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def _release(user_id: int, key: str):
+    """Forget a failed attempt so that a retry runs again"""
+    db = SessionLocal()
+    try:
+        db.query(IdempotencyKey).filter(
+            IdempotencyKey.user_id == user_id,
+            IdempotencyKey.key == key,
+            IdempotencyKey.response.is_(None),
+        ).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def _replay(record: dict) -> JSONResponse:
+    return JSONResponse(
+        status_code=record["status_code"],
+        content=record["response"],
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+async def run_idempotent(user_id, key, endpoint: str, payload, handler, status_code: int = 200):
+    """
+    Run `handler()` (a coroutine function) once per (user, key). Retries with the same
+    key and payload get the stored response; concurrent ones wait for the first to finish.
+    `status_code` is the route's success status, replayed along with the body.
+    """
+    if not key:
+        return await handler()
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters")
+
+    user_id = user_id or 0
+    fingerprint = request_fingerprint(endpoint, payload)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        # Off the event loop: on SQLite the insert can wait for the first request's write lock
+        claimed, record = await run_in_threadpool(_claim, user_id, key, endpoint, fingerprint)
+        if claimed:
+            break
+        if record is not None and record["response"] is not None:
+            logger.info(f"Replaying stored response for idempotency key {key!r} on {endpoint}")
+            return _replay(record)
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+        await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+    try:
+        result = await handler()
+    except BaseException:
+        await run_in_threadpool(_release, user_id, key)
+        raise
+    await run_in_threadpool(_store, user_id, key, status_code, jsonable_encoder(result))
+    return result
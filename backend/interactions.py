@@ -0,0 +1,134 @@
+"""
+Drug-interaction checks against a local dataset, indexed once by normalized drug pairs
+"""
+
+import os
+import re
+import json
+import logging
+from functools import lru_cache
+from itertools import combinations
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+INTERACTIONS_DATA_PATH = os.getenv(
+    "INTERACTIONS_DATA_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "drug_interactions.json")
+)
+
+SEVERITY_ORDER = ["minor", "moderate", "major", "contraindicated"]
+
+# Strength, unit and dosage-form words that appear in free-text medication names
+DOSE = re.compile(r"\b\d+(?:\.\d+)?\s*(?:mg|mcg|µg|g|ml|iu|units?|%)?\b")
+FORM_WORDS = {
+    "tablet", "tablets", "tab", "tabs", "capsule", "capsules", "cap", "caps", "pill", "pills",
+    "er", "xr", "sr", "xl", "cr", "ec", "dr", "ir", "mg", "mcg", "oral", "solution", "syrup",
+    "suspension", "drops", "cream", "gel", "injection", "daily", "extended", "release", "hcl",
+    "sodium", "sulfate", "succinate", "tartrate", "besylate",
+}
+NON_WORD = re.compile(r"[^a-z0-9 ]+")
+
+def normalize_name(name: str) -> str:
+    text = re.sub(r"\(.*?\)", " ", (name or "").lower())
+    text = DOSE.sub(" ", NON_WORD.sub(" ", text.replace("'", "")))
+    return " ".join(text.split())
+
+class InteractionIndex:
+    """Alias table plus a dict keyed on sorted (term, term) pairs, where terms are drugs and drug classes"""
+
+    def __init__(self, data: dict):
+        self.aliases = {}
+        self.terms = {}
+        for drug, entry in data["drugs"].items():
+            canonical = normalize_name(drug)
+            self.terms[canonical] = (canonical, *entry.get("classes", ()))
+            for alias in (drug, *entry.get("aliases", ())):
+                self.aliases[normalize_name(alias)] = canonical
+
+        known = {term for terms in self.terms.values() for term in terms}
+        self.pairs = {}
+        for interaction in data["interactions"]:
+            first, second = (normalize_name(term) for term in interaction["drugs"])
+            unknown = {first, second} - known
+            if unknown:
+                logger.warning(f"Interaction dataset refers to unknown drugs or classes: {', '.join(sorted(unknown))}")
+                continue
+            self.pairs[self._key(first, second)] = (interaction["severity"], interaction["description"])
+
+    @staticmethod
+    def _key(first: str, second: str) -> tuple:
+        return (first, second) if first <= second else (second, first)
+
+    def resolve(self, name: str):
+        """Canonical drug for a free-text medication name, or None when it is not in the dataset"""
+        text = normalize_name(name)
+        if text in self.aliases:
+            return self.aliases[text]
+        # Brand plus strength and form ("Advil Liqui-Gels 200mg") or combination names
+        words = [word for word in text.split() if word not in FORM_WORDS]
+        for size in (3, 2, 1):
+            for start in range(len(words) - size + 1):
+                candidate = " ".join(words[start:start + size])
+                if candidate in self.aliases:
+                    return self.aliases[candidate]
+        return None
+
+    def check_pair(self, first: str, second: str):
+        """Most severe (severity, description) between two canonical drugs, or None"""
+        if first == second:
+            return None
+        found = None
+        for term in self.terms[first]:
+            for other in self.terms[second]:
+                hit = self.pairs.get(self._key(term, other))
+                if hit and (found is None or SEVERITY_ORDER.index(hit[0]) > SEVERITY_ORDER.index(found[0])):
+                    found = hit
+        return found
+
+@lru_cache(maxsize=1)
+def get_index() -> InteractionIndex:
+    with open(INTERACTIONS_DATA_PATH, encoding="utf-8") as f:
+        index = InteractionIndex(json.load(f))
+    logger.info(f"Loaded {len(index.aliases)} drug names and {len(index.pairs)} interaction pairs")
+    return index
+
+def _is_active(medication, now) -> bool:
+    end = medication.endDate
+    if end is None:
+        return True
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    return end >= now
+
+def check_regimen(medications, involving=None) -> list:
+    """
+    Interaction warnings between a user's current medications, most severe first.
+    With `involving` (a medication id), only pairs that include that medication.
+    """
+    index = get_index()
+    now = datetime.now(timezone.utc)
+    resolved = []
+    for medication in medications:
+        if _is_active(medication, now):
+            drug = index.resolve(medication.name)
+            if drug is not None:
+                resolved.append((medication, drug))
+
+    warnings = []
+    for (first, first_drug), (second, second_drug) in combinations(resolved, 2):
+        if involving is not None and involving not in (first.id, second.id):
+            continue
+        hit = index.check_pair(first_drug, second_drug)
+        if hit:
+            severity, description = hit
+            warnings.append({
+                "medicationIds": [first.id, second.id],
+                "medications": [first.name, second.name],
+                "severity": severity,
+                "description": description,
+            })
+    warnings.sort(key=lambda warning: SEVERITY_ORDER.index(warning["severity"]), reverse=True)
+    if involving is not None and warnings:
+        logger.info(f"{len(warnings)} interaction warnings for new medication {involving}")
+    return warnings
@@ -0,0 +1,287 @@
+"""
+Persistent background jobs for symptom assessments: a bounded worker pool per process over a shared job table
+"""
+
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from fastapi import HTTPException
+from sqlalchemy import func
+from starlette.concurrency import run_in_threadpool
+from database import SessionLocal
+from models import AssessmentJob
+
+logger = logging.getLogger(__name__)
+
+# Concurrent jobs per process (0 disables the workers, e.g. on API-only processes)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Retries wait JOB_RETRY_BASE_SECONDS, then twice that, and so on
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+# A job running longer than this is assumed lost with its worker and runs again
+JOB_TIMEOUT_SECONDS = int(os.getenv("JOB_TIMEOUT_SECONDS", "300"))
+JOB_RETENTION_HOURS = int(os.getenv("JOB_RETENTION_HOURS", "24"))
+# Idle workers look for jobs submitted through other processes this often
+JOB_POLL_SECONDS = 1.0
+MAINTENANCE_INTERVAL_SECONDS = 30
+METRICS_WINDOW = timedelta(hours=1)
+
+FINISHED = ("succeeded", "failed")
+
+def _now() -> datetime:
+    # Stored naive, like the other DateTime columns
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _is_retryable(error: Exception) -> bool:
+    # Client errors (e.g. 429 over budget) will not succeed on a retry
+    return not (isinstance(error, HTTPException) and error.status_code < 500)
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 1)
+
+def serialize_job(job: AssessmentJob) -> dict:
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "result": job.result,
+        "error": job.error if job.status == "failed" else None,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+class JobRunner:
+    """Runs queued jobs with `handler(payload, user_id)` on JOB_WORKERS asyncio tasks"""
+
+    def __init__(self, handler, workers: int = JOB_WORKERS):
+        self.handler = handler
+        self.workers = workers
+        self._tasks = []
+        self._wakeup = None
+        self._finished = None
+        self.started = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._finished = asyncio.Event()
+        if self.workers <= 0:
+            return
+        prefix = f"{os.getpid()}"
+        self._tasks = [asyncio.create_task(self._work(f"{prefix}-{n}")) for n in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintain()))
+        logger.info(f"Started {self.workers} assessment job workers")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, db, user_id, payload: dict) -> AssessmentJob:
+        now = _now()
+        job = AssessmentJob(user_id=user_id, status="queued", request=payload, created_at=now, next_attempt_at=now)
+        db.add(job)
+        db.commit()
+        db.refresh(job)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    def _claim(self, worker: str):
+        """Atomically move the oldest due queued job to running; returns its id or None"""
+        db = SessionLocal()
+        try:
+            now = _now()
+            candidates = [row.id for row in db.query(AssessmentJob.id).filter(
+                AssessmentJob.status == "queued",
+                AssessmentJob.next_attempt_at <= now
+            ).order_by(AssessmentJob.next_attempt_at).limit(5)]
+            for job_id in candidates:
+                # Another process may have claimed it since the select; only one update matches
+                claimed = db.query(AssessmentJob).filter(
+                    AssessmentJob.id == job_id,
+                    AssessmentJob.status == "queued"
+                ).update({
+                    "status": "running",
+                    "worker": worker,
+                    "started_at": now,
+                    "attempts": AssessmentJob.attempts + 1,
+                }, synchronize_session=False)
+                db.commit()
+                if claimed:
+                    return job_id
+            return None
+        finally:
+            db.close()
+
+    def _load(self, job_id: str):
+        db = SessionLocal()
+        try:
+            return db.query(AssessmentJob).filter(AssessmentJob.id == job_id).first()
+        finally:
+            db.close()
+
+    def _complete(self, job_id: str, worker: str, result=None, error: Exception = None):
+        db = SessionLocal()
+        try:
+            job = db.query(AssessmentJob).filter(
+                AssessmentJob.id == job_id,
+                AssessmentJob.worker == worker,
+                AssessmentJob.status == "running"
+            ).first()
+            if job is None:
+                # Timed out and requeued by maintenance meanwhile; the new run owns it
+                return
+            now = _now()
+            if error is None:
+                job.status = "succeeded"
+                job.result = result
+                job.error = None
+                job.finished_at = now
+                self.succeeded += 1
+            elif _is_retryable(error) and job.attempts < JOB_MAX_ATTEMPTS:
+                job.status = "queued"
+                job.error = str(error)
+                job.next_attempt_at = now + timedelta(seconds=JOB_RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+                self.retried += 1
+                logger.warning(f"Assessment job {job_id} failed (attempt {job.attempts}), retrying: {error}")
+            else:
+                job.status = "failed"
+                job.error = getattr(error, "detail", None) or str(error)
+                job.finished_at = now
+                self.failed += 1
+                logger.error(f"Assessment job {job_id} failed after {job.attempts} attempts: {error}")
+            db.commit()
+        finally:
+            db.close()
+
+    async def _run(self, job_id: str, worker: str):
+        job = await run_in_threadpool(self._load, job_id)
+        if job is None:
+            # Deleted between the claim and the load; there is nothing left to run or record
+            logger.warning(f"Assessment job {job_id} disappeared before it ran")
+            return
+        self.started += 1
+        try:
+            result = await self.handler(job.request, job.user_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await run_in_threadpool(self._complete, job_id, worker, None, e)
+        else:
+            await run_in_threadpool(self._complete, job_id, worker, result)
+        # Wake every long-poller in this process; they re-read their job
+        finished, self._finished = self._finished, asyncio.Event()
+        finished.set()
+
+    async def _work(self, worker: str):
+        while True:
+            try:
+                job_id = await run_in_threadpool(self._claim, worker)
+                if job_id is not None:
+                    await self._run(job_id, worker)
+                    continue
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Assessment job worker {worker} error: {e}")
+                await asyncio.sleep(JOB_POLL_SECONDS)
+
+    def _recover_and_purge(self):
+        db = SessionLocal()
+        try:
+            now = _now()
+            stale = db.query(AssessmentJob).filter(
+                AssessmentJob.status == "running",
+                AssessmentJob.started_at < now - timedelta(seconds=JOB_TIMEOUT_SECONDS)
+            ).all()
+            for job in stale:
+                if job.attempts < JOB_MAX_ATTEMPTS:
+                    job.status, job.next_attempt_at = "queued", now
+                else:
+                    job.status, job.finished_at = "failed", now
+                job.error = "Timed out"
+                logger.warning(f"Assessment job {job.id} timed out on worker {job.worker}")
+            purged = db.query(AssessmentJob).filter(
+                AssessmentJob.status.in_(FINISHED),
+                AssessmentJob.finished_at < now - timedelta(hours=JOB_RETENTION_HOURS)
+            ).delete(synchronize_session=False)
+            db.commit()
+            if purged:
+                logger.info(f"Purged {purged} finished assessment jobs")
+        finally:
+            db.close()
+
+    async def _maintain(self):
+        while True:
+            try:
+                await run_in_threadpool(self._recover_and_purge)
+            except Exception as e:
+                logger.error(f"Assessment job maintenance error: {e}")
+            await asyncio.sleep(MAINTENANCE_INTERVAL_SECONDS)
+
+    async def wait(self, job_id: str, timeout: float):
+        """The job once finished, or as it is after `timeout` seconds (long polling)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            # Take the event before reading, so a completion in between is not missed
+            finished = self._finished
+            job = await run_in_threadpool(self._load, job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job.status in FINISHED or remaining <= 0:
+                return job
+            # Jobs run by other processes are noticed by re-reading every poll interval
+            try:
+                await asyncio.wait_for(finished.wait(), min(remaining, JOB_POLL_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+
+    def metrics(self, db) -> dict:
+        """Queue depth from the shared table, latencies of jobs finished in the last hour"""
+        now = _now()
+        counts = {status: 0 for status in ("queued", "running", "succeeded", "failed")}
+        for status, count in db.query(AssessmentJob.status, func.count(AssessmentJob.id)).group_by(AssessmentJob.status):
+            counts[status] = count
+        recent = db.query(AssessmentJob.next_attempt_at, AssessmentJob.started_at, AssessmentJob.finished_at).filter(
+            AssessmentJob.status == "succeeded",
+            AssessmentJob.finished_at >= now - METRICS_WINDOW
+        ).order_by(AssessmentJob.finished_at.desc()).limit(1000).all()
+        # Measured from the last time the job became due, so retry backoff is not counted as queueing
+        queue_ms = [(row.started_at - row.next_attempt_at).total_seconds() * 1000 for row in recent]
+        run_ms = [(row.finished_at - row.started_at).total_seconds() * 1000 for row in recent]
+        oldest = db.query(AssessmentJob.next_attempt_at).filter(
+            AssessmentJob.status == "queued",
+            AssessmentJob.next_attempt_at <= now
+        ).order_by(AssessmentJob.next_attempt_at).first()
+        return {
+            "queue_depth": counts["queued"],
+            "running": counts["running"],
+            "jobs": counts,
+            "oldest_queued_seconds": round((now - oldest.next_attempt_at).total_seconds(), 1) if oldest else 0,
+            "last_hour": {
+                "succeeded": len(recent),
+                "queue_wait_ms": {"p50": _percentile(queue_ms, 0.5), "p95": _percentile(queue_ms, 0.95)},
+                "run_ms": {"p50": _percentile(run_ms, 0.5), "p95": _percentile(run_ms, 0.95)},
+            },
+            "this_process": {
+                "workers": self.workers,
+                "started": self.started,
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "retried": self.retried,
+            },
+        }
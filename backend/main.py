@@ -1,58 +1,71 @@
-from fastapi import FastAPI, Depends, HTTPException
+import os
+import sys
+
+if __name__ == "__main__":
+    # `python main.py` is `python serve.py`. Hand over before the imports below: they read
+    # the pool sizes serve.py sets, and serve.py imports this file again as `main`.
+    os.execv(sys.executable, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "serve.py")] + sys.argv[1:])
+
+from fastapi import FastAPI, Depends, HTTPException, Query, BackgroundTasks, Header, WebSocket, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, ValidationError
 from typing import Optional, List
-import os
 import json
-from datetime import datetime, timezone
+import time
+import asyncio
+from datetime import datetime, timezone, timedelta
 # Enable database imports
 from sqlalchemy.orm import Session
-from database import get_db, create_tables
+from database import SessionLocal, get_db, get_read_db, mark_user_write, create_tables, engine, replica_engine, use_replica, QueryStatsMiddleware, query_budget
 from models import User, ChatSession, ChatMessage, Medication as MedicationDB
-from auth import get_password_hash, authenticate_user, create_access_token, get_current_user
+from search import search_chat_messages
+from export import iter_export
+from dashboard import medications_with_adherence, recent_sessions, session_summaries
+from memory import load_context, record_turn, refresh_summary
+from formatting import format_response, StreamingFormatter
+from triage import pretriage
+from semantic_cache import semantic_cache
+from interactions import check_regimen
+from idempotency import run_idempotent
+from jobs import JobRunner, serialize_job
+from reminders import reminder_scheduler, schedule_medication
+from shards import get_chat_db, get_chat_read_db, get_user_chat_read_db, chat_sessionmaker, chat_engine, chat_engines, read_any_shard
+from read_path import serialize_medication, medication_rows, chat_message_rows, user_rows, json_response
+from prompts import build_chat_prompt, build_assessment_prompt, prompt_stats
+from usage import LLM_MODEL, LLM_BUDGET_MODEL, DEFAULT_DAILY_TOKEN_BUDGET, usage_from_response, record_usage, budget_route, tokens_used_today, user_usage, agent_usage
+from auth import get_password_hash, authenticate_user, create_access_token, get_current_user, get_current_user_read, get_current_user_detached, get_current_user_optional, require_ops_token, verify_token, user_from_token
+from ws_chat import ChatConnection
+from profiling import PROFILING_ENABLED, ProfilingMiddleware
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import ChatPromptTemplate
 from langgraph.graph import StateGraph, END
 from dotenv import load_dotenv
 import uuid
-from sqlalchemy import JSON
+from sqlalchemy import JSON, Date, DateTime, bindparam, text
 
 
 load_dotenv()
 
-import re
-
-def format_response(text: str) -> str:
-    """
-    Format AI response into clean Markdown with:
-    - Proper headings
-    - Consistent bullet points
-    - Bolded keywords
-    - Separated disclaimers
-    """
-
-    if not text:
-        return ""
-
-    # Ensure bullets use '-' instead of '*'
-    text = re.sub(r"^\s*\*", "-", text, flags=re.MULTILINE)
-
-    # Fix bullets like "- *Thing:*" → keep them consistent
-    text = re.sub(r"-\s*\\(.+?):\\", r"- *\1*:", text)
-
-    # Add line breaks after headings (## or ###)
-    text = re.sub(r"(#+\s[^\n]+)", r"\1\n", text)
-
-    # Add spacing after sentences
-    text = re.sub(r'([.!?])\s+(?=[A-Z])', r'\1\n\n', text)
+app = FastAPI()
 
-    return text.strip()
+# Concurrent LLM calls in this process; serve.py sets it to this worker's share of LLM_CONCURRENCY
+LLM_WORKER_CONCURRENCY = int(os.getenv("LLM_WORKER_CONCURRENCY", "8"))
+llm_semaphore = asyncio.Semaphore(LLM_WORKER_CONCURRENCY)
 
-app = FastAPI()
+async def invoke_llm(func, *args):
+    """Run a blocking LLM call in the threadpool, at most LLM_WORKER_CONCURRENCY at a time"""
+    async with llm_semaphore:
+        return await run_in_threadpool(func, *args)
 
 # Create database tables on startup
 @app.on_event("startup")
 async def startup_event():
+    # serve.py migrates once in the master process before forking workers
+    if os.getenv("RUN_STARTUP_MIGRATIONS", "1") == "0":
+        return
     try:
         from database import migrate_database
         migrate_database()
@@ -79,14 +92,20 @@ app.add_middleware(
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    allow_headers=["Content-Type", "Authorization", "X-Requested-With"],
-    expose_headers=["Content-Length"],
+    allow_headers=["Content-Type", "Authorization", "X-Requested-With", "Idempotency-Key", "X-Profile", "X-Ops-Token"],
+    expose_headers=["Content-Length", "X-DB-Queries", "X-DB-Time"],
 )
+# Per-request query counts and timings: debug headers, N+1 warnings, query budgets
+app.add_middleware(QueryStatsMiddleware)
+# Opt-in request profiling (PROFILE_TOKEN / PROFILE_SAMPLE_RATE); not installed otherwise
+if PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
 
 class ChatRequest(BaseModel):
     message: str
     agent_type: Optional[str] = "general"
     response_style: Optional[str] = "concise"  # Add response style parameter
+    session_id: Optional[str] = None  # Continue an existing conversation
 
 class ChatResponse(BaseModel):
     response: str
@@ -117,6 +136,7 @@ class SymptomAssessmentResponse(BaseModel):
     followUp: str
 
 llm = None
+llm_budget = None  # Cheaper model for users over their daily token budget
 
 # Initialize LLM only if API key is available
 try:
@@ -124,7 +144,8 @@ try:
     print(f"DEBUG: Google API key found: {api_key is not None}")
     if api_key and api_key != "your_google_api_key_here":
         print("DEBUG: Initializing LLM with Google API key")
-        llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash",google_api_key=api_key)
+        llm = ChatGoogleGenerativeAI(model=LLM_MODEL,google_api_key=api_key)
+        llm_budget = ChatGoogleGenerativeAI(model=LLM_BUDGET_MODEL, google_api_key=api_key)
         print("DEBUG: LLM initialized successfully")
     else:
         print("Warning: Google API key not set. AI features will be limited.")
@@ -133,83 +154,50 @@ except Exception as e:
     print(f"Warning: Could not initialize LLM: {e}. AI features will be limited.")
     print(f"DEBUG: LLM initialization error details: {e}")
 
-# Prompt templates for each agent type
-PROMPT_TEMPLATES = {
-    "general": (
-        "You are a helpful general health assistant. "
-        "Response Style: {response_style}\n\n"
-        "If response_style is 'concise': Keep your answer brief and to the point (2-3 sentences max). "
-        "If response_style is 'detailed': Provide comprehensive information with examples and explanations.\n\n"
-        "Always format your response in *Markdown* with:\n"
-        "- Clear headings (## Heading)\n"
-        "- Bullet points (- item)\n"
-        "- Bold keywords (*word*)\n\n"
-        "Answer the following user question:\nUser: {message}"
-    ),
-    "symptom": (
-        "You are a symptom checker AI. "
-        "Response Style: {response_style}\n\n"
-        "If response_style is 'concise': Give brief, direct answers (2-3 sentences max). "
-        "If response_style is 'detailed': Provide comprehensive analysis with multiple sections.\n\n"
-        "Always format your response in *Markdown* with:\n"
-        "- Clear sections (## Symptoms, ## Possible Causes, ## Next Steps)\n"
-        "- Bullet points (- item)\n"
-        "- Bold important terms (*term*)\n\n"
-        "User: {message}"
-    ),
-    "nutrition": (
-        "You are a nutrition expert AI. "
-        "Response Style: {response_style}\n\n"
-        "If response_style is 'concise': Keep advice brief and actionable (2-3 sentences max). "
-        "If response_style is 'detailed': Provide comprehensive guidance with examples and explanations.\n\n"
-        "Always format your response in *Markdown* with:\n"
-        "- Headings for structure (## Diet Tips, ## Foods to Include, ## Foods to Avoid)\n"
-        "- Bullet points for lists\n"
-        "- Bold important nutrients and food names\n\n"
-        "User: {message}"
-    ),
-    "mental-health": (
-        "You are a mental health coach AI. "
-        "Response Style: {response_style}\n\n"
-        "If response_style is 'concise': Give brief, supportive advice (2-3 sentences max). "
-        "If response_style is 'detailed': Provide comprehensive strategies with examples and resources.\n\n"
-        "Always format your response in *Markdown* with:\n"
-        "- Headings for clarity (## Coping Strategies, ## Resources, ## Self-Care)\n"
-        "- Bullet points for advice\n"
-        "- Bold key ideas for emphasis\n\n"
-        "User:{message}"
-    ),
-} 
-
-def get_prompt(agent_type: str, message: str, response_style: str = "concise") -> str:
-    print("DEBUG get_prompt called with agent_type:", agent_type, "message:", message, "response_style:", response_style)
-    template = PROMPT_TEMPLATES.get(agent_type, PROMPT_TEMPLATES["general"])
-    print("DEBUG get_prompt template:", template)
-    print("DEBUG get_prompt message:", message)
-    return template.format(message=message, response_style=response_style)
+def select_llm(model_route: str = "default"):
+    """LLM client and model name for a budget route"""
+    if model_route == "budget" and llm_budget is not None:
+        return llm_budget, LLM_BUDGET_MODEL
+    return llm, LLM_MODEL
+
+# Responses when the LLM is not available
+FALLBACK_RESPONSES = {
+    "general": "I'm currently in maintenance mode. Please try again later or contact support.",
+    "symptom": "Symptom checking is temporarily unavailable. Please consult a healthcare professional for medical advice.",
+    "nutrition": "Nutrition advice is temporarily unavailable. Please consult a registered dietitian for personalized guidance.",
+    "mental-health": "Mental health support is temporarily unavailable. Please contact a mental health professional or crisis hotline if you need immediate help."
+}
 
 def llm_node(state: dict):
     print("DEBUG llm_node state at entry:", state)
     agent_type = state.get("agent_type", "general")
     message = state.get("message", "")
     response_style = state.get("response_style", "concise")
+    context = state.get("context", "")
     
     # Check if LLM is available
     if llm is None:
         # Provide fallback response when LLM is not available
-        fallback_responses = {
-            "general": "I'm currently in maintenance mode. Please try again later or contact support.",
-            "symptom": "Symptom checking is temporarily unavailable. Please consult a healthcare professional for medical advice.",
-            "nutrition": "Nutrition advice is temporarily unavailable. Please consult a registered dietitian for personalized guidance.",
-            "mental-health": "Mental health support is temporarily unavailable. Please contact a mental health professional or crisis hotline if you need immediate help."
-        }
-        state["response"] = fallback_responses.get(agent_type, fallback_responses["general"])
+        state["response"] = FALLBACK_RESPONSES.get(agent_type, FALLBACK_RESPONSES["general"])
         return state
     
-    prompt = get_prompt(agent_type, message, response_style)
-    print("DEBUG llm_node prompt:", prompt)
+    # Standalone questions can reuse the answer to a near-identical earlier question;
+    # with conversation context the answer depends on more than the message
+    cacheable = not context
+    if cacheable:
+        cached = semantic_cache.get(agent_type, response_style, message)
+        if cached is not None:
+            state["response"] = cached
+            state["cache"] = "semantic"
+            return state
+
+    prompt = build_chat_prompt(agent_type, message, response_style, context)
+    print("DEBUG llm_node prompt:", prompt.template, "truncated:", prompt.truncated)
+    model_client, model_name = select_llm(state.get("model_route", "default"))
     try:
-        response = llm.invoke(prompt)
+        started = time.perf_counter()
+        response = model_client.invoke(prompt.messages)
+        state["usage"] = usage_from_response(response, model_name, (time.perf_counter() - started) * 1000, prompt.text)
         print("DEBUG llm_node raw response:", response)
         # Try to extract the content robustly
         if hasattr(response, "content") and response.content:
@@ -221,6 +209,8 @@ def llm_node(state: dict):
         else:
             state["response"] = str(response)
         print("DEBUG llm_node extracted response:", state["response"])
+        if cacheable and state["response"]:
+            semantic_cache.put(agent_type, response_style, message, state["response"])
     except Exception as e:
         print("ERROR in llm_node:", e)
         state["response"] = f"Internal error in llm_node: {str(e)}"
@@ -242,6 +232,18 @@ class MedicationResponse(BaseModel):
     endDate: Optional[datetime] = None
     totalDoses: Optional[int] = None
     instructions: Optional[str] = None
+    schedule: Optional[dict] = None
+    nextDueAt: Optional[datetime] = None
+
+class InteractionWarning(BaseModel):
+    medicationIds: List[str]
+    medications: List[str]
+    severity: str
+    description: str
+
+class MedicationListResponse(BaseModel):
+    medications: List[MedicationResponse]
+    interactions: List[InteractionWarning]
 
 class MedicationCreate(BaseModel):
     name: str
@@ -260,6 +262,37 @@ class UserProfileResponse(BaseModel):
     full_name: Optional[str] = None
     date_of_birth: Optional[str] = None
 
+class UserSummary(BaseModel):
+    id: int
+    username: str
+    email: str
+
+class UserListResponse(BaseModel):
+    users: List[UserSummary]
+
+class ChatSessionSummary(BaseModel):
+    id: int
+    session_id: str
+    agent_type: Optional[str] = None
+    created_at: Optional[datetime] = None
+    message_count: int
+    last_message_at: Optional[datetime] = None
+    last_message_type: Optional[str] = None
+    preview: Optional[str] = None
+
+class ChatHistoryResponse(BaseModel):
+    sessions: List[ChatSessionSummary]
+
+class ChatMessageItem(BaseModel):
+    id: int
+    message_type: str
+    content: str
+    message_metadata: Optional[dict] = None
+    created_at: Optional[datetime] = None
+
+class ChatMessagesResponse(BaseModel):
+    messages: List[ChatMessageItem]
+
 class DoseTakenRequest(BaseModel):
     medicationId: str
     date: str  # ISO date string (YYYY-MM-DD)
@@ -365,6 +398,7 @@ async def update_profile(
         db.add(current_user)
         db.commit()
         db.refresh(current_user)
+        mark_user_write(current_user.id)
     return {
         "id": current_user.id,
         "username": current_user.username,
@@ -417,14 +451,14 @@ async def create_user(username: str, email: str, db: Session = Depends(get_db)):
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error creating user: {str(e)}")
 
-@app.get("/api/users")
-async def get_users(db: Session = Depends(get_db)):
+@app.get("/api/users", response_model=UserListResponse)
+async def get_users(db: Session = Depends(get_read_db)):
     """Get all users for testing"""
-    users = db.query(User).all()
-    return {"users": [{"id": u.id, "username": u.username, "email": u.email} for u in users]}
+    return json_response({"users": [row._asdict() for row in user_rows(db)]})
 
 @app.get("/api/profile")
-def get_profile(current_user: User = Depends(get_current_user)):
+@query_budget(1)
+def get_profile(current_user: User = Depends(get_current_user_read)):
     return {
         "user_id": current_user.id,
         "email": current_user.email,
@@ -436,100 +470,263 @@ def get_profile(current_user: User = Depends(get_current_user)):
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat_endpoint(
     request: ChatRequest, 
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    chat_db: Session = Depends(get_chat_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    print("DEBUG /api/chat received:", request)
-    try:
-        # Use authenticated user
-        user_id = current_user.id
-        session_id = f"session_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}"
+    # Retries with the same Idempotency-Key get the first response instead of a second LLM call
+    return await run_idempotent(current_user.id, idempotency_key, "chat", request,
+                                lambda: handle_chat(request, background_tasks, current_user, db, chat_db))
+
+def new_session_id() -> str:
+    # The random suffix keeps ids unique when several chats start within the same second
+    return f"session_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
 
+def begin_chat_turn(db: Session, chat_db: Session, request: ChatRequest, current_user: User):
+    """
+    Resolve or create the chat session and add the user's message (flushed, not committed).
+    chat_db holds the user's chats; it is `db` itself unless chat storage is sharded.
+    Returns (chat_session, context, model_route); raises 404/429 HTTPExceptions.
+    """
+    # Continue an existing conversation when the client sends its session id
+    chat_session = None
+    if request.session_id:
+        chat_session = chat_db.query(ChatSession).filter(
+            ChatSession.session_id == request.session_id,
+            ChatSession.user_id == current_user.id
+        ).first()
+        if chat_session is None:
+            raise HTTPException(status_code=404, detail="Chat session not found")
+
+    model_route = budget_route(db, current_user)
+    if model_route == "refuse":
+        raise HTTPException(status_code=429, detail="Daily AI usage limit reached, please try again tomorrow")
+
+    context = ""
+    if chat_session is not None:
+        context = load_context(chat_db, chat_session)
+    else:
         # Create chat session
         chat_session = ChatSession(
-            user_id=user_id,
-            session_id=session_id,
+            user_id=current_user.id,
+            session_id=new_session_id(),
             agent_type=request.agent_type
         )
-        db.add(chat_session)
-        db.flush()  # Get the ID without committing yet
-
-        # Store user message
-        user_message = ChatMessage(
-            session_id=chat_session.id,  # Use the actual session ID
-            message_type="user",
-            content=request.message,
-            message_metadata={"agent_type": request.agent_type}
-        )
-        db.add(user_message)
+        chat_db.add(chat_session)
+        chat_db.flush()  # Get the ID without committing yet
+
+    # Store user message
+    user_message = ChatMessage(
+        session_id=chat_session.id,  # Use the actual session ID
+        message_type="user",
+        content=request.message,
+        message_metadata={"agent_type": request.agent_type}
+    )
+    chat_db.add(user_message)
+    return chat_session, context, model_route
+
+def complete_chat_turn(db: Session, chat_db: Session, chat_session: ChatSession, request: ChatRequest, user_id: int,
+                       response_text: str, usage: Optional[dict], cache: Optional[str]) -> bool:
+    """Store the AI response and usage and commit the turn; returns True when the summary is due"""
+    ai_message = ChatMessage(
+        session_id=chat_session.id,  # Use the actual session ID
+        message_type="assistant",
+        content=response_text,
+        message_metadata={"agent_type": request.agent_type, **(usage or {}), **({"cache": cache} if cache else {})}
+    )
+    chat_db.add(ai_message)
+    if usage:
+        record_usage(db, user_id, request.agent_type, usage)
+    summary_due = record_turn(chat_db, chat_session)
+
+    # Commit everything to database (the chat shard first: usage without its turn is harmless)
+    chat_db.commit()
+    if db is not chat_db:
+        db.commit()
+    mark_user_write(user_id)
+    return summary_due
+
+async def handle_chat(request: ChatRequest, background_tasks: BackgroundTasks, current_user: User, db: Session, chat_db: Session):
+    print("DEBUG /api/chat received:", request)
+    try:
+        chat_session, context, model_route = begin_chat_turn(db, chat_db, request, current_user)
+    except HTTPException:
+        chat_db.rollback()
+        db.rollback()
+        raise
+
+    try:
+        session_id = chat_session.session_id
 
         # Generate AI response
-        state = {"agent_type": request.agent_type, "message": request.message, "response_style": request.response_style}
+        state = {"agent_type": request.agent_type, "message": request.message, "response_style": request.response_style, "context": context, "model_route": model_route}
         try:
-            result = chat_workflow.invoke(state)
+            result = await invoke_llm(chat_workflow.invoke, state)
+            usage = result.get("usage") if isinstance(result, dict) else None
             if not result or not isinstance(result, dict):
                 response_text = "Sorry, I couldn't generate a response (workflow returned nothing)."
             else:
                 raw_response = result.get("response", "Sorry, I couldn't generate a response.")
                 response_text = format_response(raw_response)
 
-            # Store AI response
-            ai_message = ChatMessage(
-                session_id=chat_session.id,  # Use the actual session ID
-                message_type="assistant",
-                content=response_text,
-                message_metadata={"agent_type": request.agent_type}
-            )
-            db.add(ai_message)
-
-            # Commit everything to database
-            db.commit()
+            cache = result.get("cache") if isinstance(result, dict) else None
+            summary_due = complete_chat_turn(db, chat_db, chat_session, request, current_user.id, response_text, usage, cache)
+            if summary_due:
+                background_tasks.add_task(refresh_summary, SessionLocal, chat_session.id, select_llm, chat_sessionmaker(current_user.id))
 
             print(f"DEBUG: Chat session {session_id} created, messages stored")
             return ChatResponse(response=response_text, session_id=session_id)
 
         except Exception as e:
+            chat_db.rollback()
             db.rollback()
             print("ERROR in AI response generation:", e)
             raise HTTPException(status_code=500, detail=f"AI response error: {str(e)}")
 
     except Exception as e:
+        chat_db.rollback()
         db.rollback()
         print("ERROR in /api/chat:", e)
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-@app.get("/api/medications")
+def stream_chat_response(agent_type: str, message: str, response_style: str, context: str, model_route: str, emit):
+    """
+    Blocking streamed counterpart of llm_node: passes raw text deltas to emit() as the
+    model produces them. Returns (raw_response, usage, cache).
+    """
+    cacheable = not context
+    if cacheable:
+        cached = semantic_cache.get(agent_type, response_style, message)
+        if cached is not None:
+            emit(cached)
+            return cached, None, "semantic"
+    if llm is None:
+        fallback = FALLBACK_RESPONSES.get(agent_type, FALLBACK_RESPONSES["general"])
+        emit(fallback)
+        return fallback, None, None
+
+    prompt = build_chat_prompt(agent_type, message, response_style, context)
+    model_client, model_name = select_llm(model_route)
+    started = time.perf_counter()
+    aggregate = None
+    parts = []
+    for chunk in model_client.stream(prompt.messages):
+        # Chunks add up to one message carrying the usage metadata
+        aggregate = chunk if aggregate is None else aggregate + chunk
+        delta = chunk.content if isinstance(chunk.content, str) else ""
+        if delta:
+            parts.append(delta)
+            emit(delta)
+    raw_response = "".join(parts)
+    usage = usage_from_response(aggregate if aggregate is not None else raw_response, model_name,
+                                (time.perf_counter() - started) * 1000, prompt.text)
+    if cacheable and raw_response:
+        semantic_cache.put(agent_type, response_style, message, raw_response)
+    return raw_response, usage, None
+
+def authenticate_websocket(token: str):
+    """(user, token expiry) for a WebSocket token; the user is detached and only read afterwards"""
+    payload = verify_token(token)
+    db = SessionLocal()
+    try:
+        user = user_from_token(token, db)
+        db.expunge(user)
+        return user, payload.get("exp")
+    finally:
+        db.close()
+
+async def run_websocket_turn(current_user: User, frame: dict, connection: ChatConnection):
+    """One chat frame: start, delta... and done (or error) frames tagged with the frame's id"""
+    turn_id = frame.get("id")
+    try:
+        request = ChatRequest(**{key: frame[key] for key in ("message", "agent_type", "response_style", "session_id") if key in frame})
+    except ValidationError as e:
+        await connection.send({"type": "error", "id": turn_id, "status": 422, "detail": jsonable_encoder(e.errors())})
+        return
+
+    lock = connection.conversation_lock(request.session_id) if request.session_id else asyncio.Lock()
+    async with lock:
+        db = SessionLocal()
+        chat_factory = chat_sessionmaker(current_user.id)
+        chat_db = db if chat_factory is SessionLocal else chat_factory()
+        try:
+            try:
+                chat_session, context, model_route = await run_in_threadpool(begin_chat_turn, db, chat_db, request, current_user)
+            except HTTPException as e:
+                chat_db.rollback()
+                db.rollback()
+                await connection.send({"type": "error", "id": turn_id, "status": e.status_code, "detail": e.detail})
+                return
+            session_id = chat_session.session_id
+            await connection.send({"type": "start", "id": turn_id, "session_id": session_id})
+
+            # Deltas are formatted as they arrive; their concatenation equals the stored response
+            formatter = StreamingFormatter()
+            formatted = []
+            def emit(raw_delta: str):
+                text = formatter.feed(raw_delta)
+                if text:
+                    formatted.append(text)
+                    connection.send_threadsafe({"type": "delta", "id": turn_id, "session_id": session_id, "text": text})
+
+            raw_response, usage, cache = await invoke_llm(stream_chat_response, request.agent_type, request.message,
+                                                          request.response_style, context, model_route, emit)
+            tail = formatter.flush()
+            if tail:
+                formatted.append(tail)
+                await connection.send({"type": "delta", "id": turn_id, "session_id": session_id, "text": tail})
+            response_text = "".join(formatted) or "Sorry, I couldn't generate a response."
+
+            summary_due = await run_in_threadpool(complete_chat_turn, db, chat_db, chat_session, request, current_user.id,
+                                                  response_text, usage, cache)
+            await connection.send({"type": "done", "id": turn_id, "session_id": session_id, "response": response_text})
+            if summary_due:
+                asyncio.get_running_loop().run_in_executor(None, refresh_summary, SessionLocal, chat_session.id, select_llm, chat_factory)
+        except BaseException:
+            chat_db.rollback()
+            db.rollback()
+            raise
+        finally:
+            if chat_db is not db:
+                chat_db.close()
+            db.close()
+
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    # Authenticated once per connection (token query parameter or first "auth" frame)
+    await ChatConnection(websocket, authenticate_websocket, run_websocket_turn).serve()
+
+@app.get("/api/medications", response_model=MedicationListResponse)
+@query_budget(2)
 async def get_medications(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
 ):
     """Get all medications for the authenticated user"""
-    medications = db.query(MedicationDB).filter(MedicationDB.user_id == current_user.id).all()
-    
-    # Convert database objects to response format
-    meds_response = []
-    for med in medications:
-        meds_response.append({
-            "id": med.id,
-            "name": med.name,
-            "dosage": med.dosage,
-            "frequency": med.frequency,
-            "prescribedBy": med.prescribedBy,
-            "startDate": med.startDate,
-            "endDate": med.endDate,
-            "totalDoses": med.totalDoses,
-            "instructions": med.instructions
-        })
+    # Plain rows of the listed columns; no ORM objects are built for a read-only list
+    medications = medication_rows(db, current_user.id)
     
-    return {"medications": meds_response}
+    # Checked against the local interaction index on every read; the dataset is loaded once per
+    # process, so an updated file takes effect after a restart
+    return json_response({
+        "medications": [serialize_medication(med) for med in medications],
+        "interactions": check_regimen(medications)
+    })
 
 @app.post("/api/medications")
 async def create_medication(
     medication: MedicationCreate, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
     """Create a new medication for the authenticated user"""
+    return await run_idempotent(current_user.id, idempotency_key, "medications", medication,
+                                lambda: handle_create_medication(medication, current_user, db))
+
+async def handle_create_medication(medication: MedicationCreate, current_user: User, db: Session):
     # Generate UUID for medication ID
     new_id = str(uuid.uuid4())
     
@@ -546,25 +743,22 @@ async def create_medication(
         totalDoses=medication.totalDoses,
         instructions=medication.instructions
     )
+    schedule_medication(new_medication)
     
     db.add(new_medication)
     db.commit()
     db.refresh(new_medication)
+    mark_user_write(current_user.id)
+    reminder_scheduler.schedule(new_medication.id, new_medication.next_due_at)
+
+    regimen = db.query(MedicationDB).filter(MedicationDB.user_id == current_user.id).all()
+    interactions = check_regimen(regimen, involving=new_medication.id)
     
     # Return the created medication in response format
     return {
         "success": True, 
-        "medication": {
-            "id": new_medication.id,
-            "name": new_medication.name,
-            "dosage": new_medication.dosage,
-            "frequency": new_medication.frequency,
-            "prescribedBy": new_medication.prescribedBy,
-            "startDate": new_medication.startDate,
-            "endDate": new_medication.endDate,
-            "totalDoses": new_medication.totalDoses,
-            "instructions": new_medication.instructions
-        }
+        "medication": serialize_medication(new_medication),
+        "interactions": interactions
     }
 
 @app.delete("/api/medications/{medication_id}")
@@ -583,22 +777,151 @@ async def delete_medication(
     if medication_to_delete:
         db.delete(medication_to_delete)
         db.commit()
+        mark_user_write(current_user.id)
         return {"success": True, "message": "Medication deleted successfully"}
     else:
         raise HTTPException(status_code=404, detail="Medication not found")
 
+UPSERT_DOSE_EVENT_SQL = text("""
+    INSERT INTO dose_events (medication_id, user_id, date, count, updated_at)
+    VALUES (:medication_id, :user_id, :date, :count, :updated_at)
+    ON CONFLICT (medication_id, date) DO UPDATE SET
+        count = excluded.count,
+        updated_at = excluded.updated_at
+""").bindparams(bindparam("date", type_=Date), bindparam("updated_at", type_=DateTime))
+
+@app.post("/api/medications/doses")
+async def record_doses_taken(
+    request: DoseTakenRequest,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Set how many doses of a medication were taken on a given day"""
+    try:
+        dose_date = datetime.strptime(request.date, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
+    if request.count < 0:
+        raise HTTPException(status_code=400, detail="Dose count cannot be negative")
+
+    medication = db.query(MedicationDB).filter(
+        MedicationDB.id == request.medicationId,
+        MedicationDB.user_id == current_user.id
+    ).first()
+    if medication is None:
+        raise HTTPException(status_code=404, detail="Medication not found")
+
+    # One statement, so two submissions for the same day cannot both insert
+    db.execute(UPSERT_DOSE_EVENT_SQL, {
+        "medication_id": medication.id,
+        "user_id": current_user.id,
+        "date": dose_date,
+        "count": request.count,
+        "updated_at": datetime.now(timezone.utc),
+    })
+    db.commit()
+    mark_user_write(current_user.id)
+    return {"success": True, "medicationId": medication.id, "date": request.date, "count": request.count}
+
+@app.get("/api/dashboard")
+@query_budget(3)
+async def get_dashboard(
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db),
+    chat_db: Session = Depends(get_chat_read_db)
+):
+    """Profile, medications with adherence, interaction warnings and recent chats in one response"""
+    rows = medications_with_adherence(db, current_user.id)
+    medications = []
+    for med, taken, taken_today, last_taken in rows:
+        medications.append({
+            **serialize_medication(med),
+            "adherence": {
+                "taken": int(taken or 0),
+                "takenToday": int(taken_today or 0),
+                "lastTaken": last_taken.isoformat() if last_taken else None,
+                "remaining": max(med.totalDoses - int(taken or 0), 0) if med.totalDoses else None,
+            }
+        })
+    return {
+        "profile": get_profile(current_user),
+        "medications": medications,
+        "interactions": check_regimen([row[0] for row in rows]),
+        "recent_sessions": recent_sessions(chat_db, current_user.id),
+    }
+
 # Add new endpoints for chat history
-@app.get("/api/chat-history/{user_id}")
-async def get_chat_history(user_id: int, db: Session = Depends(get_db)):
-    """Get chat history for a user"""
-    sessions = db.query(ChatSession).filter(ChatSession.user_id == user_id).all()
-    return {"sessions": [{"id": s.id, "session_id": s.session_id, "agent_type": s.agent_type, "created_at": s.created_at} for s in sessions]}
-
-@app.get("/api/chat-messages/{session_id}")
-async def get_chat_messages(session_id: str, db: Session = Depends(get_db)):
-    """Get messages for a specific chat session"""
-    messages = db.query(ChatMessage).filter(ChatMessage.session_id == session_id).all()
-    return {"messages": [{"id": m.id, "message_type": m.message_type, "content": m.content, "message_metadata": m.message_metadata, "created_at": m.created_at} for m in messages]}
+@app.get("/api/chat-history/{user_id}", response_model=ChatHistoryResponse)
+@query_budget(1)
+async def get_chat_history(user_id: int, chat_db: Session = Depends(get_user_chat_read_db)):
+    """Get chat history for a user, with message counts and a preview of each session's last message"""
+    return json_response({"sessions": session_summaries(chat_db, user_id)})
+
+@app.get("/api/chat-messages/{session_id}", response_model=ChatMessagesResponse)
+@query_budget(len(chat_engines()))
+async def get_chat_messages(session_id: str, db: Session = Depends(get_read_db)):
+    """Get messages for a specific chat session (by its numeric id or its session_id string)"""
+    if session_id.isdigit() and len(chat_engines()) > 1:
+        # Numeric ids repeat across shards, so one would name a session of some other user
+        raise HTTPException(status_code=400, detail="Use the session_id string when chat storage is sharded")
+    # Without an owning user, a sharded lookup tries the shards in turn: one query per shard at worst
+    rows = read_any_shard(db, lambda chat_db: chat_message_rows(chat_db, session_id))
+    return json_response({"messages": [row._asdict() for row in rows]})
+
+@app.get("/api/chat-search")
+async def search_chat_history(
+    q: str = Query(..., min_length=2, max_length=200),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=50),
+    current_user: User = Depends(get_current_user_read),
+    chat_db: Session = Depends(get_chat_read_db)
+):
+    """Full-text search over the authenticated user's chat messages"""
+    try:
+        return search_chat_messages(chat_db, current_user.id, q, page, page_size)
+    except Exception as e:
+        print("ERROR in /api/chat-search:", e)
+        raise HTTPException(status_code=500, detail=f"Error searching chat history: {str(e)}")
+
+@app.get("/api/export")
+async def export_history(
+    compress: bool = Query(False, description="gzip-compress the NDJSON stream"),
+    current_user: User = Depends(get_current_user_detached)
+):
+    """Stream all of the authenticated user's sessions, messages and medications as NDJSON"""
+    # No session is held while streaming (the user is resolved and released up front); the
+    # stream reads over its own connection, from the replica when it is healthy and the
+    # user has not just written (read-your-writes, as in get_read_db).
+    source = replica_engine if use_replica(current_user.id) else engine
+    filename = f"healthmate_export_{current_user.id}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.ndjson"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}{".gz" if compress else ""}"'}
+    media_type = "application/gzip" if compress else "application/x-ndjson"
+    return StreamingResponse(iter_export(source, current_user.id, compress, chat_engine(current_user.id, source)),
+                             media_type=media_type, headers=headers)
+
+@app.get("/api/usage")
+async def get_usage(
+    days: int = Query(7, ge=1, le=90),
+    current_user: User = Depends(get_current_user_read),
+    db: Session = Depends(get_read_db)
+):
+    """Daily LLM usage of the authenticated user, per agent"""
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).date()
+    budget = current_user.daily_token_budget if current_user.daily_token_budget is not None else DEFAULT_DAILY_TOKEN_BUDGET
+    return {
+        "tokens_today": tokens_used_today(db, current_user.id),
+        "daily_token_budget": budget or None,
+        "usage": user_usage(db, current_user.id, since),
+    }
+
+@app.get("/api/usage/agents", dependencies=[Depends(require_ops_token)])
+async def get_agent_usage(
+    days: int = Query(7, ge=1, le=90),
+    db: Session = Depends(get_read_db)
+):
+    """Daily LLM usage per agent across all users (operators only, see OPS_TOKEN)"""
+    since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).date()
+    return {"usage": agent_usage(db, since), "semantic_cache": semantic_cache.stats(), "prompts": prompt_stats.report()}
 
 class Symptom(BaseModel):
     name: str
@@ -619,7 +942,26 @@ class SymptomAssessmentResponse(BaseModel):
     followUp: str
 
 @app.post("/api/assess-symptoms", response_model=SymptomAssessmentResponse)
-async def assess_symptoms(request: SymptomRequest):
+async def assess_symptoms(
+    request: SymptomRequest,
+    current_user: Optional[User] = Depends(get_current_user_optional),
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    # Anonymous keys share user id 0; a replay also needs the identical symptom list
+    return await run_idempotent(current_user.id if current_user else None, idempotency_key, "assess-symptoms", request,
+                                lambda: handle_assess_symptoms(request, current_user, db))
+
+async def handle_assess_symptoms(request: SymptomRequest, current_user: Optional[User], db: Session):
+    # Textbook, non-severe symptom sets are answered locally; red flags always go to the LLM
+    local_assessment = pretriage(request.symptoms)
+    if local_assessment is not None:
+        return SymptomAssessmentResponse(**local_assessment)
+
+    model_route = budget_route(db, current_user)
+    if model_route == "refuse":
+        raise HTTPException(status_code=429, detail="Daily AI usage limit reached, please try again tomorrow")
+
     try:
         # Prepare structured symptom text
         formatted_symptoms = [
@@ -628,39 +970,8 @@ async def assess_symptoms(request: SymptomRequest):
         ]
         symptom_text = "; ".join(formatted_symptoms)
 
-        # Prompt for the LLM to return structured JSON
-        prompt = f"""
-        Analyze these symptoms: {symptom_text}
-        
-        Return a structured JSON response with these exact fields:
-        - riskLevel: string (low, moderate, high, urgent)
-        - conditions: list of objects with name, probability, description, urgent (boolean)
-        - immediateActions: list of strings
-        - precautions: list of strings  
-        - medications: list of strings
-        - lifestyleChanges: list of strings
-        - whenToSeekHelp: list of strings
-        - followUp: string
-        
-        Make it valid JSON that can be parsed. Example format:
-        {{
-          "riskLevel": "moderate",
-          "conditions": [
-            {{
-              "name": "Common Cold",
-              "probability": 65,
-              "description": "Viral infection affecting upper respiratory tract",
-              "urgent": false
-            }}
-          ],
-          "immediateActions": ["Rest and hydrate", "Monitor temperature"],
-          "precautions": ["Avoid close contact with others", "Practice good hygiene"],
-          "medications": ["Acetaminophen for fever", "Ibuprofen for pain"],
-          "lifestyleChanges": ["Get adequate sleep", "Eat nutritious foods"],
-          "whenToSeekHelp": ["Fever above 103°F", "Difficulty breathing"],
-          "followUp": "Consult doctor if symptoms persist beyond 7 days"
-        }}
-        """
+        # Schema instructions are the static system prompt; only the symptoms vary
+        prompt = build_assessment_prompt(symptom_text)
 
         if llm is None:
             # Return structured fallback response
@@ -675,17 +986,26 @@ async def assess_symptoms(request: SymptomRequest):
                 followUp="Please see a doctor for medical advice"
             )
             
-        response = llm.invoke(prompt)
+        model_client, model_name = select_llm(model_route)
+        started = time.perf_counter()
+        response = await invoke_llm(model_client.invoke, prompt.messages)
+        usage = usage_from_response(response, model_name, (time.perf_counter() - started) * 1000, prompt.text)
+        try:
+            record_usage(db, current_user.id if current_user else None, "symptom-assessment", usage)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error recording symptom assessment usage: {e}")
         
         # Parse the LLM response as JSON
         try:
             # Extract JSON from the response (Gemini might wrap it in markdown)
             content = response.content
             # Remove markdown code blocks if present
-            if 'json' in content:
-                content = content.split('json')[1].split('')[0].strip()
-            elif '' in content:
-                content = content.split('')[1].split('')[0].strip()
+            if '```json' in content:
+                content = content.split('```json')[1].split('```')[0].strip()
+            elif '```' in content:
+                content = content.split('```')[1].split('```')[0].strip()
                 
             analysis_data = json.loads(content)
             return SymptomAssessmentResponse(**analysis_data)
@@ -714,6 +1034,110 @@ async def assess_symptoms(request: SymptomRequest):
         print(f"Error in symptom assessment: {e}")
         raise HTTPException(status_code=500, detail=f"Error analyzing symptoms: {str(e)}")
 
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+async def run_assessment_job(payload: dict, user_id: Optional[int]):
+    """Job handler: the same assessment as POST /api/assess-symptoms, with its own DB session"""
+    db = SessionLocal()
+    try:
+        user = db.query(User).filter(User.id == user_id).first() if user_id else None
+        result = await handle_assess_symptoms(SymptomRequest(**payload), user, db)
+        return jsonable_encoder(result)
+    finally:
+        db.close()
+
+assessment_jobs = JobRunner(run_assessment_job)
+
+@app.on_event("startup")
+async def start_assessment_workers():
+    await assessment_jobs.start()
+
+@app.on_event("shutdown")
+async def stop_assessment_workers():
+    await assessment_jobs.stop()
+
+@app.post("/api/assess-symptoms/jobs", status_code=202)
+async def submit_assessment_job(
+    request: SymptomRequest,
+    current_user: Optional[User] = Depends(get_current_user_optional),
+    db: Session = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
+):
+    """Queue a symptom assessment and return its job id immediately"""
+    async def submit():
+        job = assessment_jobs.submit(db, current_user.id if current_user else None, jsonable_encoder(request))
+        return {"job_id": job.id, "status": job.status, "poll_url": f"/api/assess-symptoms/jobs/{job.id}"}
+    return await run_idempotent(current_user.id if current_user else None, idempotency_key, "assess-symptoms-jobs", request,
+                                submit, status_code=202)
+
+@app.get("/api/assess-symptoms/jobs/metrics", dependencies=[Depends(require_ops_token)])
+async def get_assessment_job_metrics(db: Session = Depends(get_read_db)):
+    """Queue depth and latency of assessment jobs across all users (operators only, see OPS_TOKEN)"""
+    return assessment_jobs.metrics(db)
+
+@app.get("/api/assess-symptoms/jobs/{job_id}")
+async def get_assessment_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=30, description="seconds to wait for the job to finish (long polling)"),
+    current_user: Optional[User] = Depends(get_current_user_optional)
+):
+    """Status of an assessment job, with the SymptomAssessmentResponse once it succeeded"""
+    job = await assessment_jobs.wait(job_id, wait)
+    # Jobs submitted with a token are only visible to that user
+    if job is None or (job.user_id is not None and (current_user is None or current_user.id != job.user_id)):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return serialize_job(job)
+
+@app.on_event("startup")
+async def start_reminder_scheduler():
+    await reminder_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_reminder_scheduler():
+    await reminder_scheduler.stop()
+
+@app.on_event("startup")
+async def start_partition_maintenance():
+    # Upcoming chat_messages partitions are created in-process, not by cron
+    from partitions import start_maintenance
+    await start_maintenance()
+
+@app.on_event("shutdown")
+async def stop_partition_maintenance():
+    from partitions import stop_maintenance
+    await stop_maintenance()
+
+@app.get("/api/reminders")
+async def get_reminders(
+    after: int = Query(0, ge=0, description="id of the last reminder already received"),
+    wait: float = Query(0, ge=0, le=30, description="seconds to wait for a reminder (long polling)"),
+    current_user: User = Depends(get_current_user_detached)
+):
+    """Due medication reminders of the user after the cursor `after`"""
+    # No pooled connection is held while the poll waits
+    reminders = await reminder_scheduler.wait(current_user.id, after, wait)
+    return {"reminders": reminders, "cursor": reminders[-1]["id"] if reminders else after}
+
+@app.get("/api/reminders/stream")
+async def stream_reminders(
+    request: Request,
+    after: int = Query(0, ge=0, description="id of the last reminder already received"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID"),
+    current_user: User = Depends(get_current_user_detached)
+):
+    """Due medication reminders as server-sent events; reconnecting clients resume from Last-Event-ID"""
+    cursor = int(last_event_id) if last_event_id and last_event_id.isdigit() else after
+    user_id = current_user.id
+
+    async def events():
+        nonlocal cursor
+        while not await request.is_disconnected():
+            reminders = await reminder_scheduler.wait(user_id, cursor, 15)
+            if not reminders:
+                # Comment line, keeps proxies from closing the idle connection
+                yield ": keepalive\n\n"
+                continue
+            for reminder in reminders:
+                cursor = reminder["id"]
+                yield f"id: {cursor}\nevent: reminder\ndata: {json.dumps(jsonable_encoder(reminder))}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,149 @@
+"""
+Bounded conversation memory: the last N turns verbatim plus a rolling summary of older turns
+"""
+
+import os
+import time
+import logging
+from sqlalchemy.orm import Session
+from models import User, ChatSession, ChatMessage
+from partitions import session_messages_bound
+from usage import budget_route, usage_from_response, record_usage
+
+logger = logging.getLogger(__name__)
+
+# Turns (user message + assistant reply) always sent verbatim
+CONTEXT_TURNS = int(os.getenv("CONTEXT_TURNS", "6"))
+# The summary absorbs turns that left the window once this many have accumulated
+SUMMARY_EVERY_TURNS = int(os.getenv("SUMMARY_EVERY_TURNS", "4"))
+# Caps that keep each prompt at a predictable size
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "1500"))
+TURN_MAX_CHARS = int(os.getenv("TURN_MAX_CHARS", "1200"))
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and a health assistant.\n"
+    "Update the summary with the new turns below. Keep the user's symptoms, conditions, medications, "
+    "preferences and any advice already given. Write plain sentences, at most {max_words} words.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New turns:\n{turns}\n\n"
+    "Updated summary:"
+)
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+def _format_turns(turns) -> str:
+    lines = []
+    for user_text, assistant_text in turns:
+        lines.append(f"User: {_clip(user_text, TURN_MAX_CHARS)}")
+        if assistant_text:
+            lines.append(f"Assistant: {_clip(assistant_text, TURN_MAX_CHARS)}")
+    return "\n".join(lines)
+
+def _turn_count(db: Session, chat_session: ChatSession) -> int:
+    if chat_session.turn_count is not None:
+        return chat_session.turn_count
+    # Sessions created before turn counting was added
+    return db.query(ChatMessage).filter(
+        ChatMessage.session_id == chat_session.id,
+        ChatMessage.message_type == "user",
+        session_messages_bound(chat_session.created_at)
+    ).count()
+
+def _recent_turns(db: Session, chat_session: ChatSession, limit: int):
+    """The last `limit` turns as (user, assistant) pairs, oldest first"""
+    messages = (
+        db.query(ChatMessage.message_type, ChatMessage.content)
+        .filter(ChatMessage.session_id == chat_session.id, session_messages_bound(chat_session.created_at))
+        .order_by(ChatMessage.id.desc())
+        .limit(limit * 2)
+        .all()
+    )
+    turns = []
+    for message_type, content in reversed(messages):
+        if message_type == "user":
+            turns.append([content, None])
+        elif turns:
+            turns[-1][1] = content
+    return [tuple(turn) for turn in turns[-limit:]]
+
+def load_context(db: Session, chat_session: ChatSession) -> str:
+    """Prompt context for the next turn: rolling summary plus every turn it does not cover yet"""
+    total = _turn_count(db, chat_session)
+    summarized = chat_session.summary_turns or 0
+    # Turns past the summary: the last CONTEXT_TURNS plus fewer than SUMMARY_EVERY_TURNS
+    # waiting to be folded in, so the prompt never grows beyond that bound
+    pending = min(total - summarized, CONTEXT_TURNS + SUMMARY_EVERY_TURNS - 1)
+    turns = _recent_turns(db, chat_session, pending) if pending > 0 else []
+    if not chat_session.summary and not turns:
+        return ""
+
+    parts = []
+    if chat_session.summary:
+        parts.append(f"Summary of the earlier conversation:\n{chat_session.summary}")
+    if turns:
+        parts.append(f"Recent conversation:\n{_format_turns(turns)}")
+    return "\n\n".join(parts) + "\n\n"
+
+def record_turn(db: Session, chat_session: ChatSession) -> bool:
+    """Count a completed turn; returns True when the summary is due for a refresh"""
+    chat_session.turn_count = _turn_count(db, chat_session) + 1
+    out_of_window = chat_session.turn_count - CONTEXT_TURNS
+    return out_of_window - (chat_session.summary_turns or 0) >= SUMMARY_EVERY_TURNS
+
+def refresh_summary(session_factory, session_pk: int, select_llm, chat_session_factory=None):
+    """
+    Fold turns that left the verbatim window into the session's rolling summary.
+    select_llm(route) gives the (client, model name) for the user's budget route; users
+    over budget with BUDGET_ACTION=refuse get no summary. chat_session_factory opens the
+    database holding the session when chat storage is sharded; usage is recorded through
+    session_factory.
+    """
+    db = session_factory()
+    chat_db = chat_session_factory() if chat_session_factory not in (None, session_factory) else db
+    try:
+        chat_session = chat_db.query(ChatSession).filter(ChatSession.id == session_pk).first()
+        if chat_session is None:
+            return
+        total = _turn_count(chat_db, chat_session)
+        summarized = chat_session.summary_turns or 0
+        target = total - CONTEXT_TURNS
+        if target <= summarized:
+            return
+
+        # Summaries count against the daily token budget like the answers do
+        model_route = budget_route(db, db.query(User).filter(User.id == chat_session.user_id).first())
+        if model_route == "refuse":
+            logger.info(f"Skipping summary of chat session {session_pk}: user over daily token budget")
+            return
+        llm, model_name = select_llm(model_route)
+        if llm is None:
+            return
+
+        # Turns summarized..target-1 counted from the start are the oldest of the last total-summarized
+        turns = _recent_turns(chat_db, chat_session, total - summarized)[:target - summarized]
+        prompt = SUMMARY_PROMPT.format(
+            max_words=SUMMARY_MAX_CHARS // 6,
+            summary=chat_session.summary or "(none yet)",
+            turns=_format_turns(turns),
+        )
+        started = time.perf_counter()
+        response = llm.invoke(prompt)
+        summary = response.content if hasattr(response, "content") else str(response)
+        usage = usage_from_response(response, model_name, (time.perf_counter() - started) * 1000, prompt)
+        record_usage(db, chat_session.user_id, "summary", usage)
+
+        chat_session.summary = _clip(summary.strip(), SUMMARY_MAX_CHARS)
+        chat_session.summary_turns = target
+        chat_db.commit()
+        if chat_db is not db:
+            db.commit()
+        logger.info(f"Refreshed summary for chat session {session_pk} ({target} turns summarized)")
+    except Exception as e:
+        chat_db.rollback()
+        db.rollback()
+        logger.error(f"Error refreshing summary for chat session {session_pk}: {e}")
+    finally:
+        if chat_db is not db:
+            chat_db.close()
+        db.close()
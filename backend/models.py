@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Date, ForeignKey, Boolean, JSON
+from sqlalchemy import Column, Integer, String, Text, DateTime, Date, ForeignKey, Boolean, JSON, Float, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime, timezone
@@ -17,6 +17,7 @@ class User(Base):
     date_of_birth = Column(Date, nullable=True)
     is_active = Column(Boolean, default=True)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    daily_token_budget = Column(Integer, nullable=True)  # Overrides DEFAULT_DAILY_TOKEN_BUDGET
 
     # Relationships
     chat_sessions = relationship("ChatSession", back_populates="user")
@@ -30,6 +31,11 @@ class ChatSession(Base):
     session_id = Column(String(100), unique=True, index=True, nullable=False)
     agent_type = Column(String(50), nullable=False)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    # Conversation memory: rolling summary of the turns older than the verbatim window
+    summary = Column(Text, nullable=True)
+    summary_turns = Column(Integer, default=0)  # Turns folded into summary
+    turn_count = Column(Integer, default=0)
     
     # Relationships
     user = relationship("User", back_populates="chat_sessions")
@@ -42,7 +48,7 @@ class ChatMessage(Base):
     session_id = Column(Integer, ForeignKey("chat_sessions.id"), nullable=False)
     message_type = Column(String(20), nullable=False)  # 'user' or 'assistant'
     content = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    timestamp = Column(DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
     message_metadata = Column(JSON)  # Store additional info like agent_type, etc.
     
     # Relationships
@@ -50,6 +56,10 @@ class ChatMessage(Base):
 
 class Medication(Base):
     __tablename__ = "medications"
+    __table_args__ = (
+        # The reminder scheduler range-scans the medications due next
+        Index("ix_medications_next_due_at", "next_due_at"),
+    )
     
     # Use String ID to match API expectations
     id = Column(String(50), primary_key=True, default=lambda: str(uuid.uuid4()))
@@ -66,6 +76,114 @@ class Medication(Base):
     
     instructions = Column(Text, nullable=True)
     created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    # Reminder schedule parsed from frequency (reminders.parse_frequency); {} when it has no fixed times
+    schedule = Column(JSON, nullable=True)
+    next_due_at = Column(DateTime, nullable=True)  # None: no upcoming reminder
     
     # Relationships
-    user = relationship("User", back_populates="medications")
\ No newline at end of file
+    user = relationship("User", back_populates="medications")
+    dose_events = relationship("DoseEvent", back_populates="medication", cascade="all, delete-orphan", passive_deletes=True)
+    reminders = relationship("MedicationReminder", cascade="all, delete-orphan", passive_deletes=True)
+
+class DoseEvent(Base):
+    __tablename__ = "dose_events"
+    __table_args__ = (
+        UniqueConstraint("medication_id", "date", name="uq_dose_events_medication_date"),
+    )
+
+    # Doses of one medication taken on one day (set from the reminders UI)
+    id = Column(Integer, primary_key=True, index=True)
+    medication_id = Column(String(50), ForeignKey("medications.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    date = Column(Date, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+    # Relationships
+    medication = relationship("Medication", back_populates="dose_events")
+
+class LLMUsageDaily(Base):
+    __tablename__ = "llm_usage_daily"
+    __table_args__ = (
+        # Per-agent reports read a range of days across all users
+        Index("ix_llm_usage_daily_day_agent", "day", "agent_type"),
+    )
+
+    # One row per day, user, agent and model; updated in place with each LLM call
+    day = Column(Date, primary_key=True)
+    user_id = Column(Integer, primary_key=True)  # 0 for anonymous calls
+    agent_type = Column(String(50), primary_key=True)
+    model = Column(String(50), primary_key=True)
+    calls = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(Integer, nullable=False, default=0)
+    completion_tokens = Column(Integer, nullable=False, default=0)
+    latency_ms = Column(Float, nullable=False, default=0.0)  # Sum over calls
+    cost_usd = Column(Float, nullable=False, default=0.0)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    # A claimed key has no response yet; its holder has until locked_until to finish
+    user_id = Column(Integer, primary_key=True)  # 0 for anonymous requests
+    key = Column(String(255), primary_key=True)
+    endpoint = Column(String(100), nullable=False)
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=True)
+    response = Column(JSON(none_as_null=True), nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    locked_until = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+class AssessmentJob(Base):
+    __tablename__ = "assessment_jobs"
+    __table_args__ = (
+        # Workers pick the oldest due job of a status
+        Index("ix_assessment_jobs_status_due", "status", "next_attempt_at"),
+    )
+
+    id = Column(String(36), primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(Integer, nullable=True, index=True)  # None for anonymous submissions
+    status = Column(String(20), nullable=False, default="queued")  # queued, running, succeeded, failed
+    request = Column(JSON, nullable=False)
+    result = Column(JSON(none_as_null=True), nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    worker = Column(String(100), nullable=True)  # Process and task holding a running job
+    created_at = Column(DateTime, nullable=False)
+    next_attempt_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class DataMigration(Base):
+    __tablename__ = "data_migrations"
+
+    # Progress of an online migration (online_migrations.py); last_key is the backfill checkpoint
+    name = Column(String(100), primary_key=True)
+    status = Column(String(20), nullable=False)  # backfilling, done
+    last_key = Column(JSON(none_as_null=True), nullable=True)
+    rows_done = Column(Integer, nullable=False, default=0)
+    started_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime, nullable=True)
+
+class MedicationReminder(Base):
+    __tablename__ = "medication_reminders"
+    __table_args__ = (
+        # Clients read their reminders after a cursor id
+        Index("ix_medication_reminders_user_id_id", "user_id", "id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    medication_id = Column(String(50), ForeignKey("medications.id", ondelete="CASCADE"), nullable=False)
+    due_at = Column(DateTime, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+class RecentWrite(Base):
+    __tablename__ = "recent_writes"
+
+    # Until expires_at the user's reads stay on the primary (database.mark_user_write).
+    # Kept in the database so every worker and node sees it.
+    user_id = Column(Integer, primary_key=True)
+    expires_at = Column(DateTime, nullable=False, index=True)  # Workers load the live ones
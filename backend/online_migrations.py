@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Online schema changes for large, hot tables (medications, chat_messages)
+
+A ShadowColumn migration never rewrites a table in one transaction:
+
+1. expand: add the new column as nullable (metadata-only) and install a trigger that
+   dual-writes it on every insert and update, so rows written from now on are correct;
+2. backfill: fill existing rows in keyset-ordered batches, one short transaction per
+   batch, throttled, with a checkpoint in data_migrations so an interrupted run resumes;
+3. contract: once no row is left, make the column NOT NULL if it should be (Postgres:
+   a NOT VALID check constraint, validated without blocking writes, lets SET NOT NULL
+   skip its own full scan under ACCESS EXCLUSIVE), then drop the trigger and the column
+   it replaces.
+
+A derived column can instead keep its trigger for good (keep_trigger), which is how a
+column Postgres would compute with GENERATED ALWAYS (a full table rewrite under an
+ACCESS EXCLUSIVE lock when added) is introduced online.
+
+DDL waits at most MIGRATION_LOCK_TIMEOUT_MS for its lock and retries, instead of
+queueing (and stalling every query behind it) while a long transaction holds the table.
+
+Usage:
+    python online_migrations.py status
+    python online_migrations.py run [name ...] [--batch-size N] [--throttle SECONDS]
+"""
+
+import argparse
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from sqlalchemy import text, inspect, select, update, insert
+from sqlalchemy.exc import OperationalError
+from database import engine, replica_engine, REPLICA_LAG_SQL, REPLICA_MAX_LAG_SECONDS
+from models import DataMigration
+
+logger = logging.getLogger(__name__)
+
+# Rows per batch to start with; adapted so a batch takes about MIGRATION_BATCH_TARGET_SECONDS
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "1000"))
+MIGRATION_BATCH_TARGET_SECONDS = float(os.getenv("MIGRATION_BATCH_TARGET_SECONDS", "0.5"))
+# Pause between batches, leaving the table (and the WAL) to live traffic
+MIGRATION_THROTTLE_SECONDS = float(os.getenv("MIGRATION_THROTTLE_SECONDS", "0.05"))
+MIGRATION_LOCK_TIMEOUT_MS = int(os.getenv("MIGRATION_LOCK_TIMEOUT_MS", "2000"))
+DDL_ATTEMPTS = 10
+MIN_BATCH_SIZE = 100
+
+# Postgres SQLSTATE for lock_timeout expiring
+LOCK_NOT_AVAILABLE = "55P03"
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _is_postgres() -> bool:
+    return engine.dialect.name == "postgresql"
+
+def _quote(name: str) -> str:
+    return engine.dialect.identifier_preparer.quote(name)
+
+def run_ddl(statements: list, target=None):
+    """Run DDL in one transaction that gives up on (and retries) a lock it cannot get quickly"""
+    target = target if target is not None else engine
+    for attempt in range(1, DDL_ATTEMPTS + 1):
+        try:
+            with target.begin() as conn:
+                if target.dialect.name == "postgresql":
+                    conn.execute(text(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT_MS}ms'"))
+                for statement in statements:
+                    conn.execute(text(statement))
+            return
+        except OperationalError as e:
+            if getattr(e.orig, "pgcode", None) != LOCK_NOT_AVAILABLE or attempt == DDL_ATTEMPTS:
+                raise
+            logger.warning(f"DDL lock not available (attempt {attempt}), retrying")
+            time.sleep(min(30, 0.5 * 2 ** attempt))
+
+def wait_for_replica():
+    """Pause the backfill while the read replica falls behind on replaying it"""
+    if replica_engine is None:
+        return
+    while True:
+        try:
+            with replica_engine.connect() as conn:
+                lag = conn.execute(text(REPLICA_LAG_SQL)).scalar()
+        except Exception as e:
+            logger.warning(f"Could not check replica lag, continuing: {e}")
+            return
+        if lag is None or float(lag) <= REPLICA_MAX_LAG_SECONDS:
+            return
+        logger.info(f"Replica lagging by {float(lag):.1f}s, pausing backfill")
+        time.sleep(REPLICA_MAX_LAG_SECONDS)
+
+class ShadowColumn:
+    """
+    Online change of one column: either a new column derived from `expression` (SQL
+    over the row's columns), or `replaces`, a column renamed/retyped to `column`.
+    `dialect` limits it to one database; `keep_trigger` keeps a derived column maintained;
+    `not_null` makes the column NOT NULL on contract, as the model declares it.
+    """
+
+    def __init__(self, name: str, table: str, column: str, column_type: str,
+                 expression: str = None, replaces: str = None, key: str = "id",
+                 dialect: str = None, keep_trigger: bool = False, not_null: bool = False):
+        self.name = name
+        self.table = table
+        self.column = column
+        self.column_type = column_type
+        self.expression = expression if expression is not None else _quote(replaces)
+        self.replaces = replaces
+        self.key = key
+        self.dialect = dialect
+        self.keep_trigger = keep_trigger
+        self.not_null = not_null
+
+    @property
+    def trigger(self) -> str:
+        return f"dual_write_{self.name}"
+
+    def plan(self, conn) -> str:
+        """"rename", "expand", "backfill", "not_null" or None (nothing to do)"""
+        if self.dialect is not None and conn.dialect.name != self.dialect:
+            return None
+        columns = {col["name"]: col for col in inspect(conn).get_columns(self.table)}
+        # SQLite cannot add NOT NULL to an existing column; only new tables get it there
+        nullable = (self.not_null and conn.dialect.name == "postgresql"
+                    and columns.get(self.column, {}).get("nullable", False))
+        if self.replaces is not None:
+            if self.replaces not in columns:
+                return "not_null" if nullable else None
+            # A plain rename keeps the data in place and only touches the catalog
+            return "backfill" if self.column in columns else "rename"
+        if self.column not in columns:
+            return "expand"
+        if columns[self.column].get("computed"):
+            # Already computed by the database itself (e.g. partitions.py's table)
+            return None
+        if self.not_null and not columns[self.column]["nullable"]:
+            # e.g. chat_messages.timestamp in partitions.py's table, where it is in the key
+            return None
+        state = conn.execute(select(DataMigration.status).where(DataMigration.name == self.name)).scalar()
+        if state == "done":
+            return "not_null" if nullable else None
+        return "backfill"
+
+    def _trigger_ddl(self, postgres: bool = None) -> list:
+        table, column, key = _quote(self.table), _quote(self.column), _quote(self.key)
+        if postgres if postgres is not None else _is_postgres():
+            if self.replaces is None:
+                # The expression names bare (or table-qualified) columns; selecting from NEW.*
+                # under the table's name resolves them on the new row
+                body = f"NEW.{column} := (SELECT {self.expression} FROM (SELECT NEW.*) AS {table});"
+            else:
+                # Old code writes the replaced column, new code the new one; keep both in step
+                old = _quote(self.replaces)
+                body = f"""
+                IF TG_OP = 'INSERT' THEN
+                    NEW.{column} := coalesce(NEW.{column}, NEW.{old});
+                    NEW.{old} := coalesce(NEW.{old}, NEW.{column});
+                ELSIF NEW.{old} IS DISTINCT FROM OLD.{old} THEN
+                    NEW.{column} := NEW.{old};
+                ELSIF NEW.{column} IS DISTINCT FROM OLD.{column} THEN
+                    NEW.{old} := NEW.{column};
+                END IF;"""
+            return [
+                f"""CREATE OR REPLACE FUNCTION {self.trigger}() RETURNS trigger AS $$
+                BEGIN
+                    {body}
+                    RETURN NEW;
+                END $$ LANGUAGE plpgsql""",
+                f"DROP TRIGGER IF EXISTS {self.trigger} ON {table}",
+                f"CREATE TRIGGER {self.trigger} BEFORE INSERT OR UPDATE ON {table} "
+                f"FOR EACH ROW EXECUTE FUNCTION {self.trigger}()",
+            ]
+        # SQLite triggers cannot change NEW; they update the row right after the write
+        if self.replaces is None:
+            on_insert = f"{column} = {self.expression}"
+            on_update = on_insert
+        else:
+            # SQLite checks NOT NULL before triggers run, so inserts must still set a NOT NULL replaced column
+            old = _quote(self.replaces)
+            on_insert = f"{column} = coalesce({column}, {old})"
+            on_update = (f"{column} = CASE WHEN NEW.{old} IS NOT OLD.{old} THEN NEW.{old} ELSE {column} END, "
+                         f"{old} = CASE WHEN NEW.{old} IS OLD.{old} AND NEW.{column} IS NOT OLD.{column} "
+                         f"THEN NEW.{column} ELSE {old} END")
+        return [
+            f"DROP TRIGGER IF EXISTS {self.trigger}_insert",
+            f"DROP TRIGGER IF EXISTS {self.trigger}_update",
+            f"CREATE TRIGGER {self.trigger}_insert AFTER INSERT ON {table} BEGIN "
+            f"UPDATE {table} SET {on_insert} WHERE {key} = NEW.{key}; END",
+            f"CREATE TRIGGER {self.trigger}_update AFTER UPDATE ON {table} BEGIN "
+            f"UPDATE {table} SET {on_update} WHERE {key} = NEW.{key}; END",
+        ]
+
+    def expand(self):
+        statements = []
+        with engine.connect() as conn:
+            columns = {col["name"] for col in inspect(conn).get_columns(self.table)}
+        if self.column not in columns:
+            # Nullable without a default: no table rewrite
+            statements.append(f"ALTER TABLE {_quote(self.table)} ADD COLUMN {_quote(self.column)} {self.column_type}")
+        run_ddl(statements)
+        run_ddl(self._trigger_ddl())
+        logger.info(f"{self.name}: added {self.table}.{self.column} with dual-write trigger")
+
+    def install(self, target):
+        """
+        Add the column and its trigger on another database's still empty table (a new
+        chat shard), where there is nothing to backfill. Only for keep_trigger columns.
+        """
+        if self.dialect is not None and target.dialect.name != self.dialect:
+            return
+        columns = {col["name"] for col in inspect(target).get_columns(self.table)}
+        if self.column in columns:
+            return
+        run_ddl([f"ALTER TABLE {_quote(self.table)} ADD COLUMN {_quote(self.column)} {self.column_type}"], target)
+        run_ddl(self._trigger_ddl(postgres=target.dialect.name == "postgresql"), target)
+
+    def rename(self):
+        run_ddl([f"ALTER TABLE {_quote(self.table)} RENAME COLUMN {_quote(self.replaces)} TO {_quote(self.column)}"])
+        logger.info(f"{self.name}: renamed {self.table}.{self.replaces} to {self.column}")
+
+    def _batch(self, after, limit: int):
+        """Fill one key range; returns (last key, rows scanned, rows updated)"""
+        table, column, key = _quote(self.table), _quote(self.column), _quote(self.key)
+        with engine.begin() as conn:
+            if after is None:
+                keys = conn.execute(text(f"SELECT {key} FROM {table} ORDER BY {key} LIMIT :limit"),
+                                    {"limit": limit}).scalars().all()
+            else:
+                keys = conn.execute(text(f"SELECT {key} FROM {table} WHERE {key} > :after ORDER BY {key} LIMIT :limit"),
+                                    {"after": after, "limit": limit}).scalars().all()
+            if not keys:
+                return after, 0, 0
+            lower = f"{key} > :after AND " if after is not None else ""
+            # Rows already written through the trigger (or by new code) are left alone
+            updated = conn.execute(text(
+                f"UPDATE {table} SET {column} = {self.expression} "
+                f"WHERE {lower}{key} <= :upto AND {column} IS NULL AND ({self.expression}) IS NOT NULL"
+            ), {"after": after, "upto": keys[-1]}).rowcount
+            # The checkpoint commits with the batch, so a resumed run never skips or repeats one
+            conn.execute(update(DataMigration).where(DataMigration.name == self.name).values(
+                last_key=keys[-1], rows_done=DataMigration.rows_done + updated, updated_at=_now()))
+        return keys[-1], len(keys), updated
+
+    def backfill(self, batch_size: int = MIGRATION_BATCH_SIZE, throttle: float = MIGRATION_THROTTLE_SECONDS):
+        with engine.connect() as conn:
+            after = conn.execute(select(DataMigration.last_key).where(DataMigration.name == self.name)).scalar()
+        max_batch = batch_size * 10
+        while True:
+            started = time.monotonic()
+            after, scanned, updated = self._batch(after, batch_size)
+            if scanned == 0:
+                return
+            elapsed = time.monotonic() - started
+            # Keep every transaction short whatever the row size or load
+            if elapsed > MIGRATION_BATCH_TARGET_SECONDS:
+                batch_size = max(MIN_BATCH_SIZE, batch_size // 2)
+            elif elapsed < MIGRATION_BATCH_TARGET_SECONDS / 4:
+                batch_size = min(max_batch, batch_size * 2)
+            logger.debug(f"{self.name}: {updated} rows up to key {after!r} in {elapsed:.2f}s")
+            time.sleep(throttle)
+            wait_for_replica()
+
+    def remaining(self) -> int:
+        table, column = _quote(self.table), _quote(self.column)
+        with engine.connect() as conn:
+            return conn.execute(text(
+                f"SELECT count(*) FROM {table} WHERE {column} IS NULL AND ({self.expression}) IS NOT NULL"
+            )).scalar()
+
+    def set_not_null(self):
+        if not _is_postgres():
+            return
+        table, column = _quote(self.table), _quote(self.column)
+        check = _quote(f"{self.table}_{self.column}_not_null")
+        # Adding the constraint NOT VALID is a catalog change; validating it scans the table
+        # under a lock that lets reads and writes through, and SET NOT NULL then trusts it
+        run_ddl([f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {check}",
+                 f"ALTER TABLE {table} ADD CONSTRAINT {check} CHECK ({column} IS NOT NULL) NOT VALID"])
+        run_ddl([f"ALTER TABLE {table} VALIDATE CONSTRAINT {check}"])
+        run_ddl([f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL",
+                 f"ALTER TABLE {table} DROP CONSTRAINT {check}"])
+        logger.info(f"{self.name}: {self.table}.{self.column} set NOT NULL")
+
+    def contract(self):
+        if self.not_null:
+            # While the trigger still fills the column from writes of old code
+            self.set_not_null()
+        table = _quote(self.table)
+        if self.keep_trigger:
+            statements = []
+        elif _is_postgres():
+            statements = [f"DROP TRIGGER IF EXISTS {self.trigger} ON {table}",
+                          f"DROP FUNCTION IF EXISTS {self.trigger}()"]
+        else:
+            statements = [f"DROP TRIGGER IF EXISTS {self.trigger}_insert",
+                          f"DROP TRIGGER IF EXISTS {self.trigger}_update"]
+        # In the same transaction, so no write lands between the trigger and the column going
+        if self.replaces is not None:
+            statements.append(f"ALTER TABLE {table} DROP COLUMN {_quote(self.replaces)}")
+        run_ddl(statements)
+        logger.info(f"{self.name}: contracted" + (" (trigger kept)" if self.keep_trigger else ""))
+
+    def run(self, batch_size: int = MIGRATION_BATCH_SIZE, throttle: float = MIGRATION_THROTTLE_SECONDS,
+            backfill: bool = True) -> str:
+        """Advance as far as possible; returns the resulting status"""
+        with engine.connect() as conn:
+            step = self.plan(conn)
+        if step is None:
+            return "done"
+        if step == "rename":
+            self.rename()
+            _set_status(self.name, "done")
+            return "done"
+        if step == "not_null":
+            # Contracted before NOT NULL was part of contract
+            self.set_not_null()
+            return "done"
+        if step == "expand" or _status(self.name) is None:
+            self.expand()
+            _set_status(self.name, "backfilling")
+        if not backfill:
+            return "backfilling"
+        self.backfill(batch_size, throttle)
+        # Writes racing the last batch are covered by the trigger, so this is final
+        left = self.remaining()
+        if left:
+            logger.warning(f"{self.name}: {left} rows still to backfill")
+            return "backfilling"
+        self.contract()
+        _set_status(self.name, "done")
+        return "done"
+
+def _status(name: str):
+    with engine.connect() as conn:
+        return conn.execute(select(DataMigration.status).where(DataMigration.name == name)).scalar()
+
+def _set_status(name: str, status: str):
+    now = _now()
+    with engine.begin() as conn:
+        updated = conn.execute(update(DataMigration).where(DataMigration.name == name).values(
+            status=status, updated_at=now, finished_at=now if status == "done" else None)).rowcount
+        if not updated:
+            conn.execute(insert(DataMigration).values(
+                name=name, status=status, rows_done=0, started_at=now, updated_at=now,
+                finished_at=now if status == "done" else None))
+
+# Applied in order. The first ones replace the old copy-the-whole-table migration of
+# the snake_case medications columns; a rename is enough unless both columns exist.
+MIGRATIONS = [
+    ShadowColumn("medications_prescribed_by", "medications", "prescribedBy", "VARCHAR(100)", replaces="prescribed_by",
+                 not_null=True),
+    ShadowColumn("medications_start_date", "medications", "startDate", "TIMESTAMP", replaces="start_date",
+                 not_null=True),
+    ShadowColumn("medications_end_date", "medications", "endDate", "TIMESTAMP", replaces="end_date"),
+    ShadowColumn("medications_total_doses", "medications", "totalDoses", "INTEGER", replaces="total_doses"),
+    # Full-text search document of each chat message (search.py), GIN-indexed by database.create_search_index
+    ShadowColumn("chat_messages_content_tsv", "chat_messages", "content_tsv", "tsvector",
+                 expression="to_tsvector('english', coalesce(content, ''))", dialect="postgresql", keep_trigger=True),
+    # Messages stored without a timestamp sort nowhere and land in the default partition;
+    # they take their session's start time, and the column becomes NOT NULL
+    ShadowColumn("chat_messages_timestamp", "chat_messages", "timestamp", "TIMESTAMP",
+                 expression='coalesce("timestamp", (SELECT created_at FROM chat_sessions WHERE chat_sessions.id = chat_messages.session_id), '
+                            'CURRENT_TIMESTAMP)',
+                 not_null=True),
+]
+
+CONTENT_TSV = next(migration for migration in MIGRATIONS if migration.name == "chat_messages_content_tsv")
+
+def run_migrations(names=None, batch_size: int = MIGRATION_BATCH_SIZE,
+                   throttle: float = MIGRATION_THROTTLE_SECONDS, backfill: bool = True) -> dict:
+    """Run the given (default: all) migrations; returns name -> status"""
+    results = {}
+    for migration in MIGRATIONS:
+        if names and migration.name not in names:
+            continue
+        results[migration.name] = migration.run(batch_size, throttle, backfill)
+    return results
+
+def migration_status() -> list:
+    with engine.connect() as conn:
+        rows = {row.name: row for row in conn.execute(select(DataMigration))}
+        statuses = []
+        for migration in MIGRATIONS:
+            row = rows.get(migration.name)
+            statuses.append({
+                "name": migration.name,
+                "status": row.status if row else ("pending" if migration.plan(conn) else "not needed"),
+                "rows_done": row.rows_done if row else 0,
+                "last_key": row.last_key if row else None,
+            })
+        return statuses
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "run"])
+    parser.add_argument("names", nargs="*", help="migrations to run (default: all)")
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE)
+    parser.add_argument("--throttle", type=float, default=MIGRATION_THROTTLE_SECONDS,
+                        help="seconds to pause between batches")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    DataMigration.__table__.create(bind=engine, checkfirst=True)
+    if args.command == "run":
+        for name, status in run_migrations(args.names, args.batch_size, args.throttle).items():
+            print(f"{name}: {status}")
+    else:
+        for row in migration_status():
+            print(f"{row['name']}: {row['status']} ({row['rows_done']} rows, last key {row['last_key']!r})")
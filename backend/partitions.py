@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""
+Monthly range partitioning of chat_messages and archival of cold partitions (PostgreSQL)
+
+The conversion runs next to live traffic: the partitioned copy is filled in keyset
+batches while a trigger mirrors every write to chat_messages into it, and the tables are
+swapped under a lock held only for the renames. An interrupted convert resumes.
+
+Usage:
+    python partitions.py convert    # one-off: turn chat_messages into a partitioned table
+    python partitions.py maintain   # create upcoming partitions and archive expired ones
+"""
+
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+import re
+import time
+from datetime import date, datetime, timedelta, timezone
+from sqlalchemy import func, select, text, true, update
+from starlette.concurrency import run_in_threadpool
+from database import engine
+
+logger = logging.getLogger(__name__)
+
+# Partitions are created this many months ahead of the current one
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# Partitions whose whole month is older than this many months are archived
+CHAT_RETENTION_MONTHS = int(os.getenv("CHAT_RETENTION_MONTHS", "12"))
+# Where archived partitions are written (point this at a cheap storage mount/bucket)
+ARCHIVE_DIR = os.getenv("CHAT_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive"))
+# Every server process makes sure upcoming partitions exist this often (one at a time)
+PARTITION_MAINTENANCE_INTERVAL_SECONDS = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL_SECONDS", "21600"))
+# Rows copied per transaction by convert
+CONVERT_BATCH_SIZE = int(os.getenv("PARTITION_CONVERT_BATCH_SIZE", "5000"))
+
+PARTITION_NAME = re.compile(r"^chat_messages_y(\d{4})m(\d{2})$")
+DEFAULT_PARTITION = "chat_messages_default"
+# Columns of a row moved between partitions (content_tsv is generated)
+MESSAGE_COLUMNS = 'id, session_id, message_type, content, "timestamp", message_metadata'
+CONVERT_MIGRATION = "chat_messages_partitioning"
+# pg_try_advisory_xact_lock key, so one process at a time creates partitions
+PARTITION_LOCK_KEY = 7305110
+
+# Set once chat_messages is found partitioned (ensure_future_partitions runs at startup);
+# until then chat queries carry no partition bound
+partitioned = False
+# Clock skew tolerated between the servers stamping a session and its messages
+SESSION_CLOCK_SKEW = timedelta(days=1)
+
+PARTITIONED_TABLE_DDL = """
+    CREATE TABLE chat_messages_partitioned (
+        id INTEGER NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+        session_id INTEGER NOT NULL REFERENCES chat_sessions (id),
+        message_type VARCHAR(20) NOT NULL,
+        content TEXT NOT NULL,
+        "timestamp" TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'),
+        message_metadata JSON,
+        content_tsv tsvector GENERATED ALWAYS AS (to_tsvector('english', coalesce(content, ''))) STORED,
+        PRIMARY KEY (id, "timestamp")
+    ) PARTITION BY RANGE ("timestamp")
+"""
+
+# Created on the parent, so every partition (present and future) gets them
+PARTITIONED_INDEX_DDL = [
+    "CREATE INDEX ix_chat_messages_p_session_id ON chat_messages_partitioned (session_id, \"timestamp\")",
+    "CREATE INDEX ix_chat_messages_p_content_tsv ON chat_messages_partitioned USING GIN (content_tsv)",
+]
+
+# While convert copies, every write to chat_messages is repeated on the partitioned copy
+MIRROR_TRIGGER = "mirror_chat_messages_partitioned"
+MIRROR_TRIGGER_DDL = [
+    f"""CREATE OR REPLACE FUNCTION {MIRROR_TRIGGER}() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            DELETE FROM chat_messages_partitioned WHERE id = OLD.id;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO chat_messages_partitioned ({MESSAGE_COLUMNS})
+            VALUES (NEW.id, NEW.session_id, NEW.message_type, NEW.content,
+                    coalesce(NEW."timestamp", now() AT TIME ZONE 'utc'), NEW.message_metadata)
+            ON CONFLICT DO NOTHING;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    f"DROP TRIGGER IF EXISTS {MIRROR_TRIGGER} ON chat_messages",
+    f"CREATE TRIGGER {MIRROR_TRIGGER} AFTER INSERT OR UPDATE OR DELETE ON chat_messages "
+    f"FOR EACH ROW EXECUTE FUNCTION {MIRROR_TRIGGER}()",
+]
+
+# FOR SHARE makes a concurrent update or delete of a row wait for its batch, so the
+# mirror trigger then applies it to the copied row instead of racing the copy
+COPY_BATCH_SQL = f"""
+    INSERT INTO chat_messages_partitioned ({MESSAGE_COLUMNS})
+    SELECT id, session_id, message_type, content, coalesce("timestamp", now() AT TIME ZONE 'utc'), message_metadata
+    FROM chat_messages WHERE id > :after AND id <= :upto
+    FOR SHARE
+    ON CONFLICT DO NOTHING
+"""
+
+SWAP_DDL = [
+    "LOCK TABLE chat_messages IN ACCESS EXCLUSIVE MODE",
+    "DROP TABLE chat_messages",
+    f"DROP FUNCTION {MIRROR_TRIGGER}()",
+    "ALTER TABLE chat_messages_partitioned RENAME TO chat_messages",
+    "ALTER INDEX ix_chat_messages_p_session_id RENAME TO ix_chat_messages_session_id",
+    "ALTER INDEX ix_chat_messages_p_content_tsv RENAME TO ix_chat_messages_content_tsv",
+    "ALTER TABLE chat_messages RENAME CONSTRAINT chat_messages_partitioned_pkey TO chat_messages_pkey",
+    "ALTER TABLE chat_messages RENAME CONSTRAINT chat_messages_partitioned_session_id_fkey TO chat_messages_session_id_fkey",
+    "ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id",
+]
+
+def _add_months(day: date, months: int) -> date:
+    month_index = day.year * 12 + (day.month - 1) + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+def _partition_name(month_start: date) -> str:
+    return f"chat_messages_y{month_start.year:04d}m{month_start.month:02d}"
+
+def _current_month() -> date:
+    today = datetime.now(timezone.utc).date()
+    return date(today.year, today.month, 1)
+
+def is_partitioned(conn) -> bool:
+    return bool(conn.execute(text("""
+        SELECT 1 FROM pg_partitioned_table p
+        JOIN pg_class c ON c.oid = p.partrelid
+        WHERE c.relname = 'chat_messages' AND c.relnamespace = 'public'::regnamespace
+    """)).scalar())
+
+def session_messages_bound(session_created_at):
+    """
+    Filter on chat_messages.timestamp that lets Postgres skip the partitions from before a
+    session started: messages are never older than their session. session_created_at is
+    a value, or the ChatSession.created_at column of a join (then the partitions are
+    pruned at run time, once the session row is known). True when not partitioned.
+    """
+    from models import ChatMessage
+    if not partitioned or session_created_at is None:
+        return true()
+    if isinstance(session_created_at, datetime):
+        return ChatMessage.timestamp >= session_created_at - SESSION_CLOCK_SKEW
+    return ChatMessage.timestamp >= func.coalesce(session_created_at - SESSION_CLOCK_SKEW, text("'-infinity'::timestamp"))
+
+def _exists(conn, name: str) -> bool:
+    return conn.execute(text("SELECT to_regclass(:name)"), {"name": f"public.{name}"}).scalar() is not None
+
+def _month_partition_ddl(parent: str, month_start: date) -> str:
+    return (f"CREATE TABLE {_partition_name(month_start)} PARTITION OF {parent} "
+            f"FOR VALUES FROM ('{month_start.isoformat()}') TO ('{_add_months(month_start, 1).isoformat()}')")
+
+def _create_month_partition(conn, parent: str, month_start: date) -> bool:
+    name = _partition_name(month_start)
+    if _exists(conn, name):
+        return False
+    month_end = _add_months(month_start, 1)
+    create = _month_partition_ddl(parent, month_start)
+    in_month = '"timestamp" >= :start AND "timestamp" < :end'
+    bounds = {"start": month_start, "end": month_end}
+    stranded = parent == "chat_messages" and conn.execute(
+        text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_month} LIMIT 1"), bounds
+    ).scalar()
+    if not stranded:
+        conn.execute(text(create))
+        return True
+    # The month's rows landed in the default partition (no partition existed yet), which
+    # rejects a new partition overlapping them: move them while the default is detached.
+    # Writes to chat_messages wait for the transaction; it only touches this month's rows.
+    conn.execute(text(f"ALTER TABLE chat_messages DETACH PARTITION {DEFAULT_PARTITION}"))
+    conn.execute(text(create))
+    moved = conn.execute(text(
+        f"INSERT INTO {name} ({MESSAGE_COLUMNS}) SELECT {MESSAGE_COLUMNS} FROM {DEFAULT_PARTITION} WHERE {in_month}"
+    ), bounds).rowcount
+    conn.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_month}"), bounds)
+    conn.execute(text(f"ALTER TABLE chat_messages ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    logger.info(f"Moved {moved} rows from {DEFAULT_PARTITION} to {name}")
+    return True
+
+def ensure_future_partitions(months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+    """
+    Create partitions for the current month and the next months_ahead months, and for any
+    month with rows in the default partition (which then move to their month's partition)
+    """
+    global partitioned
+    created = 0
+    with engine.begin() as conn:
+        partitioned = is_partitioned(conn)
+        if not partitioned:
+            return 0
+        if not conn.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": PARTITION_LOCK_KEY}).scalar():
+            # Another process is creating them right now
+            return 0
+        current = _current_month()
+        months = {_add_months(current, offset) for offset in range(months_ahead + 1)}
+        months.update(conn.execute(text(
+            f'SELECT DISTINCT date_trunc(\'month\', "timestamp")::date FROM {DEFAULT_PARTITION}'
+        )).scalars().all())
+        for month in sorted(months):
+            try:
+                with conn.begin_nested():
+                    created += _create_month_partition(conn, "chat_messages", month)
+            except Exception as e:
+                logger.error(f"Could not create partition for {month}: {e}")
+        if not _exists(conn, _partition_name(_add_months(current, 1))):
+            logger.error(f"No chat_messages partition for next month; its messages will pile up in "
+                         f"{DEFAULT_PARTITION} until one is created")
+    if created:
+        logger.info(f"Created {created} chat_messages partition(s)")
+    return created
+
+async def _maintain_forever():
+    while True:
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(ensure_future_partitions)
+        except Exception as e:
+            logger.error(f"Partition maintenance error: {e}")
+
+_maintenance_task = None
+
+async def start_maintenance():
+    """Keep creating upcoming partitions from this server process (PostgreSQL only)"""
+    global _maintenance_task
+    if engine.dialect.name == "postgresql" and _maintenance_task is None:
+        _maintenance_task = asyncio.create_task(_maintain_forever())
+
+async def stop_maintenance():
+    global _maintenance_task
+    if _maintenance_task is not None:
+        _maintenance_task.cancel()
+        await asyncio.gather(_maintenance_task, return_exceptions=True)
+        _maintenance_task = None
+
+def _prepare_conversion(conn, months_ahead: int) -> list:
+    """DDL creating the empty partitioned copy and the trigger that mirrors writes into it"""
+    oldest = conn.execute(text('SELECT min("timestamp") FROM chat_messages')).scalar()
+    month = date(oldest.year, oldest.month, 1) if oldest else _current_month()
+    last = _add_months(_current_month(), months_ahead)
+    statements = [
+        # The trigger needs this lock anyway; taken before the sequence's, in the order inserts take them
+        "LOCK TABLE chat_messages IN SHARE ROW EXCLUSIVE MODE",
+        # Keep the id sequence alive when the old table is dropped
+        "ALTER SEQUENCE chat_messages_id_seq OWNED BY NONE",
+        PARTITIONED_TABLE_DDL,
+        *PARTITIONED_INDEX_DDL,
+        f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF chat_messages_partitioned DEFAULT",
+    ]
+    while month <= last:
+        statements.append(_month_partition_ddl("chat_messages_partitioned", month))
+        month = _add_months(month, 1)
+    return statements + MIRROR_TRIGGER_DDL
+
+def _copy_rows(batch_size: int) -> int:
+    """Copy chat_messages into the partitioned table in keyset batches, from the checkpoint on"""
+    from models import DataMigration
+    from online_migrations import MIGRATION_THROTTLE_SECONDS, wait_for_replica, _now
+    with engine.connect() as conn:
+        after = conn.execute(select(DataMigration.last_key).where(DataMigration.name == CONVERT_MIGRATION)).scalar()
+    after = after or 0
+    copied = 0
+    while True:
+        with engine.begin() as conn:
+            upto = conn.execute(text(
+                "SELECT max(id) FROM (SELECT id FROM chat_messages WHERE id > :after ORDER BY id LIMIT :limit) AS batch"
+            ), {"after": after, "limit": batch_size}).scalar()
+            if upto is None:
+                return copied
+            # Rows the mirror trigger already wrote are left alone
+            inserted = conn.execute(text(COPY_BATCH_SQL), {"after": after, "upto": upto}).rowcount
+            # The checkpoint commits with the batch, so a resumed run never skips one
+            conn.execute(update(DataMigration).where(DataMigration.name == CONVERT_MIGRATION).values(
+                last_key=upto, rows_done=DataMigration.rows_done + inserted, updated_at=_now()))
+        after = upto
+        copied += inserted
+        logger.debug(f"Copied chat_messages up to id {after}")
+        time.sleep(MIGRATION_THROTTLE_SECONDS)
+        wait_for_replica()
+
+def _verify_copy():
+    # One snapshot for both counts: the mirror trigger writes in the same transactions
+    with engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn:
+        source = conn.execute(text("SELECT count(*) FROM chat_messages")).scalar()
+        copy = conn.execute(text("SELECT count(*) FROM chat_messages_partitioned")).scalar()
+    if source != copy:
+        raise RuntimeError(f"chat_messages has {source} rows but its partitioned copy {copy}; not swapping")
+    return source
+
+def convert_to_partitioned(months_ahead: int = PARTITION_MONTHS_AHEAD, batch_size: int = CONVERT_BATCH_SIZE):
+    """
+    Rebuild chat_messages as a monthly range-partitioned table, keeping ids and data,
+    without blocking chat writes for longer than the final renames
+    """
+    global partitioned
+    from online_migrations import run_ddl, _set_status
+    with engine.connect() as conn:
+        if is_partitioned(conn):
+            logger.info("chat_messages is already partitioned")
+            return
+        prepared = _exists(conn, "chat_messages_partitioned")
+        statements = MIRROR_TRIGGER_DDL if prepared else _prepare_conversion(conn, months_ahead)
+    # Short DDL that waits at most MIGRATION_LOCK_TIMEOUT_MS for its locks, and retries
+    run_ddl(statements)
+    if not prepared:
+        _set_status(CONVERT_MIGRATION, "backfilling")
+
+    copied = _copy_rows(batch_size)
+    rows = _verify_copy()
+    run_ddl(SWAP_DDL)
+    _set_status(CONVERT_MIGRATION, "done")
+    partitioned = True
+    logger.info(f"chat_messages converted to monthly partitions ({rows} rows, {copied} copied by this run)")
+
+def _expired_partitions(conn, retention_months: int):
+    cutoff = _add_months(_current_month(), -retention_months)
+    names = conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'public.chat_messages'::regclass
+        ORDER BY c.relname
+    """)).scalars().all()
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if not match:
+            continue
+        month_start = date(int(match.group(1)), int(match.group(2)), 1)
+        # Only whole months entirely before the cutoff
+        if _add_months(month_start, 1) <= cutoff:
+            yield name
+
+def _dump_partition(name: str, archive_dir: str) -> str:
+    """Write a detached partition as gzip-compressed CSV (with header) and return the path"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    raw = engine.raw_connection()
+    try:
+        with gzip.open(path + ".part", "wb") as out:
+            cursor = raw.cursor()
+            cursor.copy_expert(
+                f"COPY (SELECT id, session_id, message_type, content, \"timestamp\", message_metadata FROM {name} ORDER BY id) "
+                "TO STDOUT WITH (FORMAT csv, HEADER true)",
+                out,
+            )
+            cursor.close()
+        raw.commit()
+    finally:
+        raw.close()
+    # Only a complete file ever carries the final name
+    os.replace(path + ".part", path)
+    return path
+
+def archive_partitions(retention_months: int = CHAT_RETENTION_MONTHS, archive_dir: str = ARCHIVE_DIR) -> list:
+    """Detach partitions past the retention window, archive them to archive_dir and drop them"""
+    with engine.connect() as conn:
+        if not is_partitioned(conn):
+            logger.info("chat_messages is not partitioned, nothing to archive")
+            return []
+        expired = list(_expired_partitions(conn, retention_months))
+
+    archived = []
+    for name in expired:
+        # Detaching first takes the partition out of every query before the slow dump
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE chat_messages DETACH PARTITION {name}"))
+        path = _dump_partition(name, archive_dir)
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP TABLE {name}"))
+        logger.info(f"Archived partition {name} to {path}")
+        archived.append(path)
+    return archived
+
+def maintain_partitions():
+    """Periodic job: make sure upcoming partitions exist and archive expired ones"""
+    ensure_future_partitions()
+    return archive_partitions()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["convert", "maintain"])
+    args = parser.parse_args()
+
+    if engine.dialect.name != "postgresql":
+        raise SystemExit("Partitioning requires PostgreSQL")
+    if args.command == "convert":
+        convert_to_partitioned()
+    else:
+        archived = maintain_partitions()
+        print(f"Archived {len(archived)} partition(s)")
@@ -0,0 +1,112 @@
+"""
+On-demand request profiling: speedscope files for single requests, selected by a
+privileged header or by sampling (uses pyinstrument, imported only when enabled)
+"""
+
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import time
+from datetime import datetime, timezone
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# Requests carrying `X-Profile: <PROFILE_TOKEN>` are profiled; unset disables the header
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+# Share of all requests profiled at random (0.0 - 1.0)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"))
+# Sampling interval of the profiler in seconds
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+# Oldest profiles are deleted beyond this many files
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "500"))
+
+# When neither trigger is configured the middleware is not installed at all
+PROFILING_ENABLED = bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+UNSAFE_FILENAME = re.compile(r"[^A-Za-z0-9]+")
+
+def _wants_profile(scope) -> bool:
+    if PROFILE_TOKEN:
+        for name, value in scope["headers"]:
+            if name == b"x-profile":
+                return hmac.compare_digest(value.decode("latin-1"), PROFILE_TOKEN)
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+def _write_profile(profiler, metadata: dict) -> str:
+    from pyinstrument.renderers import SpeedscopeRenderer
+    profile = json.loads(profiler.output(SpeedscopeRenderer()))
+    title = f"{metadata['method']} {metadata['path']} -> {metadata['status']} in {metadata['duration_ms']:.0f} ms"
+    profile["name"] = title
+    for entry in profile.get("profiles", []):
+        entry["name"] = title
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    slug = UNSAFE_FILENAME.sub("_", metadata["route"] or metadata["path"]).strip("_") or "root"
+    filename = f"{stamp}_{metadata['method']}_{slug}_{metadata['duration_ms']:.0f}ms.speedscope.json"
+    with open(os.path.join(PROFILE_DIR, filename), "w", encoding="utf-8") as f:
+        json.dump(profile, f)
+    # One line per profile, to find the slow ones without opening every file
+    with open(os.path.join(PROFILE_DIR, "index.jsonl"), "a", encoding="utf-8") as f:
+        f.write(json.dumps({**metadata, "file": filename}) + "\n")
+
+    profiles = sorted(name for name in os.listdir(PROFILE_DIR) if name.endswith(".speedscope.json"))
+    for old in profiles[:max(0, len(profiles) - PROFILE_MAX_FILES)]:
+        os.remove(os.path.join(PROFILE_DIR, old))
+    return filename
+
+class ProfilingMiddleware:
+    """ASGI middleware profiling selected HTTP requests; see PROFILE_TOKEN and PROFILE_SAMPLE_RATE"""
+
+    def __init__(self, app):
+        self.app = app
+        self.available = True
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.available or not _wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.warning("Request profiling requested but pyinstrument is not installed; disabling it")
+            self.available = False
+            await self.app(scope, receive, send)
+            return
+
+        # Async mode follows this request's task across awaits and leaves out other requests
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+        status = {"code": None}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        started_at = datetime.now(timezone.utc)
+        started = time.perf_counter()
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            profiler.stop()
+            duration_ms = (time.perf_counter() - started) * 1000
+            route = getattr(scope.get("route"), "path", None)
+            metadata = {
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": route,
+                "status": status["code"] or 500,
+                "duration_ms": round(duration_ms, 1),
+                "started_at": started_at.isoformat(),
+            }
+            try:
+                filename = await run_in_threadpool(_write_profile, profiler, metadata)
+                logger.info(f"Profiled {metadata['method']} {metadata['path']} ({duration_ms:.0f} ms): {filename}")
+            except Exception as e:
+                logger.error(f"Could not write request profile: {e}")
@@ -0,0 +1,174 @@
+"""
+Compact LLM prompts: system instructions compiled once per agent and response style,
+kept apart from the user content, and a token budget for that user content
+"""
+
+import os
+import threading
+from langchain_core.messages import SystemMessage, HumanMessage
+from usage import estimate_tokens
+
+# Estimated tokens of user content (conversation context plus message) per call
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+# Of an oversized text, the share kept from its start; the rest is kept from its end
+MESSAGE_HEAD_SHARE = 0.75   # the question usually comes first or last in a long message
+CONTEXT_HEAD_SHARE = 0.25   # the context starts with the summary and ends with the latest turns
+
+STYLES = ("concise", "detailed")
+DEFAULT_STYLE = "concise"
+
+AGENTS = {
+    "general": {
+        "role": "You are a helpful general health assistant.",
+        "concise": "Keep your answer brief and to the point (2-3 sentences max).",
+        "detailed": "Provide comprehensive information with examples and explanations.",
+        "format": "clear headings (## Heading), bullet points (- item) and bold keywords (*word*)",
+    },
+    "symptom": {
+        "role": "You are a symptom checker AI.",
+        "concise": "Give brief, direct answers (2-3 sentences max).",
+        "detailed": "Provide comprehensive analysis with multiple sections.",
+        "format": "sections (## Symptoms, ## Possible Causes, ## Next Steps), bullet points (- item) and bold important terms (*term*)",
+    },
+    "nutrition": {
+        "role": "You are a nutrition expert AI.",
+        "concise": "Keep advice brief and actionable (2-3 sentences max).",
+        "detailed": "Provide comprehensive guidance with examples and explanations.",
+        "format": "headings (## Diet Tips, ## Foods to Include, ## Foods to Avoid), bullet points for lists and bold nutrients and food names",
+    },
+    "mental-health": {
+        "role": "You are a mental health coach AI.",
+        "concise": "Give brief, supportive advice (2-3 sentences max).",
+        "detailed": "Provide comprehensive strategies with examples and resources.",
+        "format": "headings (## Coping Strategies, ## Resources, ## Self-Care), bullet points for advice and bold key ideas",
+    },
+}
+
+ASSESSMENT_TEMPLATE = "assess-symptoms"
+ASSESSMENT_SYSTEM = (
+    "You assess symptoms for a health app. Reply with only a JSON object with the fields "
+    'riskLevel ("low", "moderate", "high" or "urgent"), '
+    "conditions (list of {name, probability 0-100, description, urgent boolean}), "
+    "immediateActions, precautions, medications, lifestyleChanges, whenToSeekHelp "
+    "(lists of short strings) and followUp (string)."
+)
+
+def _compile_system(agent: dict, style: str) -> str:
+    # Only the selected style's instruction; the model never sees the other branch
+    return f"{agent['role']} {agent[style]}\n\nAlways format your response in Markdown with {agent['format']}."
+
+# Static system prompts, identical on every call so providers can cache them as a prefix
+SYSTEM_PROMPTS = {
+    f"{name}/{style}": _compile_system(agent, style)
+    for name, agent in AGENTS.items()
+    for style in STYLES
+}
+SYSTEM_PROMPTS[ASSESSMENT_TEMPLATE] = ASSESSMENT_SYSTEM
+
+class Prompt:
+    """One LLM call's prompt: the template's system instructions and the user content"""
+
+    def __init__(self, template: str, system: str, user: str, truncated: bool = False):
+        self.template = template
+        self.system = system
+        self.user = user
+        self.truncated = truncated
+
+    @property
+    def messages(self) -> list:
+        return [SystemMessage(content=self.system), HumanMessage(content=self.user)]
+
+    @property
+    def text(self) -> str:
+        # For token estimates and debugging
+        return f"{self.system}\n\n{self.user}"
+
+class PromptStats:
+    """Per-template prompt sizes observed in this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._templates = {}
+
+    def record(self, prompt: Prompt):
+        user_tokens = estimate_tokens(prompt.user)
+        with self._lock:
+            entry = self._templates.setdefault(prompt.template, {"calls": 0, "user_tokens": 0, "max_user_tokens": 0, "truncated": 0})
+            entry["calls"] += 1
+            entry["user_tokens"] += user_tokens
+            entry["max_user_tokens"] = max(entry["max_user_tokens"], user_tokens)
+            entry["truncated"] += int(prompt.truncated)
+
+    def report(self) -> dict:
+        """Static system tokens and observed user tokens per template"""
+        with self._lock:
+            observed = {name: dict(entry) for name, entry in self._templates.items()}
+        templates = {}
+        for name, system in SYSTEM_PROMPTS.items():
+            entry = observed.get(name, {"calls": 0, "user_tokens": 0, "max_user_tokens": 0, "truncated": 0})
+            calls = entry["calls"]
+            templates[name] = {
+                "system_tokens": estimate_tokens(system),
+                "calls": calls,
+                "avg_user_tokens": round(entry["user_tokens"] / calls, 1) if calls else None,
+                "max_user_tokens": entry["max_user_tokens"],
+                "truncated": entry["truncated"],
+            }
+        return {"token_budget": PROMPT_TOKEN_BUDGET, "templates": templates}
+
+prompt_stats = PromptStats()
+
+def _clip(text: str, tokens: int, head_share: float) -> str:
+    """Text cut to about `tokens`, keeping its start and end around an omission marker"""
+    if estimate_tokens(text) <= tokens:
+        return text
+    if tokens <= 0:
+        return ""
+    chars = tokens * 4
+    head = text[:int(chars * head_share)]
+    tail = text[len(text) - (chars - len(head)):]
+    # Cut at word boundaries where there are any
+    if " " in head:
+        head = head.rsplit(" ", 1)[0]
+    if " " in tail:
+        tail = tail.split(" ", 1)[1]
+    omitted = len(text) - len(head) - len(tail)
+    return f"{head}\n[... {omitted} characters omitted ...]\n{tail}"
+
+def fit_to_budget(message: str, context: str = "", budget: int = None):
+    """(message, context, truncated) within `budget` estimated tokens; context gives way first"""
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    message_tokens = estimate_tokens(message)
+    context_tokens = estimate_tokens(context) if context else 0
+    if message_tokens + context_tokens <= budget:
+        return message, context, False
+    # The message keeps at least half of the budget, or all it needs when that is less
+    message = _clip(message, max(budget - context_tokens, min(message_tokens, budget // 2)), MESSAGE_HEAD_SHARE)
+    if context:
+        context = _clip(context, budget - estimate_tokens(message), CONTEXT_HEAD_SHARE)
+        if context and not context.endswith("\n\n"):
+            context += "\n\n"
+    return message, context, True
+
+def build_chat_prompt(agent_type: str, message: str, response_style: str = DEFAULT_STYLE, context: str = "") -> Prompt:
+    """Prompt of a chat turn; unknown agents and styles fall back to general / concise"""
+    agent = agent_type if agent_type in AGENTS else "general"
+    style = response_style if response_style in STYLES else DEFAULT_STYLE
+    message, context, truncated = fit_to_budget(message, context)
+    prompt = Prompt(f"{agent}/{style}", SYSTEM_PROMPTS[f"{agent}/{style}"], f"{context}User: {message}", truncated)
+    prompt_stats.record(prompt)
+    return prompt
+
+def build_assessment_prompt(symptom_text: str) -> Prompt:
+    """Prompt of a structured symptom assessment"""
+    symptom_text, _, truncated = fit_to_budget(symptom_text)
+    prompt = Prompt(ASSESSMENT_TEMPLATE, ASSESSMENT_SYSTEM, f"Symptoms: {symptom_text}", truncated)
+    prompt_stats.record(prompt)
+    return prompt
+
+if __name__ == "__main__":
+    # python prompts.py: static prompt size per template
+    print(f"{'template':<24} {'chars':>6} {'tokens':>7}")
+    for name, system in SYSTEM_PROMPTS.items():
+        print(f"{name:<24} {len(system):>6} {estimate_tokens(system):>7}")
+    print(f"User content budget: {PROMPT_TOKEN_BUDGET} tokens")
@@ -0,0 +1,79 @@
+"""
+Fast read path for list endpoints: only the needed columns as Core rows, serialized
+straight to JSON bytes (orjson when it is installed) without jsonable_encoder
+"""
+
+import json
+from datetime import date, datetime
+from fastapi import Response
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from models import User, ChatSession, ChatMessage, Medication
+from partitions import session_messages_bound
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MEDICATION_COLUMNS = (
+    Medication.id, Medication.name, Medication.dosage, Medication.frequency, Medication.prescribedBy,
+    Medication.startDate, Medication.endDate, Medication.totalDoses, Medication.instructions,
+    Medication.schedule, Medication.next_due_at,
+)
+
+def serialize_medication(med) -> dict:
+    """API form of a medication; takes ORM objects and rows of MEDICATION_COLUMNS alike"""
+    return {
+        "id": med.id,
+        "name": med.name,
+        "dosage": med.dosage,
+        "frequency": med.frequency,
+        "prescribedBy": med.prescribedBy,
+        "startDate": med.startDate,
+        "endDate": med.endDate,
+        "totalDoses": med.totalDoses,
+        "instructions": med.instructions,
+        "schedule": med.schedule,
+        "nextDueAt": med.next_due_at
+    }
+
+def medication_rows(db: Session, user_id: int) -> list:
+    return db.execute(
+        select(*MEDICATION_COLUMNS).where(Medication.user_id == user_id)
+    ).all()
+
+def chat_message_rows(db: Session, session_id: str) -> list:
+    """Messages of a chat session, by its numeric id or its session_id string"""
+    query = select(
+        ChatMessage.id, ChatMessage.message_type, ChatMessage.content,
+        ChatMessage.message_metadata, ChatMessage.timestamp.label("created_at"),
+    ).join(ChatSession, ChatSession.id == ChatMessage.session_id).where(
+        session_messages_bound(ChatSession.created_at)
+    )
+    if session_id.isdigit():
+        query = query.where(ChatSession.id == int(session_id))
+    else:
+        query = query.where(ChatSession.session_id == session_id)
+    return db.execute(query.order_by(ChatMessage.id)).all()
+
+def user_rows(db: Session) -> list:
+    return db.execute(select(User.id, User.username, User.email).order_by(User.id)).all()
+
+def _default(value):
+    # The types the stdlib encoder does not know, formatted like jsonable_encoder does
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def json_bytes(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def json_response(content, status_code: int = 200) -> Response:
+    """
+    Pre-serialized JSON response. FastAPI passes Response objects through untouched, so the
+    endpoint's response_model only documents the shape and costs nothing per request.
+    """
+    return Response(content=json_bytes(content), status_code=status_code, media_type="application/json")
@@ -0,0 +1,390 @@
+"""
+Medication reminders: frequency text parsed into schedules, an indexed next_due_at per
+medication, and a heap scheduler per process that turns due medications into reminders
+"""
+
+import os
+import re
+import time
+import heapq
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+from database import SessionLocal
+from models import Medication, MedicationReminder, DataMigration
+
+logger = logging.getLogger(__name__)
+
+REMINDER_SCHEDULER_ENABLED = os.getenv("REMINDER_SCHEDULER_ENABLED", "1") != "0"
+# Wall-clock zone of the schedule times ("08:00" means 08:00 there); stored times are UTC
+REMINDER_TIMEZONE = ZoneInfo(os.getenv("REMINDER_TIMEZONE", "UTC"))
+# A reminder missed by more than this (e.g. while no server ran) is skipped, not sent late
+REMINDER_MAX_LATENESS = timedelta(minutes=int(os.getenv("REMINDER_MAX_LATENESS_MINUTES", "60")))
+REMINDER_RETENTION_HOURS = int(os.getenv("REMINDER_RETENTION_HOURS", "24"))
+# The heap holds the medications due within the next two load intervals
+REMINDER_LOAD_INTERVAL_SECONDS = float(os.getenv("REMINDER_LOAD_INTERVAL_SECONDS", "30"))
+REMINDER_LOAD_LIMIT = 10000
+# Long-pollers look for reminders fired by other processes this often
+REMINDER_POLL_SECONDS = 1.0
+MAINTENANCE_INTERVAL_SECONDS = 300
+BACKFILL_BATCH_SIZE = 500
+BACKFILL_MIGRATION = "medication_schedules"
+
+# Default times of day for "N times daily"
+DAILY_TIMES = {
+    1: ["09:00"],
+    2: ["09:00", "21:00"],
+    3: ["08:00", "14:00", "20:00"],
+    4: ["08:00", "12:00", "16:00", "20:00"],
+}
+TIME_WORDS = {"morning": "08:00", "noon": "12:00", "lunch": "12:00", "afternoon": "15:00",
+              "evening": "18:00", "dinner": "18:00", "night": "22:00", "bedtime": "22:00"}
+COUNT_WORDS = {"once": 1, "one": 1, "twice": 2, "two": 2, "thrice": 3, "three": 3, "four": 4,
+               "five": 5, "six": 6}
+# Latin prescription abbreviations
+ABBREVIATIONS = {"qd": 1, "od": 1, "bid": 2, "tid": 3, "qid": 4}
+
+AS_NEEDED = re.compile(r"\b(as needed|when needed|if needed|prn|as required)\b")
+CLOCK_TIME = re.compile(r"\b(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b|\b(\d{1,2}):(\d{2})\b")
+EVERY = re.compile(r"\bevery\s+(\d+|other)?\s*(hour|day|week)s?\b")
+Q_HOURS = re.compile(r"\bq\s*(\d+)\s*h\b")
+TIMES_PER_DAY = re.compile(r"\b(\d+|once|one|twice|two|thrice|three|four|five|six)(?:\s*(?:times|x))?\s*(?:a|per|each|/)?\s*(?:day|daily)\b")
+WORD = re.compile(r"[a-z]+")
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _naive_utc(value):
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _spaced(count: int) -> list:
+    """`count` times a day, evenly spaced from 08:00"""
+    step = 24 * 60 // count
+    return sorted(f"{(8 * 60 + n * step) // 60 % 24:02d}:{(8 * 60 + n * step) % 60:02d}" for n in range(count))
+
+def _every_hours(hours: int) -> dict:
+    if hours < 24 and 24 % hours == 0:
+        # Fixed clock times, so the reminders do not drift with when the medication was added
+        return {"times": _spaced(24 // hours)}
+    if hours % 24 == 0:
+        days = hours // 24
+        return {"times": DAILY_TIMES[1]} if days == 1 else {"every_days": days, "times": DAILY_TIMES[1]}
+    return {"every_hours": hours}
+
+def parse_frequency(frequency: str) -> dict:
+    """
+    Schedule for a frequency text: {"times": ["08:00", ...]}, {"every_hours": n} or
+    {"every_days": n, "times": [...]}; {} when it has no fixed times (as needed, unknown).
+    """
+    text = (frequency or "").lower()
+    if not text or AS_NEEDED.search(text):
+        return {}
+
+    clock_times = []
+    for hour, minute, meridiem, hour24, minute24 in CLOCK_TIME.findall(text):
+        if meridiem:
+            hour = int(hour) % 12 + (12 if meridiem == "pm" else 0)
+            clock_times.append(f"{hour:02d}:{int(minute or 0):02d}")
+        elif int(hour24) < 24 and int(minute24) < 60:
+            clock_times.append(f"{int(hour24):02d}:{int(minute24):02d}")
+    word_times = [TIME_WORDS[word] for word in WORD.findall(text) if word in TIME_WORDS]
+    times = sorted(set(clock_times or word_times))
+
+    every = EVERY.search(text)
+    if every:
+        amount = 2 if every.group(1) == "other" else int(every.group(1) or 1)
+        if amount <= 0:
+            return {}
+        if every.group(2) == "hour":
+            return _every_hours(amount)
+        days = amount * (7 if every.group(2) == "week" else 1)
+        if days == 1:
+            return {"times": times or DAILY_TIMES[1]}
+        return {"every_days": days, "times": times or DAILY_TIMES[1]}
+    q_hours = Q_HOURS.search(text)
+    if q_hours and int(q_hours.group(1)) > 0:
+        return _every_hours(int(q_hours.group(1)))
+    if re.search(r"\b(weekly|once a week)\b", text):
+        return {"every_days": 7, "times": times or DAILY_TIMES[1]}
+
+    count = None
+    per_day = TIMES_PER_DAY.search(text)
+    if per_day:
+        count = COUNT_WORDS.get(per_day.group(1)) or int(per_day.group(1))
+    else:
+        for word in WORD.findall(text):
+            if word in ABBREVIATIONS:
+                count = ABBREVIATIONS[word]
+                break
+    if count is None and (times or "daily" in text or "every day" in text):
+        count = len(times) or 1
+    if not count or count > 24:
+        return {}
+    # Named times win when they match the count ("twice daily, morning and night")
+    return {"times": times if len(times) == count else DAILY_TIMES.get(count) or _spaced(count)}
+
+def next_due(schedule: dict, after: datetime, start: datetime = None, end: datetime = None):
+    """First scheduled time strictly after `after` (naive UTC), or None"""
+    if not schedule:
+        return None
+    start, end = _naive_utc(start), _naive_utc(end)
+    if start is not None and start > after:
+        # Nothing is due before the medication starts
+        after = start - timedelta(microseconds=1)
+    due = None
+    if "every_hours" in schedule:
+        interval = timedelta(hours=schedule["every_hours"])
+        anchor = start or after
+        due = anchor + interval * ((after - anchor) // interval + 1)
+    else:
+        every_days = schedule.get("every_days", 1)
+        local_after = after.replace(tzinfo=timezone.utc).astimezone(REMINDER_TIMEZONE)
+        first_day = (start.replace(tzinfo=timezone.utc).astimezone(REMINDER_TIMEZONE).date()
+                     if start is not None else local_after.date())
+        day = local_after.date()
+        for _ in range(every_days + 1):
+            if (day - first_day).days % every_days == 0:
+                for clock in schedule["times"]:
+                    hour, minute = map(int, clock.split(":"))
+                    local = datetime(day.year, day.month, day.day, hour, minute, tzinfo=REMINDER_TIMEZONE)
+                    candidate = local.astimezone(timezone.utc).replace(tzinfo=None)
+                    if candidate > after:
+                        due = candidate
+                        break
+                if due is not None:
+                    break
+            day += timedelta(days=1)
+    if due is not None and end is not None and due > end:
+        return None
+    return due
+
+def schedule_medication(medication: Medication, now: datetime = None):
+    """Set schedule and next_due_at from the medication's frequency and dates"""
+    medication.schedule = parse_frequency(medication.frequency)
+    medication.next_due_at = next_due(medication.schedule, now or _now(), medication.startDate, medication.endDate)
+
+def serialize_reminder(reminder: MedicationReminder, medication: Medication) -> dict:
+    return {
+        "id": reminder.id,
+        "medicationId": medication.id,
+        "name": medication.name,
+        "dosage": medication.dosage,
+        "instructions": medication.instructions,
+        "dueAt": reminder.due_at,
+    }
+
+class ReminderScheduler:
+    """Fires reminders for due medications; safe to run in every process"""
+
+    def __init__(self):
+        self._heap = []      # (due_at, medication_id)
+        self._queued = {}    # medication_id -> due_at currently in the heap
+        self._tasks = []
+        self._wakeup = None
+        self._fired_event = None
+        self.fired = 0
+        self.skipped = 0
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._fired_event = asyncio.Event()
+        if not REMINDER_SCHEDULER_ENABLED:
+            return
+        self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._maintain())]
+        logger.info("Started medication reminder scheduler")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _push(self, medication_id: str, due_at: datetime):
+        if self._queued.get(medication_id) == due_at:
+            return
+        # A superseded entry stays in the heap and is ignored when popped
+        self._queued[medication_id] = due_at
+        heapq.heappush(self._heap, (due_at, medication_id))
+
+    def schedule(self, medication_id: str, due_at):
+        """Pick up a medication created or changed in this process right away"""
+        if due_at is None or self._wakeup is None:
+            return
+        if due_at <= _now() + timedelta(seconds=2 * REMINDER_LOAD_INTERVAL_SECONDS):
+            self._push(medication_id, due_at)
+            self._wakeup.set()
+
+    def _load_due(self, until: datetime) -> list:
+        db = SessionLocal()
+        try:
+            # Range scan of ix_medications_next_due_at; never touches medications due later
+            return db.execute(
+                select(Medication.id, Medication.next_due_at)
+                .where(Medication.next_due_at <= until)
+                .order_by(Medication.next_due_at)
+                .limit(REMINDER_LOAD_LIMIT)
+            ).all()
+        finally:
+            db.close()
+
+    def _fire(self, batch: dict) -> int:
+        """Advance each medication past its due time and record its reminder; returns reminders created"""
+        db = SessionLocal()
+        try:
+            now = _now()
+            created = 0
+            medications = db.query(Medication).filter(Medication.id.in_(list(batch))).all()
+            for medication in medications:
+                due_at = batch[medication.id]
+                if medication.next_due_at != due_at:
+                    continue
+                late = now - due_at > REMINDER_MAX_LATENESS
+                following = next_due(medication.schedule, now if late else due_at,
+                                     medication.startDate, medication.endDate)
+                # Other processes may hold the same entry; only one update matches
+                claimed = db.query(Medication).filter(
+                    Medication.id == medication.id,
+                    Medication.next_due_at == due_at
+                ).update({"next_due_at": following}, synchronize_session=False)
+                if not claimed:
+                    continue
+                if late:
+                    self.skipped += 1
+                    continue
+                db.add(MedicationReminder(user_id=medication.user_id, medication_id=medication.id,
+                                          due_at=due_at, created_at=now))
+                created += 1
+            db.commit()
+            return created
+        finally:
+            db.close()
+
+    async def _run(self):
+        next_load = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_load:
+                    horizon = _now() + timedelta(seconds=2 * REMINDER_LOAD_INTERVAL_SECONDS)
+                    rows = await run_in_threadpool(self._load_due, horizon)
+                    for medication_id, due_at in rows:
+                        self._push(medication_id, due_at)
+                    # A full load means a backlog; load again as soon as this part is fired
+                    next_load = time.monotonic() + (0 if len(rows) == REMINDER_LOAD_LIMIT else REMINDER_LOAD_INTERVAL_SECONDS)
+
+                now = _now()
+                batch = {}
+                while self._heap and self._heap[0][0] <= now:
+                    due_at, medication_id = heapq.heappop(self._heap)
+                    if self._queued.get(medication_id) == due_at:
+                        del self._queued[medication_id]
+                        batch[medication_id] = due_at
+                if batch:
+                    created = await run_in_threadpool(self._fire, batch)
+                    if created:
+                        self.fired += created
+                        # Wake every long-poller in this process; they re-read their reminders
+                        fired, self._fired_event = self._fired_event, asyncio.Event()
+                        fired.set()
+
+                sleep = next_load - time.monotonic()
+                if self._heap:
+                    sleep = min(sleep, (self._heap[0][0] - _now()).total_seconds())
+                if sleep > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), sleep)
+                    except asyncio.TimeoutError:
+                        pass
+                self._wakeup.clear()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Reminder scheduler error: {e}")
+                await asyncio.sleep(REMINDER_POLL_SECONDS)
+
+    def _backfill_schedules(self):
+        """Parse the frequency of medications created before schedules existed, in keyset batches"""
+        db = SessionLocal()
+        try:
+            if db.query(DataMigration.status).filter(DataMigration.name == BACKFILL_MIGRATION).scalar() == "done":
+                return
+            after = ""
+            now = _now()
+            updated = 0
+            while True:
+                medications = db.query(Medication).filter(
+                    Medication.id > after,
+                    Medication.schedule.is_(None)
+                ).order_by(Medication.id).limit(BACKFILL_BATCH_SIZE).all()
+                if not medications:
+                    break
+                for medication in medications:
+                    schedule_medication(medication, now)
+                after = medications[-1].id
+                updated += len(medications)
+                db.commit()
+            db.merge(DataMigration(name=BACKFILL_MIGRATION, status="done", rows_done=updated,
+                                   started_at=now, updated_at=_now(), finished_at=_now()))
+            db.commit()
+            if updated:
+                logger.info(f"Scheduled reminders for {updated} existing medications")
+        finally:
+            db.close()
+
+    def _purge(self):
+        db = SessionLocal()
+        try:
+            purged = db.query(MedicationReminder).filter(
+                MedicationReminder.created_at < _now() - timedelta(hours=REMINDER_RETENTION_HOURS)
+            ).delete(synchronize_session=False)
+            db.commit()
+            if purged:
+                logger.info(f"Purged {purged} old medication reminders")
+        finally:
+            db.close()
+
+    async def _maintain(self):
+        while True:
+            try:
+                await run_in_threadpool(self._backfill_schedules)
+                await run_in_threadpool(self._purge)
+            except Exception as e:
+                logger.error(f"Reminder maintenance error: {e}")
+            await asyncio.sleep(MAINTENANCE_INTERVAL_SECONDS)
+
+    def _pending(self, user_id: int, after: int) -> list:
+        db = SessionLocal()
+        try:
+            rows = db.query(MedicationReminder, Medication).join(
+                Medication, Medication.id == MedicationReminder.medication_id
+            ).filter(
+                MedicationReminder.user_id == user_id,
+                MedicationReminder.id > after
+            ).order_by(MedicationReminder.id).limit(100).all()
+            return [serialize_reminder(reminder, medication) for reminder, medication in rows]
+        finally:
+            db.close()
+
+    async def wait(self, user_id: int, after: int, timeout: float) -> list:
+        """The user's reminders after id `after`, waiting up to `timeout` seconds for one (long polling)"""
+        deadline = time.monotonic() + timeout
+        while True:
+            # Take the event before reading, so a reminder fired in between is not missed
+            fired = self._fired_event
+            reminders = await run_in_threadpool(self._pending, user_id, after)
+            remaining = deadline - time.monotonic()
+            if reminders or remaining <= 0 or fired is None:
+                return reminders
+            try:
+                await asyncio.wait_for(fired.wait(), min(remaining, REMINDER_POLL_SECONDS))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {"queued": len(self._queued), "fired": self.fired, "skipped_late": self.skipped}
+
+reminder_scheduler = ReminderScheduler()
@@ -0,0 +1,116 @@
+"""
+Full-text search over a user's chat messages (PostgreSQL tsvector + GIN, or FTS5 in SQLite mode)
+"""
+
+import re
+from sqlalchemy import DateTime, text
+from sqlalchemy.orm import Session
+
+# Markers wrapped around matched terms in highlights - bold in the Markdown the UI renders
+HIGHLIGHT_OPTIONS = "StartSel=**, StopSel=**, MaxFragments=2, MaxWords=30, MinWords=10, FragmentDelimiter=\" … \""
+
+# Ranking only touches rows the GIN index matched for this user; ts_headline (which
+# re-parses the document) runs on the requested page only.
+SEARCH_SQL = text("""
+    WITH query AS (
+        SELECT websearch_to_tsquery('english', :query) AS q
+    ),
+    hits AS (
+        SELECT m.id, m.message_type, m.content, m.timestamp,
+               s.session_id, s.agent_type,
+               ts_rank_cd(m.content_tsv, query.q) AS rank
+        FROM chat_messages m
+        JOIN chat_sessions s ON s.id = m.session_id
+        CROSS JOIN query
+        WHERE s.user_id = :user_id
+          AND m.content_tsv @@ query.q
+        ORDER BY rank DESC, m.id DESC
+        LIMIT :limit OFFSET :offset
+    )
+    SELECT hits.id, hits.message_type, hits.timestamp, hits.session_id, hits.agent_type, hits.rank,
+           ts_headline('english', hits.content, query.q, :options) AS highlight
+    FROM hits CROSS JOIN query
+    ORDER BY hits.rank DESC, hits.id DESC
+""")
+
+# bm25() is lower for better matches; negated, rank sorts like ts_rank_cd does
+SQLITE_SEARCH_SQL = text("""
+    SELECT m.id, m.message_type, m.timestamp, s.session_id, s.agent_type,
+           -bm25(chat_messages_fts) AS rank,
+           snippet(chat_messages_fts, 0, '**', '**', ' … ', 30) AS highlight
+    FROM chat_messages_fts
+    JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+    JOIN chat_sessions s ON s.id = m.session_id
+    WHERE chat_messages_fts MATCH :query
+      AND s.user_id = :user_id
+    ORDER BY rank DESC, m.id DESC
+    LIMIT :limit OFFSET :offset
+""").columns(timestamp=DateTime)
+
+# Quoted phrases and bare words, each optionally negated with a leading "-"
+WEB_QUERY_TERM = re.compile(r'(-?)"([^"]*)"|(-?)(\w+)')
+
+def fts5_query(query: str) -> str:
+    """
+    A web-style query (words, "quoted phrases", or, -excluded) in FTS5 syntax. Every term
+    is quoted, so user input never reaches FTS5's own operators; "" when nothing is left.
+    """
+    parts = []
+    for phrase_negated, phrase, word_negated, word in WEB_QUERY_TERM.findall(query):
+        if word.lower() == "or" and not word_negated:
+            if parts and parts[-1] != "OR":
+                parts.append("OR")
+            continue
+        tokens = re.findall(r"\w+", phrase or word)
+        if not tokens:
+            continue
+        term = '"' + " ".join(tokens) + '"'
+        if phrase_negated or word_negated:
+            # FTS5's NOT is binary: an exclusion needs a term to exclude from
+            if parts and parts[-1] != "OR":
+                parts.append(f"NOT {term}")
+            continue
+        parts.append(term)
+    while parts and parts[-1] == "OR":
+        parts.pop()
+    return " ".join(parts)
+
+def search_chat_messages(db: Session, user_id: int, query: str, page: int = 1, page_size: int = 20) -> dict:
+    """Ranked, highlighted page of the user's messages matching a web-style query"""
+    offset = (page - 1) * page_size
+    # Fetch one extra row to know whether another page exists without a COUNT(*)
+    if db.get_bind().dialect.name == "sqlite":
+        match = fts5_query(query)
+        rows = db.execute(SQLITE_SEARCH_SQL, {
+            "query": match,
+            "user_id": user_id,
+            "limit": page_size + 1,
+            "offset": offset,
+        }).mappings().all() if match else []
+    else:
+        rows = db.execute(SEARCH_SQL, {
+            "query": query,
+            "user_id": user_id,
+            "limit": page_size + 1,
+            "offset": offset,
+            "options": HIGHLIGHT_OPTIONS,
+        }).mappings().all()
+
+    return {
+        "query": query,
+        "page": page,
+        "page_size": page_size,
+        "has_more": len(rows) > page_size,
+        "results": [
+            {
+                "message_id": row["id"],
+                "session_id": row["session_id"],
+                "agent_type": row["agent_type"],
+                "message_type": row["message_type"],
+                "timestamp": row["timestamp"],
+                "rank": float(row["rank"]),
+                "highlight": row["highlight"],
+            }
+            for row in rows[:page_size]
+        ],
+    }
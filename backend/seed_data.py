@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Synthetic production-like data for scale testing: users, chat sessions and messages,
+medications and dose events, with skewed per-user activity
+
+A few heavy users own most of the sessions and messages (Pareto-distributed activity),
+many users never chat or take no medication, and conversations and answers vary in
+length, so pagination, indexes and query plans see realistic shapes. Rows are loaded
+with COPY on PostgreSQL and batched multi-row INSERTs elsewhere, in chunks of users
+that are committed one at a time.
+
+Usage:
+    python seed_data.py --users 100000                 # ~millions of messages and dose events
+    python seed_data.py --users 1000 --sessions 2 --seed 7
+
+Seeded users are named synthetic_<id> and have the password "password".
+"""
+
+import argparse
+import csv
+import io
+import json
+import logging
+import math
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text, func, select
+from database import engine
+from models import Base
+from interactions import INTERACTIONS_DATA_PATH
+from reminders import next_due, parse_frequency
+
+logger = logging.getLogger(__name__)
+
+# Share of users who never chat / have no medications
+INACTIVE_CHAT_SHARE = 0.3
+NO_MEDICATION_SHARE = 0.4
+# Pareto shape of per-user activity; lower is more skewed (with 1.5 the top 20% of
+# chatting users own about three quarters of the messages)
+ACTIVITY_SHAPE = 1.5
+ACTIVITY_MEAN = ACTIVITY_SHAPE / (ACTIVITY_SHAPE - 1)
+# Sessions are more likely in recent days: the age in days is exponential with this mean
+SESSION_AGE_MEAN_DAYS = 60
+
+AGENT_WEIGHTS = {"general": 0.45, "symptom": 0.3, "nutrition": 0.15, "mental-health": 0.1}
+# Frequencies offered by the medication form, with their doses per day
+FREQUENCIES = {"Once daily": 1, "Twice daily": 2, "Three times daily": 3,
+               "Every 12 hours": 2, "Every 8 hours": 3, "Every 6 hours": 4, "Every 4 hours": 6}
+DOSAGES = ["5 mg", "10 mg", "20 mg", "25 mg", "50 mg", "100 mg", "200 mg", "250 mg", "400 mg", "500 mg", "1 g"]
+PRESCRIBERS = ["Dr. Smith", "Dr. Patel", "Dr. Garcia", "Dr. Chen", "Dr. Okafor", "Dr. Müller", "Dr. Rossi", "Self"]
+
+QUESTIONS = {
+    "general": [
+        "How much sleep do I need at {age}?", "Is it safe to exercise with a {symptom}?",
+        "What vaccines are recommended for adults over {age}?", "How can I lower my blood pressure naturally?",
+        "Should I see a doctor about {symptom} that lasts {days} days?",
+    ],
+    "symptom": [
+        "I have had a {symptom} for {days} days, what could it be?", "{symptom} and {symptom2} since yesterday",
+        "My child has a {symptom} and {symptom2}, should I worry?", "Sudden {symptom} after eating, is that normal?",
+        "Recurring {symptom} every morning for {days} days",
+    ],
+    "nutrition": [
+        "What should I eat to get more {nutrient}?", "Is a {diet} diet healthy long term?",
+        "How much {nutrient} do I need per day?", "Good breakfast ideas for a {diet} diet",
+        "Can {food} help with {symptom}?",
+    ],
+    "mental-health": [
+        "I feel anxious before work every day", "How can I sleep better when I am stressed?",
+        "Tips to cope with {feeling} after a breakup", "Is it normal to feel {feeling} in winter?",
+        "How do I talk to my doctor about {feeling}?",
+    ],
+}
+SLOTS = {
+    "symptom": ["headache", "cough", "fever", "sore throat", "back pain", "rash", "dizziness", "nausea",
+                "stomach ache", "fatigue", "chest tightness", "runny nose", "joint pain", "insomnia"],
+    "nutrient": ["protein", "iron", "fiber", "vitamin D", "calcium", "omega-3", "magnesium", "B12"],
+    "diet": ["vegetarian", "vegan", "keto", "mediterranean", "low-carb", "gluten-free", "high-protein"],
+    "food": ["ginger", "honey", "green tea", "turmeric", "yogurt", "garlic", "oatmeal"],
+    "feeling": ["sad", "overwhelmed", "lonely", "irritable", "unmotivated", "nervous"],
+}
+ANSWER_SENTENCES = [
+    "## Possible Causes", "## What You Can Do", "## When to Seek Help",
+    "- **Rest and hydration** help most mild cases improve within a few days.",
+    "- Keep a diary of when it happens, what you ate and how you slept.",
+    "- Over-the-counter *acetaminophen* or *ibuprofen* can ease the pain; follow the label.",
+    "Most cases are not serious and get better on their own.",
+    "Seek urgent care if it comes with a high fever, confusion or trouble breathing.",
+    "A balanced diet with vegetables, whole grains and lean protein covers most needs.",
+    "Regular exercise, even a 20 minute walk, improves sleep and mood.",
+    "If symptoms last longer than a week, book an appointment with your doctor.",
+    "Talking to someone you trust, or a counselor, can make a real difference.",
+    "- Limit caffeine and alcohol, especially in the evening.",
+    "- Aim for 7 to 9 hours of sleep on a regular schedule.",
+]
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _drug_names() -> list:
+    with open(INTERACTIONS_DATA_PATH, encoding="utf-8") as f:
+        return sorted(json.load(f)["drugs"])
+
+class Generator:
+    """Rows for consecutive users, with ids assigned here so children need no lookups"""
+
+    def __init__(self, rng: random.Random, next_ids: dict, args, password_hash: str):
+        self.rng = rng
+        self.ids = next_ids
+        self.args = args
+        self.password_hash = password_hash
+        self.now = _now()
+        self.drugs = _drug_names()
+        # What schedule_medication would store, parsed once per offered frequency
+        self.schedules = {frequency: parse_frequency(frequency) for frequency in FREQUENCIES}
+        self.agents = list(AGENT_WEIGHTS)
+        self.agent_weights = list(AGENT_WEIGHTS.values())
+
+    def _next(self, table: str) -> int:
+        value = self.ids[table]
+        self.ids[table] += 1
+        return value
+
+    def _activity(self) -> float:
+        # Capped so one user cannot dominate a small run
+        return min(self.rng.paretovariate(ACTIVITY_SHAPE), 50.0) / ACTIVITY_MEAN
+
+    def _question(self, agent: str) -> str:
+        template = self.rng.choice(QUESTIONS[agent])
+        slots = {name: self.rng.choice(values) for name, values in SLOTS.items()}
+        slots["symptom2"] = self.rng.choice(SLOTS["symptom"])
+        return template.format(age=self.rng.randint(18, 85), days=self.rng.randint(1, 14), **slots)
+
+    def _answer(self) -> str:
+        # Log-normal length: mostly short, some long "detailed" answers
+        sentences = max(2, min(40, int(self.rng.lognormvariate(1.6, 0.6))))
+        return "\n".join(self.rng.choice(ANSWER_SENTENCES) for _ in range(sentences))
+
+    def user(self, rows: dict):
+        user_id = self._next("users")
+        created = self.now - timedelta(days=self.rng.uniform(0, self.args.days))
+        rows["users"].append((user_id, f"synthetic_{user_id}", f"synthetic_{user_id}@example.com",
+                              self.password_hash, f"Synthetic User {user_id}", None, True, created, None))
+        if self.rng.random() >= INACTIVE_CHAT_SHARE:
+            self._sessions(rows, user_id, created)
+        if self.rng.random() >= NO_MEDICATION_SHARE:
+            self._medications(rows, user_id, created)
+
+    def _sessions(self, rows: dict, user_id: int, user_created: datetime):
+        activity = self._activity()
+        count = max(1, round(self.args.sessions * activity))
+        span = (self.now - user_created).total_seconds()
+        for _ in range(count):
+            session_pk = self._next("chat_sessions")
+            agent = self.rng.choices(self.agents, self.agent_weights)[0]
+            age = min(span, self.rng.expovariate(1 / (SESSION_AGE_MEAN_DAYS * 86400)))
+            started = self.now - timedelta(seconds=age)
+            # Heavy users also hold longer conversations
+            turns = 1 + int(self.rng.expovariate(1 / max(0.1, (self.args.turns - 1) * math.sqrt(activity))))
+            rows["chat_sessions"].append((session_pk, user_id, f"session_{started:%Y%m%d_%H%M%S}_{self.rng.getrandbits(32):08x}",
+                                          agent, started, None, 0, turns))
+            at = started
+            for _ in range(turns):
+                rows["chat_messages"].append((self._next("chat_messages"), session_pk, "user",
+                                              self._question(agent), at, {"agent_type": agent}))
+                at += timedelta(seconds=self.rng.uniform(2, 20))
+                answer = self._answer()
+                rows["chat_messages"].append((self._next("chat_messages"), session_pk, "assistant", answer, at, {
+                    "agent_type": agent, "model": "gemini-1.5-flash",
+                    "prompt_tokens": self.rng.randint(80, 600), "completion_tokens": len(answer) // 4,
+                }))
+                at += timedelta(seconds=self.rng.expovariate(1 / 90))
+
+    def _medications(self, rows: dict, user_id: int, user_created: datetime):
+        count = min(15, max(1, round(self.args.medications * self._activity())))
+        # Some users take every dose, others forget half of them
+        adherence = self.rng.betavariate(5, 2)
+        today = self.now.date()
+        for _ in range(count):
+            medication_id = str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+            frequency = self.rng.choice(list(FREQUENCIES))
+            start = user_created + timedelta(days=self.rng.uniform(0, max(0.0, (self.now - user_created).days)))
+            end = start + timedelta(days=self.rng.choice([7, 10, 14, 30, 90])) if self.rng.random() < 0.4 else None
+            per_day = FREQUENCIES[frequency]
+            # Set like the API sets them: the reminder backfill has long finished on a live database
+            schedule = self.schedules[frequency]
+            rows["medications"].append((medication_id, user_id, self.rng.choice(self.drugs).title(),
+                                        self.rng.choice(DOSAGES), frequency, self.rng.choice(PRESCRIBERS),
+                                        start, end, None, None, start, schedule, next_due(schedule, self.now, start, end)))
+            first = max(start.date(), today - timedelta(days=self.args.dose_days))
+            last = min(today, end.date()) if end else today
+            day = first
+            while day <= last:
+                taken = sum(self.rng.random() < adherence for _ in range(per_day))
+                if taken:
+                    rows["dose_events"].append((self._next("dose_events"), medication_id, user_id, day, taken,
+                                                datetime.combine(day, datetime.min.time()) + timedelta(hours=20)))
+                day += timedelta(days=1)
+
+# Columns per table, in the order the generator emits them
+COLUMNS = {
+    "users": ["id", "username", "email", "password_hash", "full_name", "date_of_birth", "is_active",
+              "created_at", "daily_token_budget"],
+    "chat_sessions": ["id", "user_id", "session_id", "agent_type", "created_at", "summary", "summary_turns", "turn_count"],
+    "chat_messages": ["id", "session_id", "message_type", "content", "timestamp", "message_metadata"],
+    "medications": ["id", "user_id", "name", "dosage", "frequency", "prescribedBy", "startDate", "endDate",
+                    "totalDoses", "instructions", "created_at", "schedule", "next_due_at"],
+    "dose_events": ["id", "medication_id", "user_id", "date", "count", "updated_at"],
+}
+# Parents before children
+LOAD_ORDER = ["users", "chat_sessions", "chat_messages", "medications", "dose_events"]
+SERIAL_TABLES = ["users", "chat_sessions", "chat_messages", "dose_events"]
+
+def _csv_value(value):
+    if value is None:
+        return r"\N"
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return value
+
+def _copy(conn, table: str, rows: list):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+    buffer.seek(0)
+    quote = conn.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(column) for column in COLUMNS[table])
+    statement = f"COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+    cursor = conn.connection.cursor()
+    try:
+        if hasattr(cursor, "copy_expert"):
+            cursor.copy_expert(statement, buffer)  # psycopg2
+        else:
+            with cursor.copy(statement) as copy:  # psycopg 3
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+def _insert(conn, table: str, rows: list, batch_size: int):
+    model_table = Base.metadata.tables[table]
+    for start in range(0, len(rows), batch_size):
+        # executemany over an INSERT is sent as multi-row VALUES batches
+        conn.execute(model_table.insert(), [dict(zip(COLUMNS[table], row)) for row in rows[start:start + batch_size]])
+
+def _next_ids(conn) -> dict:
+    next_ids = {}
+    for table in SERIAL_TABLES:
+        model_table = Base.metadata.tables[table]
+        next_ids[table] = (conn.execute(select(func.max(model_table.c.id))).scalar() or 0) + 1
+    return next_ids
+
+def _sync_sequences(conn):
+    # Explicit ids bypass the sequences; move them past the loaded rows
+    for table in SERIAL_TABLES:
+        conn.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT coalesce(max(id), 1) FROM {table}))"
+        ))
+
+def seed(args) -> dict:
+    from auth import get_password_hash
+    Base.metadata.create_all(bind=engine)
+    use_copy = engine.dialect.name == "postgresql" and not args.no_copy
+    rng = random.Random(args.seed)
+    with engine.connect() as conn:
+        generator = Generator(rng, _next_ids(conn), args, get_password_hash("password"))
+
+    totals = {table: 0 for table in LOAD_ORDER}
+    started = time.monotonic()
+    remaining = args.users
+    while remaining > 0:
+        chunk = min(args.chunk_users, remaining)
+        rows = {table: [] for table in LOAD_ORDER}
+        for _ in range(chunk):
+            generator.user(rows)
+        with engine.begin() as conn:
+            for table in LOAD_ORDER:
+                if use_copy:
+                    _copy(conn, table, rows[table])
+                else:
+                    _insert(conn, table, rows[table], args.batch_size)
+                totals[table] += len(rows[table])
+        remaining -= chunk
+        logger.info(f"{args.users - remaining}/{args.users} users loaded "
+                    f"({totals['chat_messages']} messages, {totals['dose_events']} dose events, "
+                    f"{time.monotonic() - started:.0f}s)")
+
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            _sync_sequences(conn)
+        # Fresh statistics, so query plans reflect the new sizes right away
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for table in LOAD_ORDER:
+                conn.execute(text(f"ANALYZE {table}"))
+    return totals
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--sessions", type=float, default=8, help="mean chat sessions per chatting user")
+    parser.add_argument("--turns", type=float, default=4, help="mean question/answer turns per session")
+    parser.add_argument("--medications", type=float, default=3, help="mean medications per user taking any")
+    parser.add_argument("--dose-days", type=int, default=90, help="days of dose history per medication")
+    parser.add_argument("--days", type=int, default=365, help="how far back accounts were created")
+    parser.add_argument("--chunk-users", type=int, default=1000, help="users generated and committed together")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows per INSERT batch (without COPY)")
+    parser.add_argument("--no-copy", action="store_true", help="use batched INSERTs on PostgreSQL too")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for a reproducible data set")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    started = time.monotonic()
+    totals = seed(args)
+    for table, count in totals.items():
+        print(f"{table}: {count} rows")
+    print(f"Loaded in {time.monotonic() - started:.1f}s")
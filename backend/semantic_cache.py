@@ -0,0 +1,197 @@
+"""
+Semantic near-duplicate cache for chat answers, using local hashed n-gram embeddings (no network calls)
+"""
+
+import os
+import re
+import time
+import zlib
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") != "0"
+# Minimum cosine similarity for a cached answer to be reused
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.85"))
+# Entries kept per (agent type, response style); the least recently used one is evicted
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "1000"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400"))
+
+EMBEDDING_DIM = 1024
+CHAR_NGRAMS = (3, 4, 5)
+
+# Spellings folded together before embedding, so "bp 130 over 85" and "130/85 blood pressure" meet
+ABBREVIATIONS = {
+    "bp": "blood pressure", "hr": "heart rate", "temp": "temperature", "meds": "medications",
+    "med": "medication", "doc": "doctor", "dr": "doctor", "u": "you", "r": "are", "pls": "please",
+    "w": "with", "wo": "without", "hrs": "hours", "mins": "minutes", "yrs": "years",
+}
+# Filler words that change the phrasing but not the question
+STOPWORDS = {
+    "is", "are", "a", "an", "the", "or", "it", "my", "i", "me", "do", "does", "should",
+    "can", "could", "would", "what", "whats", "this", "that", "of", "to", "be", "am", "im",
+}
+# A trailing "or not?" adds nothing; any other negation must match exactly (see exact_terms)
+NEGATIONS = {"not", "no", "never", "dont", "don't", "cant", "can't", "without", "shouldnt", "shouldn't"}
+# Words that flip or point the question ("is it high" vs "is it low"): each spelling is folded to one
+# term and the set of terms must match exactly, since the embeddings barely tell the pairs apart
+POLARITY = {
+    "high": "high", "higher": "high", "elevated": "high", "low": "low", "lower": "low",
+    "increase": "increase", "increased": "increase", "increasing": "increase", "raise": "increase",
+    "decrease": "decrease", "decreased": "decrease", "decreasing": "decrease", "reduce": "decrease",
+    "before": "before", "after": "after", "during": "during",
+    "more": "more", "less": "less", "fewer": "less",
+    "start": "start", "starting": "start", "begin": "start", "stop": "stop", "stopping": "stop", "quit": "stop",
+    "safe": "safe", "unsafe": "unsafe", "dangerous": "unsafe",
+    "normal": "normal", "abnormal": "abnormal", "good": "good", "bad": "bad",
+    "better": "better", "worse": "worse", "fast": "fast", "slow": "slow",
+    "empty": "empty", "full": "full", "morning": "morning", "night": "night",
+    "hot": "hot", "cold": "cold", "above": "above", "below": "below",
+}
+OR_NOT = re.compile(r"\bor not\b")
+NUMBER_PAIR = re.compile(r"(\d+)\s*/\s*(\d+)")
+TOKEN = re.compile(r"[a-z0-9']+")
+NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+def normalize(text: str) -> list:
+    text = OR_NOT.sub(" ", NUMBER_PAIR.sub(r"\1 over \2", text.lower()))
+    words = []
+    for token in TOKEN.findall(text):
+        token = ABBREVIATIONS.get(token, token)
+        words.extend(token.split())
+    return [word for word in words if word not in STOPWORDS]
+
+def _bucket(feature: str) -> int:
+    return zlib.crc32(feature.encode("utf-8"))
+
+def embed(text: str) -> np.ndarray:
+    """L2-normalized hashed bag of word unigrams and character n-grams"""
+    words = normalize(text)
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    if not words:
+        return vector
+    features = [f"w:{word}" for word in words]
+    # Character n-grams per word tolerate typos and inflections; word order is ignored on purpose
+    for word in words:
+        padded = f" {word} "
+        for n in CHAR_NGRAMS:
+            features.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    for feature in features:
+        hashed = _bucket(feature)
+        # The sign bit halves the damage done by bucket collisions
+        vector[hashed % EMBEDDING_DIM] += 1.0 if hashed & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+def exact_terms(text: str) -> tuple:
+    """
+    Terms a cached answer must match exactly: 130/85 and 150/95, "take" and "not take", or
+    "high" and "low" differ
+    """
+    words = normalize(text)
+    negated = any(word in NEGATIONS for word in words)
+    polarity = tuple(sorted({POLARITY[word] for word in words if word in POLARITY}))
+    return (negated, polarity) + tuple(sorted(NUMBER.findall(text)))
+
+class SemanticIndex:
+    """Bounded matrix of embeddings searched with one matrix-vector product"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.vectors = np.zeros((min(capacity, 64), EMBEDDING_DIM), dtype=np.float32)
+        self.terms = []
+        self.responses = []
+        self.created = np.zeros(len(self.vectors))
+        self.last_used = np.zeros(len(self.vectors))
+        self.size = 0
+
+    def _grow(self):
+        # Doubling keeps idle (agent, style) indexes small
+        rows = min(self.capacity, 2 * len(self.vectors))
+        self.vectors = np.resize(self.vectors, (rows, EMBEDDING_DIM))
+        self.created = np.resize(self.created, rows)
+        self.last_used = np.resize(self.last_used, rows)
+
+    def search(self, vector: np.ndarray, terms: tuple, now: float):
+        """(similarity, slot) of the best live entry with the same exact terms, or (0.0, None)"""
+        if self.size == 0:
+            return 0.0, None
+        similarities = self.vectors[:self.size] @ vector
+        similarities[self.created[:self.size] < now - SEMANTIC_CACHE_TTL_SECONDS] = -1.0
+        candidates = np.flatnonzero(similarities >= SEMANTIC_CACHE_THRESHOLD)
+        for slot in candidates[np.argsort(similarities[candidates])[::-1]]:
+            if self.terms[slot] == terms:
+                return float(similarities[slot]), int(slot)
+        return 0.0, None
+
+    def add(self, vector: np.ndarray, terms: tuple, response: str, now: float):
+        if self.size < self.capacity:
+            if self.size == len(self.vectors):
+                self._grow()
+            slot = self.size
+            self.size += 1
+            self.terms.append(terms)
+            self.responses.append(response)
+        else:
+            # Expired entries have the oldest last_used times too, so LRU covers both
+            slot = int(np.argmin(self.last_used))
+            self.terms[slot] = terms
+            self.responses[slot] = response
+        self.vectors[slot] = vector
+        self.created[slot] = now
+        self.last_used[slot] = now
+
+class SemanticCache:
+    """Per (agent type, response style) semantic indexes, safe to use from worker threads"""
+
+    def __init__(self, capacity: int = SEMANTIC_CACHE_SIZE):
+        self.capacity = capacity
+        self.indexes = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _index(self, key):
+        index = self.indexes.get(key)
+        if index is None:
+            index = self.indexes[key] = SemanticIndex(self.capacity)
+        return index
+
+    def get(self, agent_type: str, response_style: str, message: str):
+        if not SEMANTIC_CACHE_ENABLED:
+            return None
+        vector = embed(message)
+        if not vector.any():
+            return None
+        now = time.time()
+        with self._lock:
+            similarity, slot = self._index((agent_type, response_style)).search(vector, exact_terms(message), now)
+            if slot is None:
+                self.misses += 1
+                return None
+            index = self.indexes[(agent_type, response_style)]
+            index.last_used[slot] = now
+            self.hits += 1
+            logger.info(f"Semantic cache hit for {agent_type}/{response_style} (similarity {similarity:.3f})")
+            return index.responses[slot]
+
+    def put(self, agent_type: str, response_style: str, message: str, response: str):
+        if not SEMANTIC_CACHE_ENABLED:
+            return
+        vector = embed(message)
+        if not vector.any():
+            return
+        with self._lock:
+            self._index((agent_type, response_style)).add(vector, exact_terms(message), response, time.time())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": {f"{agent}/{style}": index.size for (agent, style), index in self.indexes.items()},
+            }
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Production launcher: a gunicorn master with uvicorn workers, one per core by default
+
+Usage:
+    python serve.py          (or python main.py)
+
+Environment:
+    WEB_CONCURRENCY       worker processes (default: number of CPUs; 1 runs plain uvicorn)
+    DB_CONNECTION_BUDGET  database connections for the whole node, split across workers (default 40)
+    LLM_CONCURRENCY       concurrent LLM calls for the whole node, split across workers (default 32)
+    HOST, PORT            bind address (default 0.0.0.0:8000)
+    GRACEFUL_TIMEOUT      seconds a worker gets to finish in-flight requests on restart (default 60)
+    MAX_REQUESTS          recycle a worker after this many requests, 0 = never (default 0)
+
+Rolling restarts: `kill -HUP <master pid>` replaces workers one by one with the
+preloaded code; to deploy new code, `kill -USR2 <master pid>` starts a new master
+next to the old one, then `kill -QUIT <old master pid>` once it is up.
+"""
+
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger(__name__)
+
+def worker_count() -> int:
+    return max(1, int(os.getenv("WEB_CONCURRENCY") or multiprocessing.cpu_count()))
+
+def size_worker_resources(workers: int):
+    """Split the node-wide DB connection and LLM concurrency budgets across workers.
+
+    Must run before database/main are imported; explicit DB_POOL_SIZE,
+    DB_MAX_OVERFLOW and LLM_WORKER_CONCURRENCY settings win.
+    """
+    db_budget = int(os.getenv("DB_CONNECTION_BUDGET", "40"))
+    per_worker = db_budget // workers
+    if per_worker < 2:
+        logger.warning(f"DB_CONNECTION_BUDGET={db_budget} is too small for {workers} workers, using 2 connections each")
+        per_worker = 2
+    # A third of each worker's share is overflow, opened only under bursts
+    overflow = per_worker // 3
+    os.environ.setdefault("DB_POOL_SIZE", str(per_worker - overflow))
+    os.environ.setdefault("DB_MAX_OVERFLOW", str(overflow))
+
+    llm_budget = int(os.getenv("LLM_CONCURRENCY", "32"))
+    os.environ.setdefault("LLM_WORKER_CONCURRENCY", str(max(1, llm_budget // workers)))
+
+def post_fork(server, worker):
+    # Connections opened by the master (migrations) must not be shared with children
+    from database import engine, replica_engine
+    from shards import chat_engines
+    engines = {engine, *chat_engines().values()}
+    if replica_engine is not None:
+        engines.add(replica_engine)
+    for inherited in engines:
+        inherited.dispose(close=False)
+
+def run():
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+    workers = worker_count()
+    size_worker_resources(workers)
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        BaseApplication = None
+    if workers == 1 or BaseApplication is None:
+        if workers > 1:
+            logger.warning("gunicorn is not installed (or not supported here), running a single uvicorn process")
+        import uvicorn
+        from main import app
+        uvicorn.run(app, host=host, port=port)
+        return
+
+    class HealthMateServer(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{host}:{port}",
+                "workers": workers,
+                "worker_class": "uvicorn_worker.UvicornWorker",
+                # Import the app once in the master; workers share its memory pages
+                "preload_app": True,
+                "post_fork": post_fork,
+                # LLM calls can take a while
+                "timeout": 120,
+                "graceful_timeout": int(os.getenv("GRACEFUL_TIMEOUT", "60")),
+                "keepalive": 5,
+                "max_requests": int(os.getenv("MAX_REQUESTS", "0")),
+                "max_requests_jitter": int(os.getenv("MAX_REQUESTS", "0")) // 10,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Migrate once here instead of racing in every worker's startup
+            os.environ["RUN_STARTUP_MIGRATIONS"] = "0"
+            from database import migrate_database
+            migrate_database()
+            from main import app
+            return app
+
+    logger.info(f"Starting {workers} workers on {host}:{port} "
+                f"(DB pool {os.environ['DB_POOL_SIZE']}+{os.environ['DB_MAX_OVERFLOW']}, "
+                f"LLM concurrency {os.environ['LLM_WORKER_CONCURRENCY']} per worker)")
+    HealthMateServer().run()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
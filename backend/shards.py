@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+User-keyed sharding of chat storage (chat_sessions, chat_messages)
+
+Each user's chats live on one database, picked by a consistent-hash ring over the user
+id, so adding a shard moves only about 1/N of the users. Users, medications, usage and
+everything else stay on the primary. Without CHAT_SHARDS chat stays on the primary too.
+
+    CHAT_SHARDS="primary,b=postgresql://.../chat_b,c=postgresql://.../chat_c"
+
+"primary" (no URL) is the main database. CHAT_SHARD_RING lists the shards on the ring
+(default: all of CHAT_SHARDS); a shard that is configured but not on the ring can be
+filled before traffic moves to it. Session and message ids are per shard and change
+when a user is moved; session_id strings do not.
+
+Adding a shard:
+    1. add it to CHAT_SHARDS (not to CHAT_SHARD_RING) and restart: tables are created
+    2. python shards.py plan --ring a,b,c       users that will move
+    3. python shards.py copy --ring a,b,c       copy them (repeatable, copies only what is new)
+    4. set CHAT_SHARD_RING=a,b,c everywhere and restart
+    5. python shards.py finish --ring a,b,c     copy the last writes, delete the old copies
+                                                (repeat while it reports users kept)
+
+Usage:
+    python shards.py status
+    python shards.py plan|copy|finish --ring a,b,c [--batch-size N]
+"""
+
+import argparse
+import bisect
+import hashlib
+import logging
+import os
+from collections import Counter
+from fastapi import Depends
+from sqlalchemy import MetaData, select, insert, update, delete, func, inspect
+from sqlalchemy.orm import Session, sessionmaker
+from database import engine, SessionLocal, create_database_engine, get_db, get_read_db, instrument_engine, create_search_index
+from models import User, ChatSession, ChatMessage
+from auth import get_current_user, get_current_user_read
+
+logger = logging.getLogger(__name__)
+
+PRIMARY_SHARD = "primary"
+# Comma-separated "name=url" entries; a bare "primary" is the main database
+CHAT_SHARDS = os.getenv("CHAT_SHARDS", "")
+CHAT_SHARD_RING = os.getenv("CHAT_SHARD_RING", "")
+# Points per shard on the ring; more points spread users more evenly
+CHAT_SHARD_VNODES = int(os.getenv("CHAT_SHARD_VNODES", "128"))
+REBALANCE_BATCH_SIZE = 500
+
+def _chat_metadata() -> MetaData:
+    """chat_sessions and chat_messages without the foreign key to users, which lives on the primary"""
+    metadata = MetaData()
+    sessions = ChatSession.__table__.to_metadata(metadata)
+    ChatMessage.__table__.to_metadata(metadata)
+    for constraint in list(sessions.foreign_key_constraints):
+        sessions.constraints.discard(constraint)
+    sessions.c.user_id.foreign_keys.clear()
+    sessions.foreign_keys.clear()
+    return metadata
+
+SHARD_METADATA = _chat_metadata()
+sessions_table = SHARD_METADATA.tables["chat_sessions"]
+messages_table = SHARD_METADATA.tables["chat_messages"]
+# Session fields that change after creation (conversation memory); a re-copy updates them
+MUTABLE_SESSION_COLUMNS = ("summary", "summary_turns", "turn_count")
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+class HashRing:
+    """Consistent hashing: a user belongs to the first shard point at or after its hash"""
+
+    def __init__(self, nodes, vnodes: int = CHAT_SHARD_VNODES):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one shard")
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash(f"{node}#{n}"), node) for node in self.nodes for n in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, user_id: int) -> str:
+        index = bisect.bisect(self._hashes, _hash(str(user_id))) % len(self._hashes)
+        return self._owners[index]
+
+def parse_shards(value: str) -> dict:
+    """{name: url}, url None for the primary"""
+    shards = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        name, _, url = entry.partition("=")
+        name = name.strip()
+        if not url and name != PRIMARY_SHARD:
+            raise ValueError(f"Chat shard {name!r} has no URL")
+        shards[name] = url.strip() or None
+    return shards
+
+class ShardRouter:
+    """Engines and sessions of the chat shards, routed by user id"""
+
+    def __init__(self, shards: dict, ring_nodes=None):
+        self.engines = {}
+        self.sessionmakers = {}
+        for name, url in shards.items():
+            if url is None:
+                self.engines[name], self.sessionmakers[name] = engine, SessionLocal
+                continue
+            shard_engine = create_database_engine(url)
+            instrument_engine(shard_engine)
+            self.engines[name] = shard_engine
+            self.sessionmakers[name] = sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)
+        unknown = set(ring_nodes or []) - set(shards)
+        if unknown:
+            raise ValueError(f"CHAT_SHARD_RING names shards missing from CHAT_SHARDS: {sorted(unknown)}")
+        self.ring = HashRing(ring_nodes or list(shards))
+
+    def shard_for(self, user_id: int) -> str:
+        return self.ring.node_for(user_id)
+
+    def engine_for(self, user_id: int):
+        return self.engines[self.shard_for(user_id)]
+
+    def sessionmaker_for(self, user_id: int):
+        return self.sessionmakers[self.shard_for(user_id)]
+
+router = None
+if CHAT_SHARDS:
+    router = ShardRouter(parse_shards(CHAT_SHARDS), [name.strip() for name in CHAT_SHARD_RING.split(",") if name.strip()])
+    logger.info(f"Chat storage sharded over {router.ring.nodes}")
+
+def chat_sessionmaker(user_id: int):
+    """Session factory of the database holding the user's chats"""
+    return router.sessionmaker_for(user_id) if router is not None else SessionLocal
+
+def chat_engine(user_id: int, default=None):
+    """Engine of the database holding the user's chats; `default` (or the primary) when unsharded"""
+    if router is not None:
+        return router.engine_for(user_id)
+    return default if default is not None else engine
+
+def chat_engines() -> dict:
+    return dict(router.engines) if router is not None else {PRIMARY_SHARD: engine}
+
+def _chat_db(user_id: int, db: Session):
+    # Chats on the primary share the caller's session (and transaction)
+    factory = chat_sessionmaker(user_id)
+    if factory is SessionLocal:
+        yield db
+        return
+    chat_db = factory()
+    try:
+        yield chat_db
+    finally:
+        chat_db.close()
+
+def get_chat_db(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+    yield from _chat_db(current_user.id, db)
+
+def get_chat_read_db(current_user: User = Depends(get_current_user_read), db: Session = Depends(get_read_db)):
+    # Shards have no replicas; sharded reads go to the user's shard
+    yield from _chat_db(current_user.id, db)
+
+def get_user_chat_read_db(user_id: int, db: Session = Depends(get_read_db)):
+    """For routes with the owning user id in the path"""
+    yield from _chat_db(user_id, db)
+
+def read_any_shard(db: Session, read):
+    """
+    read(session) on `db` when unsharded; sharded, the first non-empty result over the
+    shards. For lookups that do not know the owning user, one query per shard at worst.
+    """
+    if router is None:
+        return read(db)
+    for factory in router.sessionmakers.values():
+        shard_db = factory()
+        try:
+            rows = read(shard_db)
+        finally:
+            shard_db.close()
+        if rows:
+            return rows
+    return []
+
+def migrate_shards():
+    """Create the chat tables and their search index on every shard besides the primary"""
+    if router is None:
+        return
+    for name, shard_engine in router.engines.items():
+        if shard_engine is engine:
+            continue
+        try:
+            SHARD_METADATA.create_all(bind=shard_engine)
+            create_search_index(shard_engine)
+            logger.info(f"Chat shard {name} is up to date")
+        except Exception as e:
+            logger.error(f"Error migrating chat shard {name}: {e}")
+
+# Rebalancing
+
+def _sources() -> dict:
+    """Every database that may hold chats: the shards and the primary (chats from before sharding)"""
+    sources = chat_engines()
+    if engine not in sources.values():
+        sources[PRIMARY_SHARD] = engine
+    return sources
+
+def _has_chat_tables(source_engine) -> bool:
+    return inspect(source_engine).has_table("chat_sessions")
+
+def _user_batches(source_engine, batch_size: int):
+    after = None
+    with source_engine.connect() as conn:
+        while True:
+            query = select(sessions_table.c.user_id).distinct().order_by(sessions_table.c.user_id).limit(batch_size)
+            if after is not None:
+                query = query.where(sessions_table.c.user_id > after)
+            users = conn.execute(query).scalars().all()
+            if not users:
+                return
+            yield users
+            after = users[-1]
+
+def _moves(ring: HashRing, batch_size: int):
+    """(source name, target name, [user ids]) for users whose chats are not on their shard"""
+    for source, source_engine in _sources().items():
+        if not _has_chat_tables(source_engine):
+            continue
+        for users in _user_batches(source_engine, batch_size):
+            by_target = {}
+            for user_id in users:
+                target = ring.node_for(user_id)
+                if target != source:
+                    by_target.setdefault(target, []).append(user_id)
+            for target, moving in by_target.items():
+                yield source, target, moving
+
+def _message_key(message) -> tuple:
+    # Ids differ per shard; a copy keeps the timestamp, type and content of the original
+    content = (message["content"] or "").encode("utf-8")
+    return message["timestamp"], message["message_type"], hashlib.sha256(content).digest()
+
+def copy_user(user_id: int, source_engine, target_engine) -> tuple:
+    """
+    Copy the user's sessions and the messages the target does not have yet, in one target
+    transaction. Messages are matched by (timestamp, type, content), not by position, as
+    the target may already hold newer messages of the same session written after the ring
+    switched. Returns (messages copied, source ids of the messages now on the target).
+    """
+    copied = 0
+    on_target = []
+    with source_engine.connect() as src, target_engine.begin() as dst:
+        sessions = src.execute(
+            select(sessions_table).where(sessions_table.c.user_id == user_id).order_by(sessions_table.c.id)
+        ).mappings().all()
+        for session in sessions:
+            values = {key: value for key, value in session.items() if key != "id"}
+            target_id = dst.execute(
+                select(sessions_table.c.id).where(sessions_table.c.session_id == session["session_id"])
+            ).scalar()
+            if target_id is None:
+                target_id = dst.execute(insert(sessions_table).values(**values)).inserted_primary_key[0]
+            else:
+                dst.execute(update(sessions_table).where(sessions_table.c.id == target_id).values(
+                    **{column: values[column] for column in MUTABLE_SESSION_COLUMNS}
+                ))
+            present = Counter(_message_key(message) for message in dst.execute(
+                select(messages_table.c.timestamp, messages_table.c.message_type, messages_table.c.content)
+                .where(messages_table.c.session_id == target_id)
+            ).mappings())
+            missing = []
+            for message in src.execute(
+                select(messages_table).where(messages_table.c.session_id == session["id"]).order_by(messages_table.c.id)
+            ).mappings():
+                key = _message_key(message)
+                if present[key]:
+                    present[key] -= 1
+                else:
+                    missing.append({**message, "session_id": target_id})
+                on_target.append(message["id"])
+            if missing:
+                dst.execute(insert(messages_table), [
+                    {key: value for key, value in message.items() if key != "id"} for message in missing
+                ])
+                copied += len(missing)
+    return copied, on_target
+
+def delete_user(user_id: int, source_engine, on_target: list) -> bool:
+    """
+    Delete the user's chats from the source, if every message there is among `on_target`
+    (as copy_user returned them). Otherwise nothing is deleted and False is returned: a
+    late write reached the source after the copy, and the next finish copies it.
+    """
+    with source_engine.begin() as conn:
+        session_ids = select(sessions_table.c.id).where(sessions_table.c.user_id == user_id).scalar_subquery()
+        count = conn.execute(
+            select(func.count()).select_from(messages_table).where(messages_table.c.session_id.in_(session_ids))
+        ).scalar()
+        if count != len(on_target):
+            logger.warning(f"User {user_id} has {count} messages on the source but {len(on_target)} were copied; "
+                           f"not deleting")
+            return False
+        # By id, so a message written after the count is kept (with its session) for the next run
+        deleted = 0
+        for start in range(0, len(on_target), REBALANCE_BATCH_SIZE):
+            deleted += conn.execute(delete(messages_table).where(
+                messages_table.c.id.in_(on_target[start:start + REBALANCE_BATCH_SIZE])
+            )).rowcount
+        has_messages = select(messages_table.c.id).where(messages_table.c.session_id == sessions_table.c.id).exists()
+        conn.execute(delete(sessions_table).where(sessions_table.c.user_id == user_id, ~has_messages))
+        kept = conn.execute(
+            select(func.count()).select_from(messages_table).where(messages_table.c.session_id.in_(session_ids))
+        ).scalar()
+    if kept:
+        logger.warning(f"User {user_id} got {kept} messages on the source during the move; run finish again")
+        return False
+    return True
+
+def rebalance(ring_nodes: list, finish: bool = False, batch_size: int = REBALANCE_BATCH_SIZE) -> dict:
+    """
+    Copy every misplaced user to its shard under `ring_nodes`; with finish, delete the
+    source copy of each user whose messages are all on the target
+    """
+    engines = _sources()
+    missing = set(ring_nodes) - set(engines)
+    if missing:
+        raise ValueError(f"Shards not in CHAT_SHARDS: {sorted(missing)}")
+    ring = HashRing(ring_nodes)
+    totals = {"users": 0, "messages": 0, "kept": 0}
+    # Users are collected first: deleting while paging through a source would skip some
+    for source, target, users in list(_moves(ring, batch_size)):
+        for user_id in users:
+            copied, on_target = copy_user(user_id, engines[source], engines[target])
+            totals["messages"] += copied
+            if finish and not delete_user(user_id, engines[source], on_target):
+                totals["kept"] += 1
+            totals["users"] += 1
+        logger.info(f"{'Moved' if finish else 'Copied'} {len(users)} users from {source} to {target}")
+    return totals
+
+def plan(ring_nodes: list, batch_size: int = REBALANCE_BATCH_SIZE) -> dict:
+    """{(source, target): users} that rebalance() would move"""
+    moves = {}
+    for source, target, users in _moves(HashRing(ring_nodes), batch_size):
+        moves[(source, target)] = moves.get((source, target), 0) + len(users)
+    return moves
+
+def status() -> list:
+    rows = []
+    for name, source_engine in _sources().items():
+        if not _has_chat_tables(source_engine):
+            rows.append({"shard": name, "users": 0, "sessions": 0, "messages": 0})
+            continue
+        with source_engine.connect() as conn:
+            rows.append({
+                "shard": name,
+                "users": conn.execute(select(func.count(sessions_table.c.user_id.distinct()))).scalar(),
+                "sessions": conn.execute(select(func.count()).select_from(sessions_table)).scalar(),
+                "messages": conn.execute(select(func.count()).select_from(messages_table)).scalar(),
+            })
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "plan", "copy", "finish"])
+    parser.add_argument("--ring", help="comma-separated shard names of the target ring")
+    parser.add_argument("--batch-size", type=int, default=REBALANCE_BATCH_SIZE, help="users read per query")
+    parser.add_argument("--force", action="store_true", help="finish although CHAT_SHARD_RING differs from --ring")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    migrate_shards()
+
+    if args.command == "status":
+        ring = router.ring.nodes if router is not None else [PRIMARY_SHARD]
+        print(f"ring: {', '.join(ring)}")
+        for row in status():
+            print(f"{row['shard']}: {row['users']} users, {row['sessions']} sessions, {row['messages']} messages")
+    else:
+        if not args.ring:
+            parser.error("--ring is required")
+        ring_nodes = [name.strip() for name in args.ring.split(",") if name.strip()]
+        if args.command == "plan":
+            moves = plan(ring_nodes, args.batch_size)
+            for (source, target), users in sorted(moves.items()):
+                print(f"{source} -> {target}: {users} users")
+            print(f"{sum(moves.values())} users to move")
+        else:
+            finish = args.command == "finish"
+            # Deleting the old copies is only safe once the servers write to the new shards
+            current = router.ring.nodes if router is not None else [PRIMARY_SHARD]
+            if finish and sorted(set(ring_nodes)) != current and not args.force:
+                parser.error(f"CHAT_SHARD_RING is {','.join(current)}; switch the servers to the new ring before finish")
+            totals = rebalance(ring_nodes, finish, args.batch_size)
+            print(f"{'Moved' if finish else 'Copied'} {totals['users']} users ({totals['messages']} new messages)")
+            if totals["kept"]:
+                print(f"{totals['kept']} users kept on their old shard (new messages arrived there); run finish again")
@@ -0,0 +1,31 @@
+"""
+Semantic cache regression tests: opposite questions must not share an answer.
+Run with `python -m pytest test_semantic_cache.py` from this directory.
+"""
+
+from semantic_cache import SemanticCache, embed, exact_terms
+
+# Pairs that score above the default similarity threshold but ask opposite things
+OPPOSITE_PAIRS = [
+    ("is 130/85 blood pressure high?", "is 130/85 blood pressure low?"),
+    ("is blood pressure 90/60 low", "is blood pressure 90/60 high"),
+    ("should i take ibuprofen before or after food", "should i take ibuprofen before food"),
+]
+
+def test_opposite_questions_have_different_exact_terms():
+    for first, second in OPPOSITE_PAIRS:
+        # The embeddings alone cannot tell these apart
+        assert float(embed(first) @ embed(second)) >= 0.85, (first, second)
+        assert exact_terms(first) != exact_terms(second), (first, second)
+
+def test_opposite_questions_miss_the_cache():
+    for first, second in OPPOSITE_PAIRS:
+        cache = SemanticCache(capacity=10)
+        cache.put("general", "balanced", first, "cached answer")
+        assert cache.get("general", "balanced", second) is None, (first, second)
+        assert cache.get("general", "balanced", first) == "cached answer"
+
+def test_rephrased_question_still_hits():
+    cache = SemanticCache(capacity=10)
+    cache.put("general", "balanced", "is 130/85 blood pressure high?", "cached answer")
+    assert cache.get("general", "balanced", "bp 130 over 85 high or not") == "cached answer"
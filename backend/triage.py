@@ -0,0 +1,324 @@
+"""
+Local rule-based pre-triage: answers textbook symptom combinations without an LLM call
+"""
+
+import os
+import math
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+PRETRIAGE_ENABLED = os.getenv("PRETRIAGE_ENABLED", "1") != "0"
+# Minimum cosine similarity between the submitted symptoms and the best condition
+PRETRIAGE_MIN_SCORE = float(os.getenv("PRETRIAGE_MIN_SCORE", "0.5"))
+# Other conditions are listed alongside the best one when they score at least this share of it
+RUNNER_UP_RATIO = 0.7
+MAX_CONDITIONS = 3
+
+# Symptoms that always go to the LLM (and a doctor), whatever else is present
+RED_FLAGS = {
+    "chest pain", "shortness of breath", "difficulty breathing", "seizures", "paralysis", "confusion",
+    "blood in stool", "bleeding", "severe bleeding", "coughing blood", "vomiting blood", "numbness",
+    "difficulty swallowing", "irregular heartbeat", "memory loss", "double vision", "vision problems",
+    "fainting", "slurred speech", "yellow skin", "suicidal thoughts", "testicular pain", "stiff neck",
+    "high fever",
+}
+# Combinations that are red flags together (e.g. meningitis, sepsis, appendicitis warning signs)
+RED_FLAG_COMBINATIONS = [
+    frozenset({"fever", "headache", "stiffness"}),
+    frozenset({"fever", "rash"}),
+    frozenset({"fever", "confusion"}),
+    frozenset({"abdominal pain", "vomiting", "fever"}),
+    frozenset({"headache", "vomiting", "blurred vision"}),
+]
+
+# Free-text spellings mapped to the names used by the symptom checker
+ALIASES = {
+    "stuffy nose": "congestion", "blocked nose": "congestion", "nasal congestion": "congestion",
+    "rhinorrhea": "runny nose", "running nose": "runny nose",
+    "tiredness": "fatigue", "exhaustion": "fatigue",
+    "body aches": "muscle pain", "muscle aches": "muscle pain", "aches": "muscle pain",
+    "throwing up": "vomiting", "stomach ache": "abdominal pain", "stomach pain": "abdominal pain",
+    "tummy ache": "abdominal pain", "loose stools": "diarrhea", "diarrhoea": "diarrhea",
+    "itchy skin": "itching", "itchy eyes": "itching", "red eyes": "eye redness", "pink eye": "eye redness",
+    "burning urination": "painful urination", "sensitivity to light": "light sensitivity",
+    "photophobia": "light sensitivity", "breathlessness": "shortness of breath",
+    "head ache": "headache", "temperature": "fever", "feverish": "fever",
+}
+
+RISK_ORDER = ["low", "moderate", "high", "urgent"]
+
+# Each condition lists symptom weights: 1.0 for hallmark symptoms, 0.5 for supporting ones
+CONDITIONS = [
+    {
+        "name": "Common Cold",
+        "risk": "low",
+        "symptoms": {"runny nose": 1.0, "congestion": 1.0, "sneezing": 1.0, "sore throat": 1.0,
+                     "cough": 0.5, "watery eyes": 0.5, "fever": 0.5, "fatigue": 0.5, "headache": 0.5},
+        "description": "Viral infection of the nose and throat that usually clears up within 7-10 days",
+        "immediateActions": ["Rest and drink plenty of fluids", "Use saline nasal spray or steam for congestion"],
+        "precautions": ["Wash hands often", "Cover coughs and sneezes", "Avoid close contact with vulnerable people"],
+        "medications": ["Acetaminophen or ibuprofen for aches or fever", "Decongestants for a blocked nose (short term)"],
+        "lifestyleChanges": ["Get adequate sleep", "Eat nutritious foods"],
+        "whenToSeekHelp": ["Fever above 103°F (39.4°C)", "Difficulty breathing", "Symptoms lasting more than 10 days"],
+        "followUp": "See a doctor if symptoms persist beyond 10 days or get worse after improving",
+    },
+    {
+        "name": "Seasonal Allergies (Allergic Rhinitis)",
+        "risk": "low",
+        "symptoms": {"sneezing": 1.0, "runny nose": 1.0, "watery eyes": 1.0, "itching": 1.0,
+                     "congestion": 0.5, "eye redness": 0.5, "allergic reactions": 1.0},
+        "description": "Immune reaction to pollen, dust, pet dander or mold causing nasal and eye symptoms",
+        "immediateActions": ["Avoid known triggers where possible", "Rinse the nose with saline"],
+        "precautions": ["Keep windows closed on high-pollen days", "Shower after spending time outdoors"],
+        "medications": ["Non-drowsy antihistamines (e.g. cetirizine, loratadine)", "Steroid nasal spray for persistent symptoms"],
+        "lifestyleChanges": ["Wash bedding weekly in hot water", "Use an air purifier indoors"],
+        "whenToSeekHelp": ["Wheezing or difficulty breathing", "Swelling of the lips, tongue or face"],
+        "followUp": "See a doctor if over-the-counter treatment does not control symptoms",
+    },
+    {
+        "name": "Influenza (Flu)",
+        "risk": "moderate",
+        "symptoms": {"fever": 1.0, "chills": 1.0, "muscle pain": 1.0, "fatigue": 1.0, "cough": 1.0,
+                     "headache": 0.5, "sore throat": 0.5, "joint pain": 0.5, "sweating": 0.5},
+        "description": "Viral respiratory infection with sudden fever, aches and exhaustion, usually improving within a week",
+        "immediateActions": ["Rest at home and drink plenty of fluids", "Monitor your temperature"],
+        "precautions": ["Stay home until 24 hours after the fever is gone", "Wash hands often and cover coughs"],
+        "medications": ["Acetaminophen or ibuprofen for fever and aches", "Ask a doctor about antivirals within 48 hours if at higher risk"],
+        "lifestyleChanges": ["Get adequate sleep", "Get a yearly flu vaccine"],
+        "whenToSeekHelp": ["Difficulty breathing or chest pain", "Confusion", "Fever that returns after improving"],
+        "followUp": "Contact a doctor early if you are pregnant, over 65 or have a chronic condition",
+    },
+    {
+        "name": "Tension Headache",
+        "risk": "low",
+        "symptoms": {"headache": 1.0, "stiffness": 0.5, "fatigue": 0.5, "anxiety": 0.5, "insomnia": 0.5},
+        "description": "Dull, band-like head pain often linked to stress, poor posture or lack of sleep",
+        "immediateActions": ["Rest in a quiet room", "Apply a warm or cool compress to the head or neck"],
+        "precautions": ["Take regular screen breaks", "Keep a headache diary to spot triggers"],
+        "medications": ["Acetaminophen or ibuprofen as directed on the label"],
+        "lifestyleChanges": ["Stay hydrated", "Keep a regular sleep schedule", "Practice relaxation techniques"],
+        "whenToSeekHelp": ["Sudden, severe headache", "Headache with fever, stiff neck or confusion"],
+        "followUp": "See a doctor if headaches become frequent or change in pattern",
+    },
+    {
+        "name": "Migraine",
+        "risk": "low",
+        "symptoms": {"headache": 1.0, "nausea": 1.0, "light sensitivity": 1.0, "vomiting": 0.5,
+                     "blurred vision": 0.5, "dizziness": 0.5},
+        "description": "Recurring throbbing headaches, often one-sided, with nausea and sensitivity to light",
+        "immediateActions": ["Rest in a dark, quiet room", "Take pain relief early in the attack"],
+        "precautions": ["Track triggers such as certain foods, stress or missed meals"],
+        "medications": ["Ibuprofen, naproxen or acetaminophen", "Anti-nausea medication if needed"],
+        "lifestyleChanges": ["Regular sleep and meals", "Limit caffeine and alcohol"],
+        "whenToSeekHelp": ["Worst headache of your life", "Weakness, numbness or trouble speaking"],
+        "followUp": "See a doctor if migraines occur more than a few times a month",
+    },
+    {
+        "name": "Gastroenteritis (Stomach Bug)",
+        "risk": "moderate",
+        "symptoms": {"diarrhea": 1.0, "vomiting": 1.0, "nausea": 1.0, "abdominal pain": 0.5,
+                     "loss of appetite": 0.5, "fever": 0.5, "fatigue": 0.5},
+        "description": "Viral or bacterial infection of the gut that usually settles within a few days",
+        "immediateActions": ["Sip water or oral rehydration solution often", "Rest"],
+        "precautions": ["Wash hands thoroughly", "Do not prepare food for others until 48 hours after symptoms stop"],
+        "medications": ["Oral rehydration salts", "Acetaminophen for fever or discomfort"],
+        "lifestyleChanges": ["Return to bland foods gradually"],
+        "whenToSeekHelp": ["Signs of dehydration (little urine, dizziness)", "Blood in stool or vomit", "Symptoms beyond 3 days"],
+        "followUp": "See a doctor if you cannot keep fluids down for more than a day",
+    },
+    {
+        "name": "Constipation",
+        "risk": "low",
+        "symptoms": {"constipation": 1.0, "abdominal pain": 0.5, "loss of appetite": 0.5},
+        "description": "Infrequent or hard-to-pass stools, commonly caused by low fiber or fluid intake",
+        "immediateActions": ["Drink more water", "Add fiber-rich foods such as fruit, vegetables and whole grains"],
+        "precautions": ["Do not ignore the urge to go"],
+        "medications": ["Bulk-forming laxatives or stool softeners (short term)"],
+        "lifestyleChanges": ["Exercise regularly", "Keep a regular toilet routine"],
+        "whenToSeekHelp": ["Blood in stool", "Severe abdominal pain", "Unexplained weight loss"],
+        "followUp": "See a doctor if constipation lasts more than 2 weeks",
+    },
+    {
+        "name": "Allergic Skin Reaction (Hives)",
+        "risk": "low",
+        "symptoms": {"hives": 1.0, "itching": 1.0, "rash": 0.5, "swelling": 0.5, "allergic reactions": 0.5},
+        "description": "Raised, itchy welts triggered by an allergen, medication, heat or stress",
+        "immediateActions": ["Apply a cool compress", "Avoid the suspected trigger"],
+        "precautions": ["Wear loose, cotton clothing", "Avoid hot showers"],
+        "medications": ["Non-drowsy antihistamines"],
+        "lifestyleChanges": ["Keep a diary of foods and products used"],
+        "whenToSeekHelp": ["Swelling of the lips, tongue or throat", "Difficulty breathing or swallowing"],
+        "followUp": "See a doctor if hives last more than 6 weeks or keep coming back",
+    },
+    {
+        "name": "Eczema (Atopic Dermatitis)",
+        "risk": "low",
+        "symptoms": {"eczema": 1.0, "dry skin": 1.0, "itching": 1.0, "rash": 0.5, "sensitive skin": 0.5},
+        "description": "Chronic condition causing dry, itchy and inflamed patches of skin",
+        "immediateActions": ["Moisturize affected skin several times a day", "Avoid scratching"],
+        "precautions": ["Use fragrance-free soaps and detergents"],
+        "medications": ["Emollients", "Low-strength hydrocortisone cream for flare-ups"],
+        "lifestyleChanges": ["Take short, lukewarm showers", "Identify and avoid irritants"],
+        "whenToSeekHelp": ["Skin that is weeping, crusted or very painful (possible infection)"],
+        "followUp": "See a doctor if over-the-counter treatment does not help within 1-2 weeks",
+    },
+    {
+        "name": "Urinary Tract Infection",
+        "risk": "moderate",
+        "symptoms": {"painful urination": 1.0, "frequent urination": 1.0, "difficulty urinating": 0.5,
+                     "abdominal pain": 0.5, "dark urine": 0.5},
+        "description": "Bacterial infection of the bladder, usually needing antibiotics",
+        "immediateActions": ["Drink plenty of water", "Book an appointment with a doctor"],
+        "precautions": ["Do not delay urination", "Avoid bladder irritants such as caffeine and alcohol"],
+        "medications": ["Acetaminophen or ibuprofen for pain", "Antibiotics if prescribed by a doctor"],
+        "lifestyleChanges": ["Stay well hydrated"],
+        "whenToSeekHelp": ["Fever, chills or back/side pain (possible kidney infection)", "Blood in urine"],
+        "followUp": "See a doctor within 1-2 days for testing and treatment",
+    },
+    {
+        "name": "Sinusitis",
+        "risk": "low",
+        "symptoms": {"sinus pain": 1.0, "congestion": 1.0, "runny nose": 0.5, "headache": 0.5,
+                     "cough": 0.5, "fatigue": 0.5},
+        "description": "Inflammation of the sinuses, usually after a cold, causing facial pain and congestion",
+        "immediateActions": ["Use saline nasal rinses", "Apply warm compresses to the face"],
+        "precautions": ["Avoid smoke and other irritants"],
+        "medications": ["Acetaminophen or ibuprofen for pain", "Decongestant nasal spray (no more than 3 days)"],
+        "lifestyleChanges": ["Stay hydrated", "Use a humidifier"],
+        "whenToSeekHelp": ["Swelling or redness around the eyes", "Severe headache or high fever"],
+        "followUp": "See a doctor if symptoms last more than 10 days",
+    },
+    {
+        "name": "Conjunctivitis (Pink Eye)",
+        "risk": "low",
+        "symptoms": {"eye redness": 1.0, "eye discharge": 1.0, "watery eyes": 0.5, "itching": 0.5},
+        "description": "Inflammation of the eye's outer membrane from infection or allergy",
+        "immediateActions": ["Clean discharge with a clean, damp cloth", "Avoid touching or rubbing the eyes"],
+        "precautions": ["Do not share towels or pillows", "Stop wearing contact lenses until it clears"],
+        "medications": ["Lubricating eye drops", "Antihistamine eye drops if allergic"],
+        "lifestyleChanges": ["Wash hands often"],
+        "whenToSeekHelp": ["Eye pain", "Changes in vision", "Strong sensitivity to light"],
+        "followUp": "See a doctor if it does not improve within a week",
+    },
+]
+
+def normalize_symptom(name: str) -> str:
+    key = " ".join(name.lower().replace("-", " ").split())
+    return ALIASES.get(key, key)
+
+def _symptom_key(symptom) -> str:
+    name = normalize_symptom(symptom.name)
+    # A stiff neck is a red flag where stiffness elsewhere is not
+    if name == "stiffness" and symptom.bodyPart and symptom.bodyPart.lower() == "neck":
+        return "stiff neck"
+    return name
+
+def _build_index():
+    """Inverted index symptom -> [(condition index, idf-weighted weight)] and condition vector norms"""
+    document_frequency = defaultdict(int)
+    for condition in CONDITIONS:
+        for symptom in condition["symptoms"]:
+            document_frequency[symptom] += 1
+    # Symptoms shared by many conditions say less about any one of them
+    idf = {symptom: math.log(1 + len(CONDITIONS) / df) for symptom, df in document_frequency.items()}
+
+    index = defaultdict(list)
+    norms = []
+    for position, condition in enumerate(CONDITIONS):
+        squares = 0.0
+        for symptom, weight in condition["symptoms"].items():
+            weighted = weight * idf[symptom]
+            index[symptom].append((position, weighted))
+            squares += weighted * weighted
+        norms.append(math.sqrt(squares))
+    return dict(index), idf, norms
+
+SYMPTOM_INDEX, SYMPTOM_IDF, CONDITION_NORMS = _build_index()
+
+def _escalation_reason(names: set, symptoms) -> str:
+    red_flags = names & RED_FLAGS
+    if red_flags:
+        return f"red flag symptoms: {', '.join(sorted(red_flags))}"
+    for combination in RED_FLAG_COMBINATIONS:
+        if combination <= names:
+            return f"red flag combination: {', '.join(sorted(combination))}"
+    if any((s.severity or "").lower() == "severe" for s in symptoms):
+        return "severe symptoms"
+    unknown = [name for name in names if name not in SYMPTOM_INDEX]
+    if unknown:
+        return f"symptoms outside the local index: {', '.join(sorted(unknown))}"
+    return ""
+
+def score_conditions(names: set) -> list:
+    """(cosine similarity, condition index) for every condition sharing a symptom, best first"""
+    dots = defaultdict(float)
+    for name in names:
+        for position, weighted in SYMPTOM_INDEX.get(name, ()):
+            dots[position] += weighted * SYMPTOM_IDF[name]
+    query_norm = math.sqrt(sum(SYMPTOM_IDF[name] ** 2 for name in names if name in SYMPTOM_IDF))
+    if not query_norm:
+        return []
+    scores = [(dot / (query_norm * CONDITION_NORMS[position]), position) for position, dot in dots.items()]
+    scores.sort(reverse=True)
+    return scores
+
+def _merge(conditions, field: str, limit: int = 5) -> list:
+    merged = []
+    for condition in conditions:
+        for item in condition[field]:
+            if item not in merged:
+                merged.append(item)
+    return merged[:limit]
+
+def pretriage(symptoms):
+    """
+    A ready-made SymptomAssessmentResponse dict for confidently matching, non-severe symptom
+    sets, or None when the case should go to the LLM.
+    """
+    if not PRETRIAGE_ENABLED or not symptoms:
+        return None
+    names = {_symptom_key(s) for s in symptoms}
+
+    reason = _escalation_reason(names, symptoms)
+    if reason:
+        logger.info(f"Pre-triage escalating to LLM ({reason})")
+        return None
+
+    scores = score_conditions(names)
+    if not scores or scores[0][0] < PRETRIAGE_MIN_SCORE:
+        logger.info(f"Pre-triage escalating to LLM (best score {scores[0][0] if scores else 0:.2f})")
+        return None
+    best = scores[0][0]
+    selected = [(score, CONDITIONS[position]) for score, position in scores[:MAX_CONDITIONS]
+                if score >= best * RUNNER_UP_RATIO]
+
+    # Every submitted symptom must be explained by one of the listed conditions
+    explained = set().union(*(condition["symptoms"].keys() for _, condition in selected))
+    if not names <= explained:
+        logger.info("Pre-triage escalating to LLM (symptoms not explained by one condition group)")
+        return None
+
+    total = sum(score for score, _ in selected)
+    conditions = [condition for _, condition in selected]
+    risk = max((condition["risk"] for condition in conditions), key=RISK_ORDER.index)
+    logger.info(f"Pre-triage answered locally: {[condition['name'] for condition in conditions]}")
+    return {
+        "riskLevel": risk,
+        "conditions": [
+            {
+                "name": condition["name"],
+                "probability": round(100 * score / total * min(1.0, best + 0.2)),
+                "description": condition["description"],
+                "urgent": False,
+            }
+            for score, condition in selected
+        ],
+        "immediateActions": _merge(conditions, "immediateActions"),
+        "precautions": _merge(conditions, "precautions"),
+        "medications": _merge(conditions, "medications"),
+        "lifestyleChanges": _merge(conditions, "lifestyleChanges"),
+        "whenToSeekHelp": _merge(conditions, "whenToSeekHelp"),
+        "followUp": conditions[0]["followUp"],
+    }
@@ -0,0 +1,141 @@
+"""
+LLM token, cost and latency accounting with per-user/per-agent daily aggregates and budgets
+"""
+
+import os
+import logging
+from datetime import datetime, timezone
+from sqlalchemy import text, func
+from sqlalchemy.orm import Session
+from models import LLMUsageDaily
+
+logger = logging.getLogger(__name__)
+
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+# Cheaper model used for users over budget when BUDGET_ACTION is "downgrade"
+LLM_BUDGET_MODEL = os.getenv("LLM_BUDGET_MODEL", "gemini-1.5-flash-8b")
+# Daily token budget for users without their own (0 = unlimited)
+DEFAULT_DAILY_TOKEN_BUDGET = int(os.getenv("DEFAULT_DAILY_TOKEN_BUDGET", "0"))
+# What happens once a user is over budget: "downgrade" to LLM_BUDGET_MODEL or "refuse"
+BUDGET_ACTION = os.getenv("BUDGET_ACTION", "downgrade")
+
+# USD per million (input, output) tokens
+MODEL_PRICES = {
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-1.5-flash-8b": (0.0375, 0.15),
+    "gemini-1.5-pro": (1.25, 5.00),
+}
+
+# Anonymous calls (e.g. symptom checks without a token) are aggregated under this user id
+ANONYMOUS_USER_ID = 0
+
+UPSERT_DAILY_SQL = text("""
+    INSERT INTO llm_usage_daily (day, user_id, agent_type, model, calls, prompt_tokens, completion_tokens, latency_ms, cost_usd)
+    VALUES (:day, :user_id, :agent_type, :model, 1, :prompt_tokens, :completion_tokens, :latency_ms, :cost_usd)
+    ON CONFLICT (day, user_id, agent_type, model) DO UPDATE SET
+        calls = llm_usage_daily.calls + 1,
+        prompt_tokens = llm_usage_daily.prompt_tokens + excluded.prompt_tokens,
+        completion_tokens = llm_usage_daily.completion_tokens + excluded.completion_tokens,
+        latency_ms = llm_usage_daily.latency_ms + excluded.latency_ms,
+        cost_usd = llm_usage_daily.cost_usd + excluded.cost_usd
+""")
+
+def estimate_tokens(text_value: str) -> int:
+    # Roughly four characters per token for English text
+    return max(1, len(text_value or "") // 4)
+
+def usage_from_response(response, model: str, latency_ms: float, prompt: str = "") -> dict:
+    """Token counts, cost and latency of one LLM call, estimated when the provider reports none"""
+    usage = getattr(response, "usage_metadata", None) or {}
+    prompt_tokens = usage.get("input_tokens")
+    completion_tokens = usage.get("output_tokens")
+    estimated = prompt_tokens is None or completion_tokens is None
+    if estimated:
+        content = getattr(response, "content", None) or str(response)
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(content if isinstance(content, str) else str(content))
+
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    record = {
+        "model": model,
+        "prompt_tokens": int(prompt_tokens),
+        "completion_tokens": int(completion_tokens),
+        "latency_ms": round(latency_ms, 1),
+        "cost_usd": round((prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000, 8),
+    }
+    if estimated:
+        record["estimated"] = True
+    return record
+
+def record_usage(db: Session, user_id, agent_type: str, usage: dict):
+    """Add one call to today's aggregate row (committed with the caller's transaction)"""
+    db.execute(UPSERT_DAILY_SQL, {
+        "day": datetime.now(timezone.utc).date(),
+        "user_id": user_id if user_id is not None else ANONYMOUS_USER_ID,
+        "agent_type": agent_type or "general",
+        "model": usage["model"],
+        "prompt_tokens": usage["prompt_tokens"],
+        "completion_tokens": usage["completion_tokens"],
+        "latency_ms": usage["latency_ms"],
+        "cost_usd": usage["cost_usd"],
+    })
+
+def tokens_used_today(db: Session, user_id: int) -> int:
+    # Served by the primary key prefix (day, user_id)
+    total = db.query(
+        func.coalesce(func.sum(LLMUsageDaily.prompt_tokens + LLMUsageDaily.completion_tokens), 0)
+    ).filter(
+        LLMUsageDaily.day == datetime.now(timezone.utc).date(),
+        LLMUsageDaily.user_id == user_id
+    ).scalar()
+    return int(total or 0)
+
+def budget_route(db: Session, user) -> str:
+    """'default' within budget, otherwise 'budget' (cheaper model) or 'refuse' per BUDGET_ACTION"""
+    if user is None:
+        return "default"
+    budget = user.daily_token_budget if user.daily_token_budget is not None else DEFAULT_DAILY_TOKEN_BUDGET
+    if not budget or tokens_used_today(db, user.id) < budget:
+        return "default"
+    logger.info(f"User {user.id} is over their daily token budget ({budget})")
+    return "refuse" if BUDGET_ACTION == "refuse" else "budget"
+
+def _aggregate_rows(rows, key: str):
+    return [
+        {
+            "day": row.day.isoformat(),
+            key: getattr(row, key),
+            "calls": int(row.calls),
+            "prompt_tokens": int(row.prompt_tokens),
+            "completion_tokens": int(row.completion_tokens),
+            "avg_latency_ms": round(float(row.latency_ms) / row.calls, 1) if row.calls else 0.0,
+            "cost_usd": round(float(row.cost_usd), 6),
+        }
+        for row in rows
+    ]
+
+def _daily_totals(db: Session, group_column, since, *filters):
+    return (
+        db.query(
+            LLMUsageDaily.day,
+            group_column,
+            func.sum(LLMUsageDaily.calls).label("calls"),
+            func.sum(LLMUsageDaily.prompt_tokens).label("prompt_tokens"),
+            func.sum(LLMUsageDaily.completion_tokens).label("completion_tokens"),
+            func.sum(LLMUsageDaily.latency_ms).label("latency_ms"),
+            func.sum(LLMUsageDaily.cost_usd).label("cost_usd"),
+        )
+        .filter(LLMUsageDaily.day >= since, *filters)
+        .group_by(LLMUsageDaily.day, group_column)
+        .order_by(LLMUsageDaily.day.desc(), group_column)
+        .all()
+    )
+
+def user_usage(db: Session, user_id: int, since) -> list:
+    """Per-agent daily totals for one user"""
+    rows = _daily_totals(db, LLMUsageDaily.agent_type, since, LLMUsageDaily.user_id == user_id)
+    return _aggregate_rows(rows, "agent_type")
+
+def agent_usage(db: Session, since) -> list:
+    """Daily totals per agent across all users"""
+    return _aggregate_rows(_daily_totals(db, LLMUsageDaily.agent_type, since), "agent_type")
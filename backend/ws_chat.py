@@ -0,0 +1,179 @@
+"""
+WebSocket chat connections: one authentication per connection, several conversations
+multiplexed over it, streamed replies, heartbeats and backpressure
+"""
+
+import os
+import time
+import json
+import asyncio
+import logging
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# Server pings this often; a connection silent for WS_IDLE_TIMEOUT_SECONDS with no turn running is closed
+WS_HEARTBEAT_SECONDS = float(os.getenv("WS_HEARTBEAT_SECONDS", "20"))
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "60"))
+WS_AUTH_TIMEOUT_SECONDS = 10
+# Turns running at once per connection; further frames are not read until one finishes
+WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "4"))
+# Frames buffered for a slow client before producers (and the LLM stream) wait
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+# A turn is abandoned when the client does not take its frames for this long
+WS_SEND_TIMEOUT_SECONDS = 30
+
+# Close codes in the application range (4000-4999), mirroring HTTP statuses
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_IDLE = 4408
+
+class ConnectionClosed(Exception):
+    pass
+
+class ChatConnection:
+    """
+    Serves one WebSocket. `authenticate(token)` (blocking) returns (user, token expiry as
+    a Unix time); `run_turn(user, frame, connection)` handles one chat frame, sending its
+    replies with connection.send() or, from worker threads, connection.send_threadsafe().
+    """
+
+    def __init__(self, websocket: WebSocket, authenticate, run_turn):
+        self.websocket = websocket
+        self.authenticate = authenticate
+        self.run_turn = run_turn
+        self.user = None
+        self.expires_at = None
+        self.closed = False
+        self._outbox = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self._inflight = asyncio.Semaphore(WS_MAX_INFLIGHT)
+        self._turns = set()
+        self._conversation_locks = {}
+        self._last_seen = time.monotonic()
+        self._loop = None
+
+    async def send(self, frame: dict):
+        if self.closed:
+            raise ConnectionClosed()
+        await self._outbox.put(frame)
+
+    def send_threadsafe(self, frame: dict):
+        """Blocking send for worker threads; waits while the client is behind"""
+        future = asyncio.run_coroutine_threadsafe(self.send(frame), self._loop)
+        try:
+            future.result(timeout=WS_SEND_TIMEOUT_SECONDS)
+        except Exception:
+            future.cancel()
+            raise ConnectionClosed()
+
+    def conversation_lock(self, session_id: str) -> asyncio.Lock:
+        """Turns of the same conversation run one after another, so each sees the previous one"""
+        lock = self._conversation_locks.get(session_id)
+        if lock is None:
+            lock = self._conversation_locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def _receive(self) -> dict:
+        text = await self.websocket.receive_text()
+        self._last_seen = time.monotonic()
+        try:
+            frame = json.loads(text)
+        except ValueError:
+            frame = None
+        if not isinstance(frame, dict):
+            await self.send({"type": "error", "status": 400, "detail": "Frames must be JSON objects"})
+            return {}
+        return frame
+
+    async def _authenticate(self) -> bool:
+        token = self.websocket.query_params.get("token")
+        if not token:
+            # Browsers cannot set headers on WebSocket requests, so the token may come as the first frame
+            try:
+                frame = await asyncio.wait_for(self._receive(), WS_AUTH_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                frame = {}
+            if frame.get("type") == "auth":
+                token = frame.get("token")
+        try:
+            if not token:
+                raise HTTPException(status_code=401, detail="Authentication required")
+            self.user, self.expires_at = await run_in_threadpool(self.authenticate, token)
+        except HTTPException as e:
+            await self.websocket.send_json({"type": "error", "status": e.status_code, "detail": e.detail})
+            await self.websocket.close(code=CLOSE_UNAUTHORIZED)
+            return False
+        await self.websocket.send_json({"type": "ready", "user_id": self.user.id})
+        return True
+
+    async def _sender(self):
+        while True:
+            frame = await self._outbox.get()
+            try:
+                await self.websocket.send_json(frame)
+            finally:
+                self._outbox.task_done()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_SECONDS)
+            idle = time.monotonic() - self._last_seen
+            if idle > WS_IDLE_TIMEOUT_SECONDS and not self._turns:
+                logger.info(f"Closing idle WebSocket of user {self.user.id}")
+                await self.websocket.close(code=CLOSE_IDLE)
+                return
+            # The connection lives no longer than its token; clients reconnect with a fresh one
+            if self.expires_at is not None and time.time() >= self.expires_at and not self._turns:
+                await self.send({"type": "error", "status": 401, "detail": "Token has expired"})
+                await self._outbox.join()
+                await self.websocket.close(code=CLOSE_UNAUTHORIZED)
+                return
+            await self.send({"type": "ping", "ts": time.time()})
+
+    async def _turn(self, frame: dict):
+        try:
+            await self.run_turn(self.user, frame, self)
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            logger.error(f"WebSocket turn error for user {self.user.id}: {e}")
+            if not self.closed:
+                await self.send({"type": "error", "id": frame.get("id"), "status": 500, "detail": str(e)})
+        finally:
+            self._inflight.release()
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        await self.websocket.accept()
+        if not await self._authenticate():
+            return
+        background = [asyncio.create_task(self._sender()), asyncio.create_task(self._heartbeat())]
+        try:
+            while True:
+                # Backpressure: at WS_MAX_INFLIGHT turns, stop reading until one finishes
+                await self._inflight.acquire()
+                try:
+                    frame = await self._receive()
+                except BaseException:
+                    self._inflight.release()
+                    raise
+                kind = frame.get("type")
+                if kind == "chat":
+                    task = asyncio.create_task(self._turn(frame))
+                    self._turns.add(task)
+                    task.add_done_callback(self._turns.discard)
+                    continue
+                self._inflight.release()
+                if kind == "ping":
+                    await self.send({"type": "pong", "ts": frame.get("ts")})
+                elif kind == "auth":
+                    await self.send({"type": "error", "status": 400, "detail": "Already authenticated"})
+                elif kind not in ("pong", None):
+                    await self.send({"type": "error", "status": 400, "detail": f"Unknown frame type: {kind}"})
+        except (WebSocketDisconnect, RuntimeError):
+            pass
+        finally:
+            self.closed = True
+            for task in [*self._turns, *background]:
+                task.cancel()
+            await asyncio.gather(*self._turns, *background, return_exceptions=True)